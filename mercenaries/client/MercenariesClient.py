@@ -7,6 +7,7 @@ from CommonClient import logger
 from .lua import LuaTypeError
 from .MercenariesIPC import MercenariesIPC, IPCError
 from .MercenariesConnector import MercenariesConnector
+from .pinestats import PineStats
 
 _MERCS_DEBUG = 'MERCS_DEBUG' in os.environ
 
@@ -30,12 +31,14 @@ class MercenariesContext(SuperContext):
   capture_hints = set()
   connector: MercenariesConnector = None
 
-  def __init__(self, server_address: str, slot_name: str, password: str, pine_path: str):
+  def __init__(self, server_address: str, slot_name: str, password: str, pine_path: str, record: str = None, patch_store: str = None):
     super().__init__(server_address, password)
     self.auth = slot_name
     self.locations_checked = set()
     self.pine_path = pine_path
-    self.ipc = MercenariesIPC(self.pine_path)
+    self.ipc = MercenariesIPC(self.pine_path, record=record, patch_store=patch_store)
+    if _MERCS_DEBUG:
+      PineStats().attach(self.ipc.pine)
     self.debug('Initialization complete.')
 
   def reset_server_state(self):
@@ -45,6 +48,11 @@ class MercenariesContext(SuperContext):
     self.hintables = set()
     self.capture_hints = set()
 
+  async def shutdown(self):
+    await super().shutdown()
+    # Among other things, this finishes off the log if we're recording.
+    self.ipc.pine.close()
+
   def make_gui(self):
     ui = super().make_gui()
     ui.base_title = 'Mercenaries Client'
@@ -153,9 +161,24 @@ class MercenariesContext(SuperContext):
           self.debug('Still waiting for state from server.')
           continue
 
+        stats = connector.begin_tick({
+          'items': [item.item for item in self.items_received],
+          'sent_items': self.stored_data['sent_items'],
+          'missing': sorted(self.missing_locations),
+          'checked': sorted(self.checked_locations),
+          'slot_data': self.slot_data,
+        })
+        if _MERCS_DEBUG:
+          self.debug('Game memory cache: %s', stats)
+          self.debug('PINE traffic:\n%s', self.ipc.pine.stats.advance())
+
         # Send new items
         old_sent_items = Counter({int(k): v for k,v in self.stored_data['sent_items'].items()})
-        new_sent_items = connector.send_items(self.items_received, old_sent_items)
+        # Everything that talks to the game blocks on PINE round trips, so it
+        # runs in a worker thread to keep the event loop free for the server
+        # connection and the GUI.
+        new_sent_items = await asyncio.to_thread(
+          connector.send_items, list(self.items_received), old_sent_items)
 
         if new_sent_items != old_sent_items:
           print(f'Updating sent_items, diff: {new_sent_items - old_sent_items}')
@@ -165,8 +188,9 @@ class MercenariesContext(SuperContext):
             ])
 
         # Get new checks and capture-based hints.
-        (new_checks,new_hints) = connector.get_checks_and_hints(
-          self.missing_locations, self.slot_data['hints_from_cards'])
+        (new_checks,new_hints) = await asyncio.to_thread(
+          connector.get_checks_and_hints,
+          set(self.missing_locations), self.slot_data['hints_from_cards'])
 
         # Report new checks.
         self.locations_checked |= new_checks
@@ -200,8 +224,10 @@ class MercenariesContext(SuperContext):
         import traceback
         self.debug(f'Unexpected error talking to the game:')
         self.debug(traceback.format_exc())
-        self.ipc = MercenariesIPC(pine=self.ipc.pine)
-        self.connector.game = self.ipc
+        # Make the next tick look everything up again and re-check the patches,
+        # but keep the same IPC, so an injection that was interrupted partway
+        # through picks up where it left off.
+        self.ipc.clear_handles()
         await asyncio.sleep(9)
       finally:
         await asyncio.sleep(1)
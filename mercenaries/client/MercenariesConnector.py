@@ -41,6 +41,15 @@ class MercenariesConnector:
     self.options = options
     self.messages = deque()
 
+  def begin_tick(self, state = None):
+    '''
+    Called at the start of each sync tick. Returns the game memory cache stats
+    for the previous tick. state is the client state the rest of the tick is
+    going to be working from, which is recorded along with the PINE traffic if
+    recording is on, so that replay.py can make the same calls.
+    '''
+    return self.game.advance_epoch(state)
+
   #### Readers ####
   def current_chapter(self):
     return self.game.latest_chapter
@@ -104,10 +113,9 @@ class MercenariesConnector:
       self.send_reputation_items(self.item_group('reputation', items))
       new_sent_items |= self.send_once(items, old_sent_items)
     except IPCError as e:
+      # No need to reset anything: if the lua_State has moved by the time we
+      # retry, the IPC notices and sets itself up again.
       logger.info(f'Error sending items to game, will retry later: {e}')
-      # Probably don't need to do this *every* time...
-      self.game = MercenariesIPC(pine=self.game.pine)
-      pass
 
     return Counter({item.id: new_sent_items[item] for item in new_sent_items})
 
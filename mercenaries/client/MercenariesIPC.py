@@ -24,109 +24,396 @@ Useful but not yet usable addresses --
 '''
 
 from contextlib import contextmanager
-from typing import List
+from functools import partial
+import struct
+from typing import Dict, List, NamedTuple, Tuple
 
 from .deck import DeckOf52
-from .lua import GCObject, Lua_TObject, LUA_TNUMBER, LUA_TSTRING, LUA_TBOOL
+from .lua import clear_cache, global_index, observe_gc, tobject_value, Lua_TObject, GC_THRESHOLD_OFFSET, LUA_TNUMBER, LUA_TSTRING, LUA_TTABLE, LUA_TBOOL
 from .lopcode import LuaOpcode
-from .patch import patch
+from .pagecache import PageCache
+from .patch import Injection, PatchRecord, PatchStore
 from .pine import Pine
-from .shop import MafiaShop
+from .pinelog import PineRecorder
+from .shop import MafiaShop, ShopCounts
 from .stats import PDAStats
 from ..items.shop import ShopItem
 
 class IPCError(RuntimeError):
   pass
 
+class GameState(NamedTuple):
+  '''
+  Everything validate() looks at. Also serves as a fingerprint of the game's
+  state: if it hasn't changed, neither has anything we worked out from it.
+  '''
+  # Pointer to the player, and the model index in it.
+  player: int
+  model: int
+  # Player control flag, and the on foot/in vehicle flags as one 64-bit value.
+  control: int
+  movement: int
+  # Radar texture name; see radar_to_map().
+  radar: bytes
+  # The mystery pointer, and the value it points to.
+  mystery: int
+  mystery_value: int
+  # The lua_State, its global_State, and the GC threshold in that.
+  L_ptr: int
+  l_G: int
+  gc_threshold: int
+
+  def pointers(self):
+    return (self.player, self.mystery, self.L_ptr, self.l_G)
+
+def queue_game_state(pine: Pine, batch, previous: GameState = None):
+  '''
+  Queue the reads for a GameState on batch. Returns a function that takes the
+  batch's results and returns the GameState.
+
+  The fixed addresses are read in the batch, and so are the things that hang off
+  pointers, at the addresses the pointers had in the previous state; as long as
+  none of the pointers have changed, that's everything. If any have, the
+  dependent reads are redone in the order they depend on each other.
+  '''
+  first = len(batch)
+  batch.peek32(0x005007f4) # player
+  batch.peek32(0x005131e0) # control
+  batch.peek64(0x00558b10) # movement
+  batch.peek64(0x004a40e8) # radar
+  batch.peek32(0x00501a44) # mystery pointer
+  batch.peek32(0x0056CBD0) # L_ptr
+  if previous:
+    batch.peek32(previous.player + 0x74)
+    batch.peek32(previous.mystery + 0x10)
+    batch.peek32(previous.L_ptr + 0x10)
+    batch.peek32(previous.l_G + GC_THRESHOLD_OFFSET)
+
+  def finish(results):
+    (player, control, movement, radar, mystery, L_ptr) = results[first:first+6]
+    radar = struct.pack('< Q', radar)
+    dependent = results[first+6:first+10]
+    if previous and (player, mystery, L_ptr, dependent[2]) == previous.pointers():
+      (model, mystery_value, l_G, gc_threshold) = dependent
+      return GameState(player, model, control, movement, radar, mystery, mystery_value, L_ptr, l_G, gc_threshold)
+
+    batch = pine.batch()
+    batch.peek32(player + 0x74)
+    batch.peek32(mystery + 0x10)
+    batch.peek32(L_ptr + 0x10)
+    (model, mystery_value, l_G) = batch.run()
+    gc_threshold = pine.peek32(l_G + GC_THRESHOLD_OFFSET) if L_ptr else 0
+    return GameState(player, model, control, movement, radar, mystery, mystery_value, L_ptr, l_G, gc_threshold)
+  return finish
+
+def radar_to_map(radar: bytes):
+  # Radar texture name, which is going to be a null-terminated string that is
+  # one of:
+  # rdrNW rdrSW -- north or south world
+  # rdraclubs, rdrAdmnd, rdrAHeart, rdrAspade -- ace missions
+  # rdrSWN -- tutorial
+  # rdrcddn -- credits/menu
+  radar = radar + b'\0'
+  match radar[:radar.find(0)]:
+    case b'rdrcddn': return 'menu'
+    case b'rdrSW': return 'SK'
+    case b'rdrNW': return 'NK'
+    case b'rdraclub': return 'clubs'
+    case b'rdrAdmnd': return 'diamonds'
+    case b'rdrAHear': return 'hearts'
+    case b'rdrAspad': return 'spades'
+  return 'unknown'
+
+
+class LuaLayout(NamedTuple):
+  '''
+  Where the Lua values in a GameSnapshot were found, so that the next snapshot
+  can read them again directly rather than looking them up.
+  '''
+  L_ptr: int
+  # _G's node array and size, and the nodes holding mission_accepted and
+  # quadrant, as (node, key string).
+  G: int
+  G_nodes: int
+  G_size: int
+  globals: Tuple[Tuple[int, int], ...]
+  # The mission_accepted table, its node array and size, and the nodes holding
+  # the factions' mission counts, as (faction, node, key string).
+  missions: int
+  nodes: int
+  size: int
+  fields: Tuple[Tuple[str, int, int], ...]
+  # The quadrant string, and whether it was 'nw'.
+  quadrant: int
+  north: bool
+
+
+class GameSnapshot(NamedTuple):
+  '''
+  Everything the IPC's queries need to know about the game, as of the start of
+  a tick. Built by MercenariesIPC.game_snapshot() from one batched read; see
+  there for the details.
+  '''
+  state: GameState
+  # Suit to card statuses, ace first; see DeckOf52.deck_status().
+  deck: Dict[str, List[int]]
+  shop: ShopCounts
+  # Bounty type to index into the bounty string buffer, and to count.
+  bounty_indexes: Dict[str, int]
+  bounties: Dict[str, int]
+  # Value of bDebugOutput, and the number of missions completed for each
+  # faction, or None if they haven't been read yet.
+  debug_flag: bool
+  missions: Dict[str, float]
+  lua: LuaLayout
+
+
 class MercenariesIPC:
   pine: Pine
   shop: MafiaShop
   L_ptr: int = -1
+  # Progress of patching the current lua_State; see patch.py.
+  injection: Injection = None
+  # This tick's GameSnapshot, and the PageCache epoch (i.e. tick) it's for.
+  snapshot: GameSnapshot = None
+  snapshot_epoch: int = -1
+  debug_flag: Lua_TObject = None
   intel_total: Lua_TObject
   deck: DeckOf52
   stats: PDAStats
   latest_chapter: int = 0
 
-  def __init__(self, pine_path: str = None, pine: Pine = None) -> None:
+  def __init__(self, pine_path: str = None, pine: Pine = None, record: str = None, patch_store: str = None) -> None:
+    # If record is set, all PINE traffic is logged to it; see pinelog.py.
+    # If patch_store is set, what we patched is remembered there so that we
+    # don't need to do it again after a restart; see patch.py.
+    self.patches = patch_store and PatchStore(patch_store)
+    connect = partial(PineRecorder, record) if record else Pine
     if not pine_path:
       assert pine
       self.pine = pine
     elif pine_path[0] == '/':
       print(f'Connecting to PCSX2 via UNIX domain socket {pine_path}')
-      self.pine = Pine(path=pine_path)
+      self.pine = connect(path=pine_path)
     else:
       print(f'Connecting to PCSX2 via TCP socket {pine_path}')
-      self.pine = Pine(address=pine_path)
+      self.pine = connect(address=pine_path)
+
+    if self.pine.cache is None:
+      self.pine.cache = PageCache(self.pine)
 
     self.shop = MafiaShop(self.pine)
     self.deck = DeckOf52(self.pine)
     self.stats = PDAStats(self.pine)
 
+  def advance_epoch(self, state = None):
+    '''
+    Discard everything we've cached about game memory, so that the next reads
+    see the game's current state. Should be called once per sync tick, before
+    anything else. Returns the cache stats for the previous tick.
+
+    state is passed on to Pine.tick(), for the benefit of PineRecorder.
+    '''
+    self.pine.tick(state)
+    return self.pine.cache.advance()
+
   def validate(self):
     # We need to both probe the game to see if it's in a consistent state, and
     # if so, compare that state to our current state to see if they match.
     # If the former check fails, we can't do anything.
     # If the latter check fails, we need to reinitialize our pointers and code
     # injections.
-    if self.pine.peek32(self.pine.peek32(0x005007f4) + 0x74) > 8:
+    # Everything we look at is read at most once per tick; see game_snapshot().
+    snapshot = self.game_snapshot()
+    state = snapshot.state
+    if state.model > 8:
       # Player model index. Only 0-8 are "normal" gameplay models.
       raise IPCError('Game is between scenes')
-    if self.pine.peek32(0x005131e0) == 0:
+    if state.control == 0:
       # Set to 1 in normal play, 0 in cutscenes.
       raise IPCError('Player is not in control')
-    if self.pine.peek64(0x00558b10) == 0:
+    if state.movement == 0:
       # Two 4-byte flags, first is 1 if the player is on foot, second is 1 if
       # they're in a vehicle, if they're both 0 who knows what's happening?
       raise IPCError('Player is in an unknown state')
-    if self.get_map() in {'menu', 'unknown'}:
+    if radar_to_map(state.radar) in {'menu', 'unknown'}:
       raise IPCError('Not in normal map')
-    ptr = self.pine.peek32(0x00501a44)
-    if ptr == 0x00501a44 or self.pine.peek32(ptr + 0x10) > 0:
+    if state.mystery == 0x00501a44 or state.mystery_value > 0:
       raise IPCError('Mystery Pointer has concerning value')
 
-    L_ptr = self.pine.peek32(0x0056CBD0)
-    if self.L_ptr != L_ptr:
+    if self.L_ptr != state.L_ptr:
       self.clear_handles()
-      self.inject(L_ptr)
+      self.inject(state.L_ptr)
+    if snapshot.debug_flag is None or snapshot.missions is None:
+      # Now that we know it's safe to go poking around in the lua_State, look up
+      # whatever the snapshot couldn't find where it was last time.
+      with self.pine.tagged('snapshot'):
+        (debug_flag, missions, layout) = self.read_lua()
+      self.snapshot = snapshot._replace(debug_flag=debug_flag, missions=missions, lua=layout)
+
+  def game_snapshot(self) -> GameSnapshot:
+    '''
+    Returns the GameSnapshot for this tick, reading it if this is the first time
+    we've been asked this tick.
+
+    Everything goes out in one batch: the GameState, the deck, the shop
+    metadata, the bounty indexes, and the Lua values. The things that hang off
+    pointers -- the GameState's dependent values, the bounty strings, and the
+    Lua values -- are read from where they were in the previous snapshot, and
+    only looked up again if they've moved, so most ticks this is one round trip.
+    The Lua values are None until validate() has checked that it's safe to look
+    them up, if they need looking up.
+    '''
+    if self.snapshot is not None and self.snapshot_epoch == self.pine.cache.epoch:
+      return self.snapshot
+    previous = self.snapshot
+    with self.pine.tagged('snapshot'):
+      batch = self.pine.batch()
+      state = queue_game_state(self.pine, batch, previous and previous.state)
+      deck = self.deck.queue_status(batch)
+      shop = self.shop.queue_counts(batch)
+      bounties = self.stats.queue_bounties(batch, previous and previous.bounty_indexes)
+      lua = self.queue_lua(batch, previous and previous.lua)
+      results = batch.run()
+      state = state(results)
+      (bounty_indexes, bounty_counts) = bounties(results)
+      (debug_flag, missions, layout) = lua(results, state.L_ptr)
+    self.snapshot = GameSnapshot(
+      state, deck(results), shop(results), bounty_indexes, bounty_counts,
+      debug_flag, missions, layout)
+    self.snapshot_epoch = self.pine.cache.epoch
+    observe_gc(state.L_ptr, state.gc_threshold)
+    return self.snapshot
+
+  def queue_lua(self, batch, layout: LuaLayout = None):
+    '''
+    Queue reads of the Lua values for a GameSnapshot on batch, from where they
+    were in layout. Returns a function that takes the batch's results and the
+    lua_State they're for, and returns (debug_flag, missions, layout), with None
+    for anything that isn't where it was or that we don't know where to find.
+    '''
+    L_ptr = self.L_ptr
+    flag = batch.readmem(self.debug_flag.addr, 8) if L_ptr and self.debug_flag else None
+    if layout is not None and layout.L_ptr == L_ptr:
+      G = batch.readmem(layout.G + 4, 16)
+      globals = [batch.readmem(node, 16) for (node, _) in layout.globals]
+      missions = batch.readmem(layout.missions + 4, 16)
+      fields = [batch.readmem(node, 16) for (_, node, _) in layout.fields]
+    else:
+      layout = None
+
+    def finish(results, state_L_ptr):
+      if state_L_ptr != L_ptr:
+        return (None, None, None)
+      debug_flag = None
+      if flag is not None:
+        debug_flag = bool(tobject_value(self.pine, *struct.unpack('< I I', flag)))
+      if layout is None:
+        return (debug_flag, None, None)
+
+      # Table header from the type tag on: tt, marked, flags, lsizenode, mt,
+      # array, node.
+      if (struct.unpack('< 3x B 8x I', G) != (layout.G_size.bit_length() - 1, layout.G_nodes)
+          or struct.unpack('< 3x B 8x I', missions) != (layout.size.bit_length() - 1, layout.nodes)):
+        return (debug_flag, None, None)
+      expected = [
+        (LUA_TSTRING, layout.globals[0][1], LUA_TTABLE, layout.missions),
+        (LUA_TSTRING, layout.globals[1][1], LUA_TSTRING, layout.quadrant),
+      ]
+      if [struct.unpack('< 4I', node) for node in globals] != expected:
+        return (debug_flag, None, None)
+      counts = {}
+      for (faction, _, key),node in zip(layout.fields, fields):
+        (ktt, kptr, vtt, value) = struct.unpack('< I I I f', node)
+        if (ktt, kptr, vtt) != (LUA_TSTRING, key, LUA_TNUMBER):
+          return (debug_flag, None, None)
+        counts[faction] = value + (6 if layout.north else 0)
+      return (debug_flag, counts, layout)
+    return finish
+
+  def read_lua(self):
+    '''
+    Look up the Lua values for a GameSnapshot the slow way, returning
+    (debug_flag, missions, layout). Only safe once validate() has checked the
+    game's state.
+    '''
+    debug_flag = bool(self.debug_flag.val())
+    try:
+      index = global_index(self.pine, self.L_ptr, ['mission_accepted', 'quadrant'])
+      missions = index.getglobal('mission_accepted').val()
+      quadrant = index.getglobal('quadrant').val()
+      north = quadrant.data == b'nw'
+      if missions is None:
+        return (debug_flag, {}, None)
+      nodes = {
+        faction: missions.getnode(faction)
+        for faction in ['allies', 'china', 'mafia', 'sk']
+      }
+      counts = {
+        faction: node.v.val() + (6 if north else 0)
+        for faction,node in nodes.items()
+      }
+    except KeyError:
+      return (debug_flag, {}, None)
+    G = index.table
+    layout = LuaLayout(
+      self.L_ptr, G.addr, G.hash_ptr, G.hash_size,
+      tuple(
+        (G.hash_ptr + index.nodes[name]*20, index.keys[name])
+        for name in ['mission_accepted', 'quadrant']),
+      missions.addr, missions.hash_ptr, missions.hash_size,
+      tuple((faction, node.addr, node.k.val().addr) for faction,node in nodes.items()),
+      quadrant.addr, north)
+    return (debug_flag, counts, layout)
 
   def clear_handles(self):
+    # The lua_State has moved, so anything we cached from the old one is junk.
+    self.pine.cache.invalidate()
+    clear_cache()
     self.L_ptr = None
     self.intel_total = None
     self.shop_txn = 0
 
   def inject(self, L_ptr):
-    print('Starting code injection.')
-    # Initialize Lua.
+    if self.patches and self.restore_injection(L_ptr):
+      return
     # Caller has already done consistency checks so hopefully we don't crash.
-    L = GCObject(self.pine, L_ptr)
+    # Injection grabs all the things we want to modify *first*, so that if any
+    # of them are nil (in which case it raises KeyError) we know the VM isn't
+    # done starting up yet and can retry later. If we get interrupted partway
+    # through, the next call picks up where this one left off, as long as it's
+    # the same lua_State.
+    if self.injection is None or self.injection.L_ptr != L_ptr:
+      print('Starting code injection.')
+      self.injection = Injection(self.pine, L_ptr)
+    else:
+      print(f'Resuming {self.injection}.')
+
+    with self.pine.tagged('patch'):
+      handles = self.injection.run()
+      debug_flag = self.injection.globals['bDebugOutput']
+      if self.patches:
+        self.patches.put(
+          self.pine.uuid(), L_ptr,
+          PatchRecord.capture(self.pine, self.injection.index, handles, debug_flag))
+    self.set_handles(L_ptr, handles, debug_flag)
+    print('Code injection complete.')
 
-    # Grab all the things we want to modify *first*, so that if any of them are
-    # nil we know the VM isn't done starting up yet and can retry later.
-    # TODO: maybe getglobal and getnode should raise KeyError?
-    try:
-      globals = {
-        'gameflow_GetIntelTotal': L.getglobal('gameflow_GetIntelTotal'),
-        'gameflow_ShouldGameStateApply': L.getglobal('gameflow_ShouldGameStateApply'),
-        'util_PrintDebugMsg': L.getglobal('util_PrintDebugMsg'),
-        'Debug_Printf': L.getglobal('Debug_Printf'),
-        'gameflow_AttemptAceMissionUnlock': L.getglobal('gameflow_AttemptAceMissionUnlock'),
-        'AttemptFactionMoodClamp': L.getglobal('AttemptFactionMoodClamp'),
-        # Stuff that we need to reference by name
-        'bDebugOutput_name': L.getglobalnode('bDebugOutput').k,
-        'gameflow_ShouldGameStateApply_name': L.getglobalnode('gameflow_ShouldGameStateApply').k,
-        'gameflow_GetIntelTotal_name': L.getglobalnode('gameflow_GetIntelTotal').k,
-        'gameflow_AttemptAceMissionUnlock_name': L.getglobalnode('gameflow_AttemptAceMissionUnlock').k,
-        'Player_GetMoney_name': L.getglobalnode('Player_GetMoney').k,
-        'Player_SetMoney_name': L.getglobalnode('Player_SetMoney').k,
-        'Ui_PrintHudMessage_name': L.getglobalnode('Ui_PrintHudMessage').k,
-        'Support_AddItem_name': L.getglobalnode('Support_AddItem').k,
-        # Stuff we need to wiggle later
-        'bDebugOutput': L.getglobal('bDebugOutput'),
-      }
-    except KeyError as e:
-      # raise IPCError(f'lua_State is still initializing: {e}')
-      raise e
+  def restore_injection(self, L_ptr):
+    '''
+    If we've patched this lua_State before, and it's still patched, pick up the
+    handles from last time rather than patching it again. Returns True if it
+    did so.
+    '''
+    with self.pine.tagged('patch'):
+      record = self.patches.get(self.pine.uuid(), L_ptr)
+      if record is None or not record.check(self.pine):
+        return False
+    self.set_handles(L_ptr, *record.restore(self.pine))
+    print('Code injection already done, reusing it.')
+    return True
 
+  def set_handles(self, L_ptr, handles, debug_flag):
     (
       self.intel_total,
       self.money_bonus,
@@ -135,30 +422,14 @@ class MercenariesIPC:
       self.support_item,
       self.has_support_item,
       self.reputation_floors,
-    ) = patch(globals)
-    self.debug_flag = globals['bDebugOutput']
+    ) = handles
+    self.debug_flag = debug_flag
     self.L_ptr = L_ptr
-    print('Code injection complete.')
 
 
   #### Useful informational functions ####
   def get_map(self):
-    # pointer to radar texture name buffer!
-    # going to be a null-terminated string that is one of:
-    # rdrNW rdrSW -- north or south world
-    # rdraclubs, rdrAdmnd, rdrAHeart, rdrAspade -- ace missions
-    # rdrSWN -- tutorial
-    # rdrcddn -- credits/menu
-    radar = self.pine.readmem(0x004a40e8, 8) + b'\0'
-    match radar[:radar.find(0)]:
-      case b'rdrcddn': return 'menu'
-      case b'rdrSW': return 'SK'
-      case b'rdrNW': return 'NK'
-      case b'rdraclub': return 'clubs'
-      case b'rdrAdmnd': return 'diamonds'
-      case b'rdrAHear': return 'hearts'
-      case b'rdrAspad': return 'spades'
-    return 'unknown'
+    return radar_to_map(self.game_snapshot().state.radar)
 
   def current_chapter(self):
     if self.is_card_verified('spades', 1):
@@ -181,24 +452,11 @@ class MercenariesIPC:
 
     Checking a location requires talking to the game, and checking all the
     locations requires talking to the game a lot, which is very expensive. So
-    we do the talking at the start of the location check block and cache the
-    results.
+    all the checks are answered from this tick's GameSnapshot, which validate()
+    makes sure is complete.
     '''
     self.validate()
     self.doing_location_checks = True
-    try:
-      L = GCObject(self.pine, self.L_ptr)
-      missions = L.getglobal('mission_accepted').val()
-      north = L.getglobal('quadrant').val().data == b'nw'
-      self.mission_cache = {
-        faction: missions.getfield(faction).val() + (6 if north else 0)
-        for faction in ['allies', 'china', 'mafia', 'sk']
-        if missions is not None
-      }
-    except KeyError:
-      self.mission_cache = {}
-    self.bounty_cache = self.stats.bounties_found()
-    self.card_cache = self.deck.deck_status()
     self.latest_chapter = self.current_chapter()
 
     try:
@@ -209,9 +467,6 @@ class MercenariesIPC:
   def end_location_checks(self):
     assert self.doing_location_checks
     self.doing_location_checks = False
-    self.bounty_cache = None
-    self.mission_cache = None
-    self.card_cache = None
 
   def is_checked(self, location):
     assert self.doing_location_checks
@@ -223,19 +478,19 @@ class MercenariesIPC:
 
   def is_card_verified(self, suit, rank):
     assert self.doing_location_checks
-    return self.card_cache[suit][rank-1] > 1
+    return self.game_snapshot().deck[suit][rank-1] > 1
 
   def is_card_captured(self, suit, rank):
     assert self.doing_location_checks
-    return self.card_cache[suit][rank-1] > 2
+    return self.game_snapshot().deck[suit][rank-1] > 2
 
   def is_mission_complete(self, faction: str, mission: int) -> bool:
     assert self.doing_location_checks
-    return mission < self.mission_cache.get(faction, 0)
+    return mission < self.game_snapshot().missions.get(faction, 0)
 
   def is_bounty_collected(self, type: str, count: int) -> bool:
     assert self.doing_location_checks
-    return self.bounty_cache[type] >= count
+    return self.game_snapshot().bounties[type] >= count
 
   def send_once(self, money: int = 0, message: str = '', support_item: str = ''):
     '''
@@ -253,7 +508,7 @@ class MercenariesIPC:
     if not money and not message and not support_item:
       return False
 
-    if self.debug_flag.val():
+    if self.game_snapshot().debug_flag:
       return False
 
     self.money_bonus.set(money)
@@ -272,6 +527,7 @@ class MercenariesIPC:
       self.has_support_item.set(False, tt=LUA_TBOOL)
 
     self.debug_flag.set(True)
+    self.snapshot = self.snapshot._replace(debug_flag=True)
     return True
 
   def set_unlocked_shop_items(self, items: List[ShopItem], txn):
@@ -287,7 +543,7 @@ class MercenariesIPC:
     # Number of distinct unlocks from AP once duplicates are merged
     ap_count = len(items)
     # Number of unlocks the player has in-game.
-    game_count = self.shop.unlock_count()
+    game_count = self.game_snapshot().shop.unlocks
 
     if ap_count != game_count or self.shop_txn != txn:
       # Either the player has received a new unlock through AP, or they've found
@@ -295,6 +551,7 @@ class MercenariesIPC:
       print(f'Updating shop items (game: count={game_count}, txn={self.shop_txn}; ap: count={ap_count}, txn={txn})')
       self.shop.set_unlocks(items)
       self.shop_txn = txn
+      self.snapshot = self.snapshot._replace(shop=self.shop.counts_for(items))
 
   def set_intel(self, amount, target):
     self.validate()
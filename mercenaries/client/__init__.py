@@ -29,7 +29,7 @@ def main(*args):
   Utils.init_logging('MercenariesClient')
 
   async def actual_main(args):
-    ctx = MercenariesContext(args.connect, args.name, args.password, args.pcsx2)
+    ctx = MercenariesContext(args.connect, args.name, args.password, args.pcsx2, args.record, args.patch_store)
     ctx.server_task = asyncio.create_task(server_loop(ctx), name='ServerLoop')
     if tracker_loaded:
       logger.info('Initializing tracker...')
@@ -46,6 +46,8 @@ def main(*args):
   parser = get_base_parser()
   parser.add_argument('--pcsx2', default=get_pine_path(), help='Absolute path (unix) or host:port (windows) for PCSX2 PINE connection')
   parser.add_argument('--name', default=None, help='Slot name')
+  parser.add_argument('--record', default=None, help='Record all PINE traffic to this file, for use with replay.py')
+  parser.add_argument('--patch-store', default=Utils.user_path('mercenaries_patches.json'), help='Remember code injections in this file, so they can be reused after restarting the client')
 
   colorama.init()
   args = parser.parse_args(args)
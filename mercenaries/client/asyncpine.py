@@ -0,0 +1,194 @@
+'''
+asyncio client for the PINE protocol.
+
+This speaks the same protocol as Pine, but never blocks the event loop, and can
+have multiple requests in flight at once. PCSX2 handles requests on a connection
+strictly in order, so replies are matched to requests by position: each request
+appends a future to the pending queue, and the reader task resolves them front
+to back as replies arrive.
+
+  pine = await AsyncPine.connect(path='/run/user/1000/pcsx2.sock')
+  n = await pine.peek32(addr)
+  (a, b) = await asyncio.gather(pine.peek32(x), pine.peek32(y))
+
+  batch = pine.batch()
+  batch.peek32(x)
+  batch.poke32(y, 0)
+  results = await batch.run()
+'''
+
+import asyncio
+from collections import deque
+
+from .pine import PineBatch, PineCodec, PineStatus
+
+
+class AsyncPineBatch(PineBatch):
+  '''
+  PineBatch for an AsyncPine. Identical to PineBatch except that run() is a
+  coroutine, and if the batch needs multiple messages, they are all sent at
+  once rather than waiting for each reply in turn.
+  '''
+  async def run(self):
+    (ops, frames) = (self.ops, list(self.frames()))
+    self.ops = []
+    replies = await asyncio.gather(*[
+      self.pine.send_batch(ops[start:end], start)
+      for start,end in frames
+    ])
+    return [result for reply in replies for result in reply]
+
+
+class AsyncPine(PineCodec):
+  reader: asyncio.StreamReader
+  writer: asyncio.StreamWriter
+  pending: deque
+  # Why the connection stopped working, once it has; see read_replies().
+  error: ConnectionError = None
+
+  def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_in_flight: int = 16):
+    '''
+    Wrap an existing stream pair. Most callers want AsyncPine.connect() instead.
+    max_in_flight limits how many requests can be awaiting replies at once, so
+    that we don't flood the emulator's socket buffers.
+    '''
+    self.reader = reader
+    self.writer = writer
+    self.pending = deque()
+    self.slots = asyncio.Semaphore(max_in_flight)
+    self.reader_task = asyncio.create_task(self.read_replies(), name='AsyncPineReader')
+
+  @classmethod
+  async def connect(cls, path: str = None, address: str = None, **kwargs):
+    assert path or address, "AsyncPine requires a path or address"
+
+    if path:
+      (reader, writer) = await asyncio.open_unix_connection(path)
+    else:
+      (host, port) = address.split(':')
+      (reader, writer) = await asyncio.open_connection(host, int(port))
+
+    return cls(reader, writer, **kwargs)
+
+  async def close(self):
+    self.reader_task.cancel()
+    self.writer.close()
+    await self.writer.wait_closed()
+
+  async def read_replies(self):
+    '''
+    Background task that reads replies and hands them to whoever is waiting at
+    the front of the pending queue. Failed commands get None, same as Pine.recv().
+
+    If anything goes wrong, we can no longer tell which reply belongs to which
+    request, so the connection is dead: everything pending fails, and so does
+    every later request.
+    '''
+    try:
+      while True:
+        (size, result) = self.decode_header(await self.reader.readexactly(5))
+        data = await self.reader.readexactly(size-5) if size > 5 else b''
+        if not self.pending:
+          raise ConnectionError('reply received with no request pending')
+        future = self.pending.popleft()
+        if not future.cancelled():
+          future.set_result(None if result > 0 else data)
+    except asyncio.CancelledError:
+      self.error = ConnectionError('PINE connection closed')
+      raise
+    except Exception as e:
+      self.error = ConnectionError(f'PINE connection lost: {e}')
+    finally:
+      while self.pending:
+        future = self.pending.popleft()
+        if not future.cancelled():
+          future.set_exception(self.error)
+
+  async def request(self, message: bytes):
+    '''
+    Send a complete, encoded message and wait for the reply payload. Returns
+    None if the emulator reports failure. Raises ConnectionError if the
+    connection has been lost or closed.
+    '''
+    async with self.slots:
+      if self.error:
+        raise self.error
+      future = asyncio.get_running_loop().create_future()
+      # No awaits between queueing the future and writing the request, so the
+      # order of pending always matches the order requests hit the socket.
+      self.pending.append(future)
+      self.writer.write(message)
+      await self.writer.drain()
+      return await future
+
+  async def command(self, opcode: int, unpack, payload: bytes = b''):
+    data = await self.request(self.encode_command(opcode, payload))
+    assert data is not None, f"Error receiving reply for command {opcode}"
+    return unpack(data)
+
+  def batch(self):
+    return AsyncPineBatch(self)
+
+  async def send_batch(self, ops, base: int = 0):
+    data = await self.request(self.encode_batch(ops))
+    if data is None:
+      raise self.batch_error(ops, base, await self.find_failure(ops))
+    return self.decode_batch(ops, data)
+
+  async def find_failure(self, ops):
+    for i,request in self.probe_ops(ops):
+      if await self.request(self.encode_op(request)) is None:
+        return i
+    return None
+
+  async def run_one(self, queue, *args):
+    batch = self.batch()
+    queue(batch, *args)
+    return (await batch.run())[0]
+
+  # Higher-level commands, mirroring Pine.
+
+  async def game_info(self):
+    return PineStatus(*await asyncio.gather(
+      self.command(0x0B, self.unpack_string),
+      self.command(0x0C, self.unpack_string),
+      self.command(0x0D, self.unpack_string),
+      self.command(0x0E, self.unpack_string)))
+
+  async def peek8(self, addr):
+    return await self.run_one(PineBatch.peek8, addr)
+  async def peek16(self, addr):
+    return await self.run_one(PineBatch.peek16, addr)
+  async def peek32(self, addr):
+    return await self.run_one(PineBatch.peek32, addr)
+  async def peek64(self, addr):
+    return await self.run_one(PineBatch.peek64, addr)
+
+  async def peekf32(self, addr):
+    return await self.run_one(PineBatch.peekf32, addr)
+
+  async def poke8(self, addr, n):
+    return await self.run_one(PineBatch.poke8, addr, n)
+  async def poke16(self, addr, n):
+    return await self.run_one(PineBatch.poke16, addr, n)
+  async def poke32(self, addr, n):
+    return await self.run_one(PineBatch.poke32, addr, n)
+  async def poke64(self, addr, n):
+    return await self.run_one(PineBatch.poke64, addr, n)
+
+  async def pokef32(self, addr, n):
+    return await self.run_one(PineBatch.pokef32, addr, n)
+
+  async def readmem(self, addr, size):
+    batch = self.batch()
+    buf = batch.readmem(addr, size)
+    await batch.run()
+    return bytes(buf)
+
+  async def writemem(self, addr, data):
+    batch = self.batch()
+    batch.writemem(addr, data)
+    await batch.run()
+
+  async def readstring(self, addr, size):
+    return (await self.readmem(addr, size)).decode(errors='replace')
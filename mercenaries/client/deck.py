@@ -28,7 +28,8 @@ class DeckOf52:
       # Aces are internally considered rank 14, above kings; rank 1 is empty
       rank = 14
     rank -= 2 # Arrays are zero-indexed and the 2 of X occupies index 0
-    return self.cards[suit][rank]()
+    with self.pine.tagged('deck'):
+      return self.cards[suit][rank]()
 
   def is_verified(self, suit, rank):
     return self.card_status(suit, rank) > 1
@@ -37,7 +38,28 @@ class DeckOf52:
     return self.card_status(suit, rank) > 2
 
   def deck_status(self):
-    return {
-      suit: [self.card_status(suit, rank+1) for rank in range(13)]
-      for suit in ['clubs', 'diamonds', 'hearts', 'spades']
-    }
+    batch = self.pine.batch()
+    finish = self.queue_status(batch)
+    with self.pine.tagged('deck'):
+      return finish(batch.run())
+
+  def queue_status(self, batch):
+    '''
+    Queue the reads for deck_status() on batch, so they can go out along with
+    other things. Returns a function that takes the batch's results and returns
+    what deck_status() would.
+    '''
+    # Read the whole deck in one go. Aces live at the end of each suit's array
+    # but are rank 1, so rotate them to the front.
+    suits = ['clubs', 'diamonds', 'hearts', 'spades']
+    first = len(batch)
+    for suit in suits:
+      for card in self.cards[suit]:
+        batch.peek32(card.addr)
+    def finish(results):
+      status = results[first:first+52]
+      return {
+        suit: status[i*13+12:i*13+13] + status[i*13:i*13+12]
+        for i,suit in enumerate(suits)
+      }
+    return finish
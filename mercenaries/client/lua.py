@@ -30,14 +30,26 @@ GCObject is a supertype of the various garbage-collectible lua types: strings,
 tables, functions, fulluserdata, and threads. The API is currently being redesigned
 for better performance and consistency with TObject.
 '''
+from collections import OrderedDict
 from contextlib import contextmanager
-from typing import Any
+import struct
+import time
+from typing import Any, NamedTuple
 
 from .lopcode import LuaOpcode
 from .pine import Pine
-from .util import MemVarInt, MemVarOpcode
-
-_CACHE = {}
+from .util import LazyMemVarArray, MemVarInt, MemVarOpcode
+
+# Offset of GCthreshold in global_State. Lua resets it at the end of every
+# collection, so if it's changed, the GC has run and may have freed (and reused)
+# memory we have objects for. Counted back from _registry at 0x38, since that
+# one we know.
+GC_THRESHOLD_OFFSET = 0x2C
+# Global name indexes, keyed by lua_State address; see global_index().
+_GLOBAL_INDEXES = {}
+# How many lua_States to keep indexes for. The game only has one at a time, but
+# tends to reuse the same few addresses for it across loading screens.
+_GLOBAL_INDEX_LIMIT = 4
 
 LUA_TNIL = 0
 LUA_TBOOL = 1
@@ -48,6 +60,9 @@ LUA_TTABLE = 5
 LUA_TFUNCTION = 6
 LUA_TUSERDATA = 7
 LUA_TTHREAD = 8
+# Internal types that never appear in TObjects, but which are on the GC lists.
+LUA_TPROTO = 9
+LUA_TUPVAL = 10
 LUA_EMPTY = 0xFFFFFFFF # Used for TObjects that have been deleted by the garbage collector
 
 def tt_to_name(tt):
@@ -61,12 +76,160 @@ def tt_to_name(tt):
     case 6: return 'function'
     case 7: return 'userdata'
     case 8: return 'thread'
+    case 9: return 'proto'
+    case 10: return 'upval'
     case 0xFFFFFFFF: return '<<deleted>>'
     case _: return f'unknown:{tt}'
 
 class LuaTypeError(RuntimeError):
   pass
 
+class LuaPatchError(RuntimeError):
+  pass
+
+
+class GCObjectCache:
+  '''
+  Cache of GCObjects we've already constructed, so that looking at the same
+  object twice doesn't read its header twice.
+
+  Entries are keyed by (generation, address). invalidate() starts a new
+  generation, which makes everything from the previous one unreachable; it then
+  ages out of the cache along with anything else not used recently, since the
+  cache only keeps the most recently used size objects.
+
+  MercenariesIPC invalidates it whenever the lua_State moves, and check_gc() (or
+  observe_gc()) does so whenever the Lua GC has run since it was last called.
+  '''
+  generation: int
+  size: int
+  entries: OrderedDict
+
+  def __init__(self, size: int = 16384):
+    self.generation = 0
+    self.size = size
+    self.entries = OrderedDict()
+    # (L_ptr, GCthreshold) as of the last check_gc()
+    self.gc_state = None
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, addr: int):
+    key = (self.generation, addr)
+    obj = self.entries.get(key)
+    if obj is not None:
+      self.entries.move_to_end(key)
+    return obj
+
+  def put(self, addr: int, obj):
+    self.entries[(self.generation, addr)] = obj
+    self.entries.move_to_end((self.generation, addr))
+    while len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+
+  def invalidate(self):
+    self.generation += 1
+
+  def check_gc(self, pine, L_ptr: int):
+    '''
+    Invalidate the cache if the GC has run, or we're looking at a different
+    lua_State, since the last time this was called. Costs two reads.
+    '''
+    l_G = pine.peek32(L_ptr + 0x10)
+    self.observe_gc(L_ptr, pine.peek32(l_G + GC_THRESHOLD_OFFSET))
+
+  def observe_gc(self, L_ptr: int, threshold: int):
+    '''
+    Like check_gc(), for callers that have already read GCthreshold themselves.
+    '''
+    if (L_ptr, threshold) != self.gc_state:
+      self.invalidate()
+      self.gc_state = (L_ptr, threshold)
+
+_CACHE = GCObjectCache()
+
+def clear_cache():
+  '''
+  Forget every GCObject constructed so far. Handles already given out are still
+  usable, but GCObject() won't return them again.
+  '''
+  _CACHE.invalidate()
+
+def check_gc(pine, L_ptr: int):
+  _CACHE.check_gc(pine, L_ptr)
+
+def observe_gc(L_ptr: int, threshold: int):
+  _CACHE.observe_gc(L_ptr, threshold)
+
+# Layouts for bulk-decoding TObjects (tt, value), table Nodes (key tt, key
+# value, value tt, value value, next), and instructions.
+_TOBJECT = struct.Struct('< I I')
+_NODE = struct.Struct('< I I I I I')
+# TString header: next, tt, (marked, padding), hash, len.
+_TSTRING = struct.Struct('< I B 3x I I')
+_INSTRUCTION = struct.Struct('< I')
+
+def tobject_value(pine, tt: int, raw: int):
+  '''
+  Decode the contents of a TObject's value slot, given its tag and the raw
+  32-bit contents of the slot. Same as TObject.val(), for when we've already
+  read the TObject ourselves.
+  '''
+  match tt:
+    case 0: return None
+    case 1: return raw > 0
+    case 2: return raw
+    case 3: return struct.unpack('< f', raw.to_bytes(4, 'little'))[0]
+    case 4|5|6|7|8: return GCObject(pine, raw)
+  raise LuaTypeError(f'Unknown tt={tt} decoding TObject value {raw:08X}')
+
+def tobject_raw(tt: int, val: Any):
+  '''
+  The inverse of tobject_value(): works out what to put in the value slot of a
+  TObject of type tt to make it hold val. val can be a primitive, a GCObject, or
+  another TObject of a GC type. Throws if val isn't of type tt.
+  '''
+  match tt:
+    case 0:
+      assert val is None
+      return 0
+    case 1:
+      assert type(val) is bool
+      return 1 if val else 0
+    case 2:
+      assert type(val) is int
+      return val
+    case 3:
+      assert type(val) is int or type(val) is float
+      return struct.unpack('< I', struct.pack('< f', val))[0]
+    case 4|5|6|7|8:
+      if type(val) is Lua_TObject:
+        val = val.val()
+      assert isinstance(val, Lua_GCObject)
+      assert val.tt == tt, f"Can't set TObject of type {tt_to_name(tt)} to value of type {tt_to_name(val.tt)}"
+      return val.addr
+  raise LuaTypeError(f'Invalid type {tt} in TObject.set({val})')
+
+def tobject_str(pine, tt: int, raw: int):
+  '''
+  Format a TObject we've already read the same way TObject.__str__ would.
+  '''
+  if tt < 4:
+    return f'TObject({str(tobject_value(pine, tt, raw))})'
+  return str(tobject_value(pine, tt, raw))
+
+def str_hash(data: bytes):
+  '''
+  Computes the hash Lua 5.0 uses for strings (luaS_hash in lstring.c). Long
+  strings only have some of their bytes hashed.
+  '''
+  h = len(data)
+  step = (len(data) >> 5) + 1
+  for i in range(len(data), step-1, -step):
+    h = (h ^ ((h << 5) + (h >> 2) + data[i-1])) & 0xFFFFFFFF
+  return h
+
 # TODO: rewrite all of this to use MemVars, have a more consistent API across
 # types, allow mutating between types in place, etc
 class Lua_TObject:
@@ -75,7 +238,6 @@ class Lua_TObject:
   _tt: MemVarInt
 
   def __init__(self, pine, addr):
-    _CACHE[addr] = self
     self.pine = pine
     self.addr = addr
     self._tt = MemVarInt(self.pine, self.addr)
@@ -141,33 +303,13 @@ class Lua_TObject:
     Throws if the val does not match the current type. To change the type as
     well, include the tt= argument.
     '''
-    vaddr = self.addr+4
     if tt is None:
       tt = self.tt()
+      raw = tobject_raw(tt, val)
     else:
+      raw = tobject_raw(tt, val)
       self._tt(tt)
-
-    match tt:
-      case 0:
-        assert val is None
-        self.pine.poke32(vaddr, 0)
-      case 1:
-        assert type(val) is bool
-        self.pine.poke32(vaddr, 1 if val else 0)
-      case 2:
-        assert type(val) is int
-        self.pine.poke32(vaddr, val)
-      case 3:
-        assert type(val) is int or type(val) is float
-        self.pine.pokef32(vaddr, val)
-      case 4|5|6|7|8:
-        if type(val) is Lua_TObject:
-          return self.set(val.val())
-        assert isinstance(val, Lua_GCObject)
-        assert val.tt == tt, f"Can't set {repr(self)} to value of type {tt_to_name(val.tt)}"
-        self.pine.poke32(vaddr, val.addr)
-      case _:
-        raise LuaTypeError(f'Invalid type {tt} in TObject.set({val})')
+    self.pine.poke32(self.addr+4, raw)
 
   def copy(self, other):
     '''
@@ -200,11 +342,13 @@ class Lua_CorruptGCObject:
 
 class Lua_GCObject:
   def __init__(self, pine, addr):
-    _CACHE[addr] = self
+    _CACHE.put(addr, self)
     self.pine = pine
     self.addr = addr
-    self.next = pine.peek32(addr)
-    self.tt = pine.peek8(addr+4)
+    batch = pine.batch()
+    batch.peek32(addr)
+    batch.peek8(addr+4)
+    (self.next, self.tt) = batch.run()
 
   def valid(self, expected):
     if expected is not None:
@@ -216,14 +360,43 @@ class Lua_GCObject:
     raise NotImplementedError
 
 class Lua_GCString(Lua_GCObject):
-  def __init__(self, pine, addr):
-    super().__init__(pine, addr)
-    self.hash = pine.peek32(addr+8)
+  '''
+  A Lua string. Only the header is read up front; the contents are read the
+  first time something asks for data, which for most strings is never, since
+  comparing them against a key can usually be settled by hash and length alone.
+
+  If the caller has already read the header, or the contents, it can pass them
+  in, and they won't be read again.
+  '''
+  def __init__(self, pine, addr, header=None, data=None):
+    _CACHE.put(addr, self)
+    self.pine = pine
+    self.addr = addr
+    if header is None:
+      header = _TSTRING.unpack(pine.readmem(addr, _TSTRING.size))
     # The string always has a null terminator in memory, which the size field
     # does not account for.
-    self.size = pine.peek32(addr+12)
+    (self.next, self.tt, self.hash, self.size) = header
     self.max_size = self.size
-    self.data = pine.readmem(addr+16, self.size)
+    self._data = data
+
+  @property
+  def data(self):
+    if self._data is None:
+      self._data = self.pine.readmem(self.addr+16, self.size)
+    return self._data
+
+  def matches(self, data: bytes, h: int = None):
+    '''
+    Check if this string's contents are data. h is the hash of data, if the
+    caller already has it. The contents are only read if the hash and length
+    both match.
+    '''
+    if self.size != len(data):
+      return False
+    if self.hash != (str_hash(data) if h is None else h):
+      return False
+    return self.data == data
 
   def __str__(self):
     return '%s [h=%08X,$%08X]' % (repr(self.data.decode(errors='replace')), self.hash, self.addr)
@@ -238,6 +411,7 @@ class Lua_GCString(Lua_GCObject):
       buf = buf[0:max_size-1]
       print('+', buf)
     self.size = len(buf)
+    self._data = buf
     if self.max_size < max_size:
       self.max_size = max_size
     self.pine.poke32(self.addr+12, self.size)
@@ -246,30 +420,61 @@ class Lua_GCString(Lua_GCObject):
   def dump(*args):
     return
 
+def fetch_strings(pine, strings):
+  '''
+  Read the contents of all the given Lua_GCStrings that haven't been read yet,
+  in one batch. Anything else in strings is ignored, so it's fine to pass in a
+  mix of values from a table.
+  '''
+  strings = [
+    string for string in strings
+    if isinstance(string, Lua_GCString) and string._data is None
+  ]
+  batch = pine.batch()
+  bodies = [batch.readmem(string.addr+16, string.size) for string in strings]
+  batch.run()
+  for string,body in zip(strings, bodies):
+    string._data = body
+  return strings
+
 class Lua_GCTable(Lua_GCObject):
   class Node:
-    def __init__(self, pine, addr):
+    def __init__(self, pine, addr, next=None):
       self.pine = pine
       self.addr = addr
-      self.next = pine.peek32(addr+16)
+      self._next = next
       self.k = TObject(self.pine, self.addr)
       self.v = TObject(self.pine, self.addr+8)
 
+    @property
+    def next(self):
+      '''
+      Address of the next node in this node's collision chain, or 0. Only read
+      from memory when asked for.
+      '''
+      if self._next is None:
+        self._next = self.pine.peek32(self.addr+16)
+      return self._next
+
     def valid(self):
       return self.v.valid() and self.k.valid()
 
-    def keyEq(self, k):
+    def keyEq(self, k, h=None):
       '''
-      Test if the key of this Node equals the given k.
-      At the moment we only support string keys.
+      Test if the key of this Node equals the given k. h is the hash of k, if
+      the caller already has it.
+      At the moment we only support string keys. If k is a Lua_GCString, this is
+      just a pointer comparison, since Lua interns all strings.
       '''
       if not self.k.valid():
         return False
       if self.k.tt() != LUA_TSTRING:
         return False
 
+      if isinstance(k, Lua_GCString):
+        return self.pine.peek32(self.k.addr+4) == k.addr
       assert type(k) is bytes
-      return k == self.k.val().data
+      return self.k.val().matches(k, h)
 
     def dump(self, seen, indent=''):
       if not self.k.valid() or self.k.tt() == LUA_TNIL:
@@ -281,38 +486,72 @@ class Lua_GCTable(Lua_GCObject):
   def __init__(self, pine, addr):
     super().__init__(pine, addr)
 
-    mt_ptr = pine.peek32(addr + 0x08)
-    if mt_ptr > 0:
-      self.metatable = GCObject(pine, mt_ptr)
-    else:
-      self.metadata = None
-
-    self.array_size = pine.peek32(addr + 0x1C)
-    self.array_ptr = pine.peek32(addr + 0x0C)
-    self.hash_size = 2 ** pine.peek8(addr + 0x07)
-    self.hash_ptr = pine.peek32(addr + 0x10)
-    self.array = [
-      TObject(self.pine, self.array_ptr + i*8)
-      for i in range(self.array_size)
-    ]
-
-    self.hash = [
-      self.Node(self.pine, self.hash_ptr + i*20)
-      for i in range(self.hash_size)
-    ]
+    batch = pine.batch()
+    batch.peek32(addr + 0x08)
+    batch.peek32(addr + 0x1C)
+    batch.peek32(addr + 0x0C)
+    batch.peek8(addr + 0x07)
+    batch.peek32(addr + 0x10)
+    (self.mt_ptr, self.array_size, self.array_ptr, lsizenode, self.hash_ptr) = batch.run()
+    self.hash_size = 2 ** lsizenode
+
+    # Nodes and array slots are only created (and read) as they're used, so
+    # getting a handle on a table costs the same no matter how big it is.
+    self.array = LazyMemVarArray(pine, TObject, self.array_ptr, 8, self.array_size)
+    self.hash = LazyMemVarArray(pine, self.Node, self.hash_ptr, 20, self.hash_size)
+
+  @property
+  def metatable(self):
+    if self.mt_ptr == 0:
+      return None
+    return GCObject(self.pine, self.mt_ptr)
 
   def __str__(self):
     return 'table$%08X[a=%d,h=%d]' % (self.addr, self.array_size, self.hash_size)
 
+  def snapshot(self):
+    '''
+    Read the entire array part and node array in one go and return them as a
+    Lua_TableSnapshot. Much cheaper than going through array and hash when you
+    need to look at most of the table.
+    '''
+    batch = self.pine.batch()
+    array = batch.readmem(self.array_ptr, self.array_size*8)
+    nodes = batch.readmem(self.hash_ptr, self.hash_size*20)
+    batch.run()
+    return Lua_TableSnapshot(self, array, nodes)
+
+  def items(self):
+    '''
+    Yields (key, value) for every entry in the table; see Lua_TableSnapshot.
+    '''
+    return self.snapshot().items()
+
   def getnode(self, key) -> Node:
     '''
-    Returns the Node representing a given hash table entry.
+    Returns the Node representing a given hash table entry. key can be a str,
+    bytes, or a Lua_GCString.
+
+    This does what Lua itself does: hash the key to find its main position in
+    the node array, and then follow the collision chain from there, so it only
+    has to look at a few nodes rather than the whole table.
     '''
     if type(key) == str:
       key = key.encode()
-    for node in self.hash:
-      if node.keyEq(key) and node.v.valid():
+    if isinstance(key, Lua_GCString):
+      h = key.hash
+    else:
+      h = str_hash(key)
+
+    node = self.hash[h & (self.hash_size - 1)]
+    # Chains can't be longer than the table, unless memory is being rewritten
+    # out from under us.
+    for _ in range(self.hash_size):
+      if node.keyEq(key, h) and node.v.valid():
         return node
+      if node.next == 0:
+        break
+      node = self.hash[(node.next - self.hash_ptr) // 20]
     raise KeyError(f'No key {key} in {self}')
 
   def getfield(self, key) -> Lua_TObject:
@@ -334,50 +573,136 @@ class Lua_GCTable(Lua_GCObject):
       return
     seen[self.addr] = self
 
-    for i,v in enumerate(self.array):
-      if not v.valid() or v.tt() == LUA_TNIL:
+    snapshot = self.snapshot()
+    # Get all the strings we're about to print in one go.
+    fetch_strings(self.pine, (x for kv in snapshot.items() for x in kv))
+    for i,(tt,raw) in enumerate(zip(snapshot.array_tt, snapshot.array_value)):
+      if tt == LUA_TNIL or tt > 8:
         continue
-      print(f'{indent}[{i}:${self.array_ptr+i*8:08X}] {v}')
-      v.dump(seen, indent + '  ')
+      print(f'{indent}[{i}:${self.array_ptr+i*8:08X}] {tobject_str(self.pine, tt, raw)}')
+      self.array[i].dump(seen, indent + '  ')
 
-    for node in self.hash:
-      if not node.valid() or node.k.tt() == LUA_TNIL:
-        continue
-      node.dump(seen, indent)
+    for i in snapshot.live_nodes():
+      self.hash[i].dump(seen, indent)
 
     if self.hasMetatable(seen):
       print(f'{indent}META: {self.metatable}')
       self.metatable.dump(seen, indent + '  ')
 
 
+class Lua_TableSnapshot:
+  '''
+  The contents of a table as of a single bulk read, decoded into columns: tag
+  and value for each array slot, and key tag, key value, value tag, value value,
+  and next pointer for each node. Values are raw 32-bit slot contents; use
+  tobject_value() to decode them, or items() to have it done for you.
+  '''
+  def __init__(self, table: Lua_GCTable, array: bytes, nodes: bytes):
+    self.table = table
+    self.pine = table.pine
+    (self.array_tt, self.array_value) = self.columns(_TOBJECT, array)
+    (self.key_tt, self.key_value, self.value_tt, self.value_value, self.next) = self.columns(_NODE, nodes)
+
+  @staticmethod
+  def columns(layout: struct.Struct, data: bytes):
+    rows = list(layout.iter_unpack(data))
+    if not rows:
+      return ((),) * len(layout.unpack(bytes(layout.size)))
+    return tuple(zip(*rows))
+
+  def live_nodes(self):
+    '''
+    Yields the index of every node with a valid, non-nil key and value.
+    '''
+    for i,(ktt,vtt) in enumerate(zip(self.key_tt, self.value_tt)):
+      if LUA_TNIL < ktt <= 8 and LUA_TNIL < vtt <= 8:
+        yield i
+
+  def items(self):
+    '''
+    Yields (key, value) for every non-nil entry, array part first, decoded the
+    same way as TObject.val(). Keys in the array part are zero-based indexes,
+    to match getfield(). This is a generator, so GCObjects for the keys and
+    values are only created as the caller gets to them.
+    '''
+    for i,(tt,raw) in enumerate(zip(self.array_tt, self.array_value)):
+      if LUA_TNIL < tt <= 8:
+        yield (i, tobject_value(self.pine, tt, raw))
+    for i in self.live_nodes():
+      yield (
+        tobject_value(self.pine, self.key_tt[i], self.key_value[i]),
+        tobject_value(self.pine, self.value_tt[i], self.value_value[i]))
+
+
+class PatchReport(NamedTuple):
+  # 32-bit words changed, and the number of contiguous runs they were written in.
+  words: int
+  runs: int
+  # Seconds from sending the lock to the reply to the message that unlocked it.
+  lock_time: float
+
+  def __str__(self):
+    if not self.words:
+      return 'no changes'
+    return f'{self.words} words in {self.runs} runs, locked for {self.lock_time*1000:.2f}ms'
+
+def diff_words(old: bytes, new: bytes):
+  '''
+  Compare two equal-length buffers a 32-bit word at a time, and return the
+  changes as a list of (offset, data) for each contiguous run of changed words.
+  '''
+  runs = []
+  for offset in range(0, len(new), 4):
+    if old[offset:offset+4] == new[offset:offset+4]:
+      continue
+    if runs and runs[-1][0] + len(runs[-1][1]) == offset:
+      runs[-1][1].extend(new[offset:offset+4])
+    else:
+      runs.append((offset, bytearray(new[offset:offset+4])))
+  return runs
+
 class Lua_GCFunction(Lua_GCObject):
   class Proto:
     def __init__(self, pine, addr):
       self.addr = addr
-      self.k = pine.peek32(addr + 8)
-      self.sizek = pine.peek32(addr + 40)
-      self.klist = [
-        TObject(pine, self.k + i*8)
-        for i in range(self.sizek)
-      ]
-      self.sizecode = pine.peek32(addr + 44)
-      self.codeptr = pine.peek32(addr + 12)
-      self.code = [
-        MemVarOpcode(pine, self.codeptr + i*4)
-        for i in range(self.sizecode)
-      ]
+      batch = pine.batch()
+      batch.peek32(addr + 8)
+      batch.peek32(addr + 40)
+      batch.peek32(addr + 44)
+      batch.peek32(addr + 12)
+      (self.k, self.sizek, self.sizecode, self.codeptr) = batch.run()
+      self.pine = pine
+      self.klist = LazyMemVarArray(pine, TObject, self.k, 8, self.sizek)
+      self.code = LazyMemVarArray(pine, MemVarOpcode, self.codeptr, 4, self.sizecode)
+
+    def snapshot(self):
+      '''
+      Read the constant table and the bytecode in one go. Returns a list of
+      (tt, raw value) pairs for the constants and a list of LuaOpcodes.
+      '''
+      batch = self.pine.batch()
+      k = batch.readmem(self.k, self.sizek*8)
+      code = batch.readmem(self.codeptr, self.sizecode*4)
+      batch.run()
+      return (
+        list(_TOBJECT.iter_unpack(k)),
+        [LuaOpcode(op) for (op,) in _INSTRUCTION.iter_unpack(code)])
 
   def __init__(self, pine, addr):
     super().__init__(pine, addr)
     self.name = None
-    self.isC = pine.peek8(addr + 6) != 0
-    self.nups = pine.peek8(addr + 7)
+    batch = pine.batch()
+    batch.peek8(addr + 6)
+    batch.peek8(addr + 7)
+    batch.peek32(addr + 12)
+    (isC, self.nups, ptr) = batch.run()
+    self.isC = isC != 0
     if self.isC:
-      self.cfunction = pine.peek32(addr + 12)
+      self.cfunction = ptr
       self.fenv = None
     else:
       self.edits = None
-      self.proto = self.Proto(pine, pine.peek32(addr + 12))
+      self.proto = self.Proto(pine, ptr)
       self.fenv = TObject(pine, addr + 16)
 
   def __str__(self):
@@ -401,29 +726,82 @@ class Lua_GCFunction(Lua_GCObject):
     the pending modifications are applied, and then the first instruction is
     restored, to ensure that the function is never executed in a half-modified
     state.
+
+    The edits are applied to a copy of the constant table and bytecode read in
+    one go beforehand, and only the words that actually changed are written, as
+    contiguous runs, all in a single message. Afterwards everything is read back
+    in one go to check that it took; if it didn't, this raises LuaPatchError.
+    A PatchReport is left in last_patch.
     '''
     self.edits = []
     try:
       yield self
+      edits = self.edits
     finally:
-      # lock function by making first instruction jump-to-self
-      self.op0 = self.proto.code[0]()
-      self.proto.code[0](LuaOpcode('JMP', sBx=-1))
-      # apply edits; code editor will update self.op0 if needed
-      for edit in self.edits:
-        edit()
       self.edits = None
+    self.last_patch = self.apply_edits(edits)
+    print(f'Patched {self}: {self.last_patch}')
+
+  def apply_edits(self, edits):
+    proto = self.proto
+    (k, code) = self.read_proto()
+    (new_k, new_code) = (bytearray(k), bytearray(code))
+    for edit in edits:
+      edit(new_k, new_code)
+
+    k_runs = diff_words(k, new_k)
+    code_runs = diff_words(code, new_code)
+    words = sum(len(data) for _,data in k_runs + code_runs) // 4
+    if not words:
+      return PatchReport(0, 0, 0.0)
+
+    # Instruction 0 is the lock, so it's written last, whether or not it changed.
+    code_runs = [
+      (offset, data) if offset > 0 else (4, data[4:])
+      for offset,data in code_runs
+      if offset > 0 or len(data) > 4
+    ]
+    op0 = new_code[:4]
+    t = time.perf_counter()
+    # Everything below goes out as a single message; the fences keep the
+    # jump-to-self, the edits, and the restore of the first instruction in
+    # that order.
+    with self.pine.combine() as writes:
+      # lock function by making first instruction jump-to-self
+      self.pine.poke32(proto.codeptr, LuaOpcode('JMP', sBx=-1).op)
+      writes.fence()
+      for offset,data in k_runs:
+        self.pine.writemem(proto.k + offset, bytes(data))
+      for offset,data in code_runs:
+        self.pine.writemem(proto.codeptr + offset, bytes(data))
+      writes.fence()
       # unlock first instruction
-      self.proto.code[0](self.op0)
-      self.op0 = None
+      self.pine.writemem(proto.codeptr, bytes(op0))
+    lock_time = time.perf_counter() - t
+
+    if self.read_proto() != (new_k, new_code):
+      raise LuaPatchError(f'Patching {self} did not take; memory does not match after writing')
+    return PatchReport(words, len(k_runs) + len(code_runs), lock_time)
+
+  def read_proto(self):
+    '''
+    Read the raw contents of the constant table and bytecode, in one batch and
+    bypassing the cache.
+    '''
+    batch = self.pine.batch()
+    k = batch.readmem(self.proto.k, self.proto.sizek*8)
+    code = batch.readmem(self.proto.codeptr, self.proto.sizecode*4)
+    batch.run()
+    return (bytes(k), bytes(code))
 
   def setk(self, k, val, tt=None):
     '''
     Set the given constant table entry. Equivalent to calling set() on the underlying TObject.
     Use only inside a 'with fn.lock()' block.
     '''
-    def apply():
-      self.proto.klist[k].set(val, tt=tt)
+    def apply(constants, code):
+      new_tt = _TOBJECT.unpack_from(constants, k*8)[0] if tt is None else tt
+      _TOBJECT.pack_into(constants, k*8, new_tt, tobject_raw(new_tt, val))
     self.edits.append(apply)
 
   def patch(self, i, code):
@@ -432,15 +810,10 @@ class Lua_GCFunction(Lua_GCObject):
     Use only inside a 'with fn.lock()' block.
     '''
     assert i+len(code) < self.proto.sizecode
-    def apply():
-      nonlocal i
-      for opcode in code:
-        # print(f'[patch {self.name}] @ {self.proto.codeptr:08X}[{i}]: {opcode.pprint(self.proto, i)}')
-        if i == 0:
-          self.op0 = opcode
-        else:
-          self.proto.code[i](opcode)
-        i += 1
+    def apply(constants, bytecode):
+      for n,opcode in enumerate(code):
+        # print(f'[patch {self.name}] @ {self.proto.codeptr:08X}[{i+n}]: {opcode.pprint(self.proto, i+n)}')
+        _INSTRUCTION.pack_into(bytecode, (i+n)*4, opcode.op)
     self.edits.append(apply)
 
   def dump(self, seen, indent=''):
@@ -454,12 +827,12 @@ class Lua_GCFunction(Lua_GCObject):
     if self.fenv.val().addr != seen.get('_G', None):
       print(f'{indent}FENV: {self.fenv}')
       self.fenv.dump(seen, indent + '  ')
-    for i in range(self.proto.sizek):
-      print(f'{indent}CONST${self.proto.k + i*8:08X} {f'k{i}':3} {self.proto.klist[i]}')
+    (constants, code) = self.proto.snapshot()
+    for i,(tt,raw) in enumerate(constants):
+      print(f'{indent}CONST${self.proto.k + i*8:08X} {f'k{i}':3} {tobject_str(self.pine, tt, raw)}')
 
     print(f'{indent} CODE${self.proto.codeptr:08X}')
-    for i,op in enumerate(self.proto.code):
-      op = op()
+    for i,op in enumerate(code):
       print(f'{indent}  {i:03d} {op.op:08X} {op.pprint(self.proto, i)}')
 
     # they all seem to be nil
@@ -474,10 +847,18 @@ class Lua_GCFunction(Lua_GCObject):
 class Lua_GCUserdata(Lua_GCObject):
   def __init__(self, pine, addr):
     super().__init__(pine, addr)
-    self.metatable = Lua_GCTable(pine, pine.peek32(addr+8))
-    self.size = pine.peek32(addr+12)
+    batch = pine.batch()
+    batch.peek32(addr+8)
+    batch.peek32(addr+12)
+    (self.mt_ptr, self.size) = batch.run()
     # self.data = pine.readmem(addr+16, self.size)
 
+  @property
+  def metatable(self):
+    if self.mt_ptr == 0:
+      return None
+    return GCObject(self.pine, self.mt_ptr)
+
   def __str__(self):
     return 'userdata$%08X[size=%d,mt=%s]' % (self.addr, self.size, self.metatable)
 
@@ -518,22 +899,41 @@ class Lua_GCThread(Lua_GCObject):
     print(f'- default metatable: {self._METATABLE}')
 
   def lazyLoad(self):
-    for node in self._G.val().hash:
-      if node.k is not None and node.k.tt() == LUA_TSTRING and node.v is not None and node.v.tt() == LUA_TFUNCTION:
-        node.v.val().name = node.k
+    for k,v in self._G.val().items():
+      if type(k) is Lua_GCString and type(v) is Lua_GCFunction:
+        v.name = k
 
   def __str__(self):
     return 'thread$%08X' % self.addr
 
+  @property
+  def strings(self):
+    return Lua_StringTable(self.pine, self.l_G)
+
+  def intern(self, key):
+    '''
+    Turn a str or bytes key into the interned Lua_GCString for it, so that table
+    lookups can compare pointers instead of string contents. Raises KeyError if
+    there's no such string, in which case it can't be a key in any table either.
+    '''
+    if isinstance(key, (int, Lua_GCString)):
+      return key
+    string = self.strings.find(key)
+    if string is None:
+      raise KeyError(f'No string {key} in {self}')
+    return string
+
   def getglobalnode(self, key):
-    return self._G.val().getnode(key)
+    with self.pine.tagged('lua'):
+      return self._G.val().getnode(self.intern(key))
 
   def getglobal(self, key) -> Lua_TObject:
     '''
     Returns the TObject for a given global (or None). Eqv to just calling getfield
     on _G.
     '''
-    return self._G.val().getfield(key)
+    with self.pine.tagged('lua'):
+      return self._G.val().getfield(self.intern(key))
 
   def initialSeen(self):
     return {
@@ -558,6 +958,271 @@ class Lua_GCThread(Lua_GCObject):
     self._G.dump(seen, indent + '  ')
 
 
+class Lua_StringTable:
+  '''
+  The string table in global_State, where Lua interns every string it creates.
+  Any given string exists at most once, so finding it here tells us the address
+  it will have as a table key or constant anywhere in the VM.
+
+  The table is an array of buckets, each a chain of TStrings linked through
+  their GC header, and a string's bucket is its hash mod the number of buckets.
+  '''
+  pine: Pine
+  hash_ptr: int
+  nuse: int
+  size: int
+
+  def __init__(self, pine, l_G):
+    self.pine = pine
+    batch = pine.batch()
+    batch.peek32(l_G)
+    batch.peek32(l_G + 4)
+    batch.peek32(l_G + 8)
+    (self.hash_ptr, self.nuse, self.size) = batch.run()
+
+  def __len__(self):
+    return self.nuse
+
+  def __str__(self):
+    return f'strt${self.hash_ptr:08X}[n={self.nuse},size={self.size}]'
+
+  def bucket(self, h: int):
+    return self.hash_ptr + (h & (self.size - 1)) * 4
+
+  def find(self, key):
+    '''
+    Returns the interned Lua_GCString with the given contents, or None if there
+    isn't one.
+    '''
+    return self.find_all([key])[0]
+
+  def find_all(self, keys):
+    '''
+    Like find(), but for many strings at once. Walks all of their bucket chains
+    in parallel, so it costs one round trip per link of the longest chain, plus
+    one more to compare the contents of any strings with matching hash and length.
+    '''
+    keys = [key.encode() if type(key) is str else key for key in keys]
+    hashes = [str_hash(key) for key in keys]
+    batch = self.pine.batch()
+    for h in hashes:
+      batch.peek32(self.bucket(h))
+    ptrs = batch.run()
+
+    # Indexes into keys, and addresses of strings whose hash and length match.
+    candidates = []
+    # Lua keeps nuse <= size, so chains are short unless something is very wrong.
+    for _ in range(self.nuse + 1):
+      pending = [(i,ptr) for i,ptr in enumerate(ptrs) if ptr]
+      if not pending:
+        break
+      batch = self.pine.batch()
+      headers = [batch.readmem(ptr, _TSTRING.size) for _,ptr in pending]
+      batch.run()
+      for (i,ptr),header in zip(pending, headers):
+        header = _TSTRING.unpack(header)
+        (next, _, h, size) = header
+        if h == hashes[i] and size == len(keys[i]):
+          candidates.append((i, ptr, header))
+        ptrs[i] = next
+
+    batch = self.pine.batch()
+    bodies = [batch.readmem(ptr + 16, len(keys[i])) for i,ptr,_ in candidates]
+    batch.run()
+    found = [None] * len(keys)
+    for (i,ptr,header),body in zip(candidates, bodies):
+      if found[i] is None and body == keys[i]:
+        # We already have everything we'd read constructing it.
+        found[i] = _CACHE.get(ptr) or Lua_GCString(self.pine, ptr, header, keys[i])
+    return found
+
+  def snapshot(self):
+    '''
+    Read the whole string table -- bucket array and every chain -- and return it
+    as a Lua_StringTableSnapshot. Costs one round trip per link of the longest
+    chain. String contents aren't read until asked for.
+    '''
+    buckets = self.pine.readmem(self.hash_ptr, self.size * 4)
+    ptrs = list(struct.unpack(f'< {self.size}I', buckets))
+    # (address, hash, len) of every string.
+    strings = []
+    for _ in range(self.nuse + 1):
+      pending = [ptr for ptr in ptrs if ptr]
+      if not pending:
+        break
+      batch = self.pine.batch()
+      headers = [batch.readmem(ptr, _TSTRING.size) for ptr in pending]
+      batch.run()
+      ptrs = []
+      for ptr,header in zip(pending, headers):
+        (next, _, h, size) = _TSTRING.unpack(header)
+        strings.append((ptr, h, size))
+        ptrs.append(next)
+    return Lua_StringTableSnapshot(self, strings)
+
+
+class Lua_StringTableSnapshot:
+  '''
+  Every string in the string table as of a single read: address, hash, and
+  length. index() additionally reads all their contents (in bulk) and returns a
+  reverse index from contents to address.
+  '''
+  def __init__(self, strt: Lua_StringTable, strings):
+    self.strt = strt
+    self.pine = strt.pine
+    self.strings = strings
+    self._index = None
+
+  def __len__(self):
+    return len(self.strings)
+
+  def __iter__(self):
+    return iter(self.strings)
+
+  def index(self):
+    '''
+    Returns a dict of string contents to address for every string in the table.
+    '''
+    if self._index is None:
+      batch = self.pine.batch()
+      bodies = [batch.readmem(addr + 16, size) for addr,_,size in self.strings]
+      batch.run()
+      self._index = {
+        bytes(body): addr for (addr,_,_),body in zip(self.strings, bodies)
+      }
+    return self._index
+
+  def find(self, key):
+    '''
+    Returns the address of the string with the given contents, or None.
+    '''
+    if type(key) is str:
+      key = key.encode()
+    return self.index().get(key)
+
+
+class Lua_GlobalIndex:
+  '''
+  Index of where a set of globals live in a lua_State's _G, built by looking
+  them all up at once.
+
+  Building it costs two round trips no matter how many names there are: one to
+  read the whole node array of _G, and one to read the key strings on the
+  collision chains of every name we're looking for. Once built, validate()
+  checks that it still holds in one more round trip, by checking that _G hasn't
+  moved or been resized and that each node still has the same key string in it.
+  '''
+  pine: Pine
+  L_ptr: int
+  table: Lua_GCTable
+  # Name to index in table.hash, and to the address of the key's TString.
+  nodes: dict
+  keys: dict
+
+  def __init__(self, pine, L_ptr):
+    self.pine = pine
+    self.L_ptr = L_ptr
+    batch = pine.batch()
+    batch.peek32(L_ptr + 0x40)
+    batch.peek32(L_ptr + 0x44)
+    (tt, G_ptr) = batch.run()
+    if tt != LUA_TTABLE:
+      raise LuaTypeError(f'_G of lua_State${L_ptr:08X} is a {tt_to_name(tt)}, not a table')
+    # Constructed directly rather than through GCObject(), in case the one in
+    # _CACHE is from before _G was last resized.
+    self.table = Lua_GCTable(pine, G_ptr)
+    self.nodes = {}
+    self.keys = {}
+
+  def __contains__(self, name):
+    return name in self.nodes
+
+  def resolve(self, names):
+    '''
+    Find all of the given names in _G and add them to the index. Raises KeyError
+    if any of them are missing.
+    '''
+    table = self.table
+    snapshot = table.snapshot()
+    # For each name, the nodes on its collision chain with string keys.
+    candidates = []
+    for name in names:
+      data = name.encode()
+      h = str_hash(data)
+      i = h & (table.hash_size - 1)
+      for _ in range(table.hash_size):
+        if snapshot.key_tt[i] == LUA_TSTRING and snapshot.value_tt[i] <= LUA_TTHREAD:
+          candidates.append((name, data, h, i))
+        if snapshot.next[i] == 0:
+          break
+        i = (snapshot.next[i] - table.hash_ptr) // 20
+
+    # Read the hash, length, and (if the length matches) contents of every
+    # candidate key.
+    batch = self.pine.batch()
+    bufs = [
+      batch.readmem(snapshot.key_value[i] + 8, 8 + len(data))
+      for (_, data, _, i) in candidates
+    ]
+    batch.run()
+
+    for (name, data, h, i),buf in zip(candidates, bufs):
+      if name in self.nodes:
+        continue
+      if buf[:8] == struct.pack('< I I', h, len(data)) and buf[8:] == data:
+        self.nodes[name] = i
+        self.keys[name] = snapshot.key_value[i]
+
+    missing = [name for name in names if name not in self.nodes]
+    if missing:
+      raise KeyError(f'No keys {missing} in {table}')
+    return self
+
+  def validate(self):
+    '''
+    Check that everything in the index is still where we found it.
+    '''
+    batch = self.pine.batch()
+    batch.peek32(self.L_ptr + 0x44)
+    batch.peek32(self.table.addr + 0x10)
+    batch.peek8(self.table.addr + 0x07)
+    for name,i in self.nodes.items():
+      batch.peek32(self.table.hash_ptr + i*20)
+      batch.peek32(self.table.hash_ptr + i*20 + 4)
+    (G_ptr, hash_ptr, lsizenode, *keys) = batch.run()
+    if (G_ptr, hash_ptr, 2 ** lsizenode) != (self.table.addr, self.table.hash_ptr, self.table.hash_size):
+      return False
+    return keys == [
+      x for key in self.keys.values() for x in (LUA_TSTRING, key)
+    ]
+
+  def node(self, name) -> Lua_GCTable.Node:
+    return self.table.hash[self.nodes[name]]
+
+  def getglobal(self, name) -> Lua_TObject:
+    return self.node(name).v
+
+
+def global_index(pine, L_ptr, names) -> Lua_GlobalIndex:
+  '''
+  Returns a Lua_GlobalIndex for the lua_State at L_ptr that covers all of names.
+  Indexes are kept between calls, so this only looks anything up if this is a
+  lua_State we haven't seen, names we haven't asked for before, or something we
+  found last time has since moved.
+  '''
+  with pine.tagged('lua'):
+    index = _GLOBAL_INDEXES.pop(L_ptr, None)
+    if index is None or not index.validate():
+      index = Lua_GlobalIndex(pine, L_ptr)
+    missing = [name for name in names if name not in index]
+    if missing:
+      index.resolve(missing)
+    _GLOBAL_INDEXES[L_ptr] = index
+    while len(_GLOBAL_INDEXES) > _GLOBAL_INDEX_LIMIT:
+      del _GLOBAL_INDEXES[next(iter(_GLOBAL_INDEXES))]
+    return index
+
+
 # Implementations of GCObject
 LUA_GCTYPES = [
   None, None, None, None,
@@ -566,8 +1231,6 @@ LUA_GCTYPES = [
 
 
 def TObject(pine, addr):
-  # if addr in _CACHE:
-  #   return _CACHE[addr]
   # tt = pine.peek32(addr)
   # if tt == 0xFFFFFFFF:
   #   # Removed by garbage collector
@@ -576,8 +1239,9 @@ def TObject(pine, addr):
   return Lua_TObject(pine, addr)
 
 def GCObject(pine, addr):
-  if addr in _CACHE:
-    return _CACHE[addr]
+  obj = _CACHE.get(addr)
+  if obj is not None:
+    return obj
   tt = pine.peek8(addr+4)
   # print('creating gcobject', f'{addr:08X} {tt:X}')
   if tt == 0xFFFFFFFF:
@@ -0,0 +1,223 @@
+'''
+Indexed on-disk store for Lua state dumps.
+
+Loads the records produced by luadump.py into an SQLite database, with indexes
+on the things we usually want to look up, so questions like "which functions use
+this constant" or "how do I get to this table from _G" can be answered offline,
+without the emulator and without grepping a multi-megabyte text dump.
+
+  db = LuaSnapshotDB('state.db')
+  db.load(dump(pine, L_ptr))
+  db.referencing('Faction_SetMinimumRelation')
+
+Tables mirror the record types:
+  objects(addr, tt, size, data)
+  edges(src, kind, key_tt, key, tt, value)
+  constants(proto, idx, tt, value)
+  instructions(proto, pc, op)
+plus meta(key, value) for things like where the dump came from. Values of GC
+types are addresses, so strings used as keys, values and constants are found by
+joining against objects. See tools/snapshot.py for the command line interface.
+'''
+
+from collections import deque
+from itertools import islice
+import sqlite3
+from typing import List, NamedTuple
+
+from .lua import tt_to_name, LUA_TNUMBER, LUA_TSTRING, LUA_TFUNCTION
+from .luadump import LuaObject, LuaEdge, LuaConstant, LuaInstruction
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS objects(addr INTEGER PRIMARY KEY, tt INTEGER, size INTEGER, data BLOB);
+CREATE TABLE IF NOT EXISTS edges(src INTEGER, kind TEXT, key_tt INTEGER, key, tt INTEGER, value);
+CREATE TABLE IF NOT EXISTS constants(proto INTEGER, idx INTEGER, tt INTEGER, value);
+CREATE TABLE IF NOT EXISTS instructions(proto INTEGER, pc INTEGER, op INTEGER);
+'''
+
+# Created after loading, since that's much faster than keeping them up to date
+# during the load.
+_INDEXES = '''
+CREATE INDEX IF NOT EXISTS objects_data ON objects(tt, data);
+CREATE INDEX IF NOT EXISTS edges_src ON edges(src);
+CREATE INDEX IF NOT EXISTS edges_value ON edges(value);
+CREATE INDEX IF NOT EXISTS constants_proto ON constants(proto);
+CREATE INDEX IF NOT EXISTS constants_value ON constants(tt, value);
+CREATE INDEX IF NOT EXISTS instructions_proto ON instructions(proto);
+'''
+
+# How many records to insert per executemany().
+_CHUNK = 10000
+
+
+class Step(NamedTuple):
+  '''
+  One step along a path through the object graph: the edge from src to dst.
+  '''
+  src: int
+  kind: str
+  key_tt: int
+  key: object
+  dst: int
+
+
+class LuaSnapshotDB:
+  def __init__(self, path: str):
+    self.db = sqlite3.connect(path)
+    self.db.executescript(_SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  def load(self, records, **meta):
+    '''
+    Store a stream of records from luadump, replacing whatever was there
+    before. Any keyword arguments are stored in the meta table. Returns the
+    number of records stored.
+    '''
+    inserts = {
+      LuaObject: 'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)',
+      LuaEdge: 'INSERT INTO edges VALUES (?, ?, ?, ?, ?, ?)',
+      LuaConstant: 'INSERT INTO constants VALUES (?, ?, ?, ?)',
+      LuaInstruction: 'INSERT INTO instructions VALUES (?, ?, ?)',
+    }
+    count = 0
+    with self.db:
+      for table in ['meta', 'objects', 'edges', 'constants', 'instructions']:
+        self.db.execute(f'DELETE FROM {table}')
+      self.db.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+      records = iter(records)
+      while chunk := list(islice(records, _CHUNK)):
+        rows = { T: [] for T in inserts }
+        for record in chunk:
+          rows[type(record)].append(record)
+        for T,sql in inserts.items():
+          self.db.executemany(sql, rows[T])
+        count += len(chunk)
+      self.db.executescript(_INDEXES)
+    return count
+
+  def meta(self):
+    return dict(self.db.execute('SELECT key, value FROM meta'))
+
+  def globals(self):
+    '''
+    Address of _G, or None if the dump doesn't include it.
+    '''
+    row = self.db.execute("SELECT value FROM edges WHERE kind = 'globals'").fetchone()
+    return row and row[0]
+
+  def string(self, addr: int):
+    row = self.db.execute('SELECT data FROM objects WHERE addr = ? AND tt = ?', (addr, LUA_TSTRING)).fetchone()
+    return row and row[0].decode(errors='replace')
+
+  def string_addr(self, data: str):
+    row = self.db.execute(
+      'SELECT addr FROM objects WHERE tt = ? AND data = ?', (LUA_TSTRING, data.encode())).fetchone()
+    return row and row[0]
+
+  def describe(self, tt: int, value):
+    '''
+    Human-readable version of a value from edges or constants.
+    '''
+    if tt == LUA_TSTRING:
+      return repr(self.string(value))
+    if tt < LUA_TSTRING:
+      return repr(value)
+    return f'{tt_to_name(tt)}${value:08X}'
+
+  def names(self, addr: int):
+    '''
+    Returns the names of all the globals holding the object at addr.
+    '''
+    return [
+      self.string(key) for (key,) in self.db.execute(
+        "SELECT key FROM edges WHERE src = ? AND kind = 'hash' AND key_tt = ? AND value = ? AND tt >= ?",
+        (self.globals(), LUA_TSTRING, addr, LUA_TSTRING))
+    ]
+
+  def functions_using(self, proto: int):
+    '''
+    Returns the addresses of all the closures of a function prototype.
+    '''
+    return [
+      src for (src,) in self.db.execute(
+        "SELECT src FROM edges WHERE kind = 'proto' AND value = ? AND src IN (SELECT addr FROM objects WHERE tt = ?)",
+        (proto, LUA_TFUNCTION))
+    ]
+
+  def referencing(self, constant: str):
+    '''
+    Returns (proto, constant index, [closure addresses]) for every function
+    prototype with the given string in its constant table.
+    '''
+    addr = self.string_addr(constant)
+    if addr is None:
+      return []
+    return [
+      (proto, idx, self.functions_using(proto))
+      for (proto, idx) in self.db.execute(
+        'SELECT proto, idx FROM constants WHERE tt = ? AND value = ? ORDER BY proto, idx',
+        (LUA_TSTRING, addr))
+    ]
+
+  def functions(self, min_sizek: int = 0):
+    '''
+    Returns (name, closure, proto, sizek, sizecode) for every global function
+    whose prototype has at least min_sizek constants.
+    '''
+    return [
+      (self.string(key), closure, proto, sizek, sizecode)
+      for (key, closure, proto, sizek, sizecode) in self.db.execute('''
+        SELECT g.key, g.value, p.value,
+          (SELECT COUNT(*) FROM constants WHERE proto = p.value) AS sizek,
+          (SELECT COUNT(*) FROM instructions WHERE proto = p.value) AS sizecode
+        FROM edges g JOIN edges p ON p.src = g.value AND p.kind = 'proto'
+        WHERE g.src = ? AND g.kind = 'hash' AND g.key_tt = ? AND g.tt = ?
+          AND sizek >= ?
+        ORDER BY sizek DESC
+      ''', (self.globals(), LUA_TSTRING, LUA_TFUNCTION, min_sizek))
+    ]
+
+  def path(self, addr: int, root: int = None) -> List[Step]:
+    '''
+    Returns the shortest path of edges from root (by default, _G) to addr, or
+    None if there isn't one. Searches backwards from addr, so it only visits
+    objects that can reach it. Function prototypes' constants count as edges,
+    with kind 'constant' and the constant index as the key.
+    '''
+    root = self.globals() if root is None else root
+    if addr == root:
+      return []
+    parents = { addr: None }
+    queue = deque([addr])
+    while queue:
+      dst = queue.popleft()
+      for (src, kind, key_tt, key) in self.db.execute('''
+          SELECT src, kind, key_tt, key FROM edges WHERE tt >= ? AND value = ?
+          UNION ALL
+          SELECT proto, 'constant', ?, idx FROM constants WHERE tt >= ? AND value = ?
+          ''', (LUA_TSTRING, dst, LUA_TNUMBER, LUA_TSTRING, dst)):
+        if src in parents:
+          continue
+        parents[src] = Step(src, kind, key_tt, key, dst)
+        if src == root:
+          path = []
+          while parents[src] is not None:
+            path.append(parents[src])
+            src = parents[src].dst
+          return path
+        queue.append(src)
+    return None
+
+  def format_path(self, path: List[Step], root: str = '_G'):
+    parts = [root]
+    for step in path:
+      if step.kind in {'hash', 'array'}:
+        parts.append(f'[{self.describe(step.key_tt, step.key)}]')
+      elif step.kind == 'constant':
+        parts.append(f'.<k{step.key}>')
+      else:
+        parts.append(f'.<{step.kind}>')
+    return ''.join(parts)
@@ -0,0 +1,308 @@
+'''
+Streaming dumps of Lua state.
+
+dump() walks everything reachable from a lua_State -- its stack and globals,
+the registry, and the default metatable -- and yields a record for each thing it
+finds, as it finds it:
+  LuaObject       every GC object, with its type, size, and (for strings) contents
+  LuaEdge         every reference from one object to a value: table entries,
+                  metatables, function environments, upvalues, stack slots...
+  LuaConstant     every entry in a function prototype's constant table
+  LuaInstruction  every instruction in a function prototype
+
+Values in edges and constants are decoded primitives, or the address of a GC
+object, which will have (or already had) its own LuaObject record.
+
+Memory is read through HeapMemory, in large chunks, so a whole lua_State costs a
+few dozen round trips rather than several per object. HeapMemory keeps every
+chunk it reads until the dump is done, since objects reference each other all
+over the heap and we'd otherwise read the same chunks again and again; so the
+dump holds on to at most the part of EE RAM that the heap touches. On top of
+that it keeps the set of addresses already visited and the queue of ones still
+to visit. Traversal is breadth-first with that explicit queue, so the object
+graph can be as deep as it likes without running out of stack, but the queue
+does grow with how wide it is. Records are yielded as they're found rather than
+collected, so none of them count against this.
+
+The records can be written as JSON Lines (write_jsonl) or a compact binary
+format (write_binary), and read back with read_dump.
+
+  python -m tools inspect --format jsonl --output state.jsonl
+'''
+
+from collections import deque
+import json
+import struct
+from typing import Any, NamedTuple
+
+from .lopcode import OPNAMES
+from .lua import LUA_TNIL, LUA_TNUMBER, LUA_TSTRING, LUA_TTABLE, LUA_TTHREAD, LUA_TPROTO
+from .luaheap import HeapMemory
+from .pine import Pine
+
+
+class LuaObject(NamedTuple):
+  addr: int
+  tt: int
+  # Bytes allocated for it; see HeapMemory.size_of().
+  size: int
+  # Contents, for strings; None for everything else.
+  data: bytes
+
+
+class LuaEdge(NamedTuple):
+  # Address of the object the reference is in.
+  src: int
+  # What kind of reference; one of EDGE_KINDS.
+  kind: str
+  # Type and value of the key, for edges that have one: table keys (with array
+  # entries keyed by their Lua index, starting at 1), and the index of stack
+  # slots and upvalues. Otherwise LUA_TNIL and None.
+  key_tt: int
+  key: Any
+  # Type and value of what it refers to.
+  tt: int
+  value: Any
+
+
+class LuaConstant(NamedTuple):
+  # Address of the function prototype.
+  proto: int
+  index: int
+  tt: int
+  value: Any
+
+
+class LuaInstruction(NamedTuple):
+  proto: int
+  pc: int
+  op: int
+
+  def name(self):
+    I = self.op & 0x3F
+    return OPNAMES[I] if I < len(OPNAMES) else f'OP{I}'
+
+
+EDGE_KINDS = [
+  'array', 'hash', 'metatable', 'env', 'proto', 'upvalue', 'stack', 'globals',
+  'registry', 'defaultmeta',
+]
+
+RECORD_TYPES = [LuaObject, LuaEdge, LuaConstant, LuaInstruction]
+
+
+def decode(tt: int, raw: int):
+  '''
+  Decode the raw contents of a TObject's value slot into what we put in records.
+  '''
+  match tt:
+    case 0: return None
+    case 1: return raw != 0
+    case 2: return raw
+    case 3: return struct.unpack('< f', struct.pack('< I', raw))[0]
+  return raw
+
+def encode(tt: int, value):
+  '''
+  Inverse of decode().
+  '''
+  match tt:
+    case 0: return 0
+    case 1: return int(value)
+    case 3: return struct.unpack('< I', struct.pack('< f', value))[0]
+  return value
+
+
+def dump(pine: Pine, L_ptr: int, memory: HeapMemory = None):
+  '''
+  Yields records for everything reachable from the lua_State at L_ptr.
+  '''
+  l_G = pine.peek32(L_ptr + 0x10)
+  memory = memory or HeapMemory(pine, l_G)
+  seen = {L_ptr}
+  queue = deque([L_ptr])
+
+  def edge(src, kind, tt, raw, key_tt=LUA_TNIL, key=None):
+    if LUA_TSTRING <= tt <= LUA_TTHREAD and raw not in seen:
+      seen.add(raw)
+      queue.append(raw)
+    return LuaEdge(src, kind, key_tt, key, tt, decode(tt, raw))
+
+  def proto_edge(src, ptr):
+    if ptr not in seen:
+      seen.add(ptr)
+      queue.append(ptr)
+    return LuaEdge(src, 'proto', LUA_TNIL, None, LUA_TPROTO, ptr)
+
+  # The roots that live in global_State rather than in any object; we report them
+  # as belonging to the thread.
+  (registry_tt, registry, defaultmeta_tt, defaultmeta) = memory.unpack('< 4I', l_G + 0x38)
+  yield edge(L_ptr, 'registry', registry_tt, registry)
+  yield edge(L_ptr, 'defaultmeta', defaultmeta_tt, defaultmeta)
+
+  while queue:
+    addr = queue.popleft()
+    (tt,) = memory.unpack('< 4x B', addr)
+    if tt == LUA_TSTRING:
+      (size,) = memory.unpack('< I', addr + 12)
+      yield LuaObject(addr, tt, 16 + size + 1, bytes(memory.read(addr + 16, size)))
+      continue
+    yield LuaObject(addr, tt, memory.size_of(addr, tt), None)
+
+    match tt:
+      case 5: # LUA_TTABLE
+        (lsizenode, mt, array, node, sizearray) = memory.unpack('< 7x B I I I 8x I', addr)
+        if mt:
+          yield edge(addr, 'metatable', LUA_TTABLE, mt)
+        for i,(vtt, raw) in enumerate(struct.iter_unpack('< I I', memory.read(array, sizearray * 8))):
+          if vtt != LUA_TNIL:
+            yield edge(addr, 'array', vtt, raw, LUA_TNUMBER, float(i + 1))
+        if memory.is_dummynode(node):
+          continue
+        for (ktt, kraw, vtt, vraw, _) in struct.iter_unpack('< 5I', memory.read(node, (1 << lsizenode) * 20)):
+          if ktt == LUA_TNIL or vtt == LUA_TNIL or ktt > LUA_TTHREAD or vtt > LUA_TTHREAD:
+            continue
+          if LUA_TSTRING <= ktt and kraw not in seen:
+            seen.add(kraw)
+            queue.append(kraw)
+          yield edge(addr, 'hash', vtt, vraw, ktt, decode(ktt, kraw))
+
+      case 6: # LUA_TFUNCTION
+        (isC, nups) = memory.unpack('< 6x B B', addr)
+        if isC:
+          # C closures have no environment, just the function pointer and then
+          # the upvalues inline.
+          upvalues = struct.iter_unpack('< I I', memory.read(addr + 16, nups * 8))
+        else:
+          # Proto, then the environment TObject, then pointers to UpVals, each
+          # of which points to the TObject holding the actual value.
+          (p, env_tt, env) = memory.unpack('< 12x I I I', addr)
+          yield edge(addr, 'env', env_tt, env)
+          yield proto_edge(addr, p)
+          upvalues = (
+            memory.unpack('< I I', memory.unpack('< 8x I', upval)[0])
+            for (upval,) in struct.iter_unpack('< I', memory.read(addr + 24, nups * 4)))
+        for i,(vtt, raw) in enumerate(upvalues):
+          yield edge(addr, 'upvalue', vtt, raw, LUA_TNUMBER, float(i))
+
+      case 7: # LUA_TUSERDATA
+        (mt,) = memory.unpack('< 8x I', addr)
+        if mt:
+          yield edge(addr, 'metatable', LUA_TTABLE, mt)
+
+      case 8: # LUA_TTHREAD
+        (top, stack) = memory.unpack('< 8x I 16x I', addr)
+        for i,(vtt, raw) in enumerate(struct.iter_unpack('< I I', memory.read(stack, max(0, top - stack)))):
+          yield edge(addr, 'stack', vtt, raw, LUA_TNUMBER, float(i))
+        (gt_tt, gt) = memory.unpack('< I I', addr + 0x40)
+        yield edge(addr, 'globals', gt_tt, gt)
+
+      case 9: # LUA_TPROTO
+        (k, code, p, sizek, sizecode, sizep) = memory.unpack('< 8x I I I 20x I I 4x I', addr)
+        for i,(vtt, raw) in enumerate(struct.iter_unpack('< I I', memory.read(k, sizek * 8))):
+          if LUA_TSTRING <= vtt <= LUA_TTHREAD and raw not in seen:
+            seen.add(raw)
+            queue.append(raw)
+          yield LuaConstant(addr, i, vtt, decode(vtt, raw))
+        for pc,(op,) in enumerate(struct.iter_unpack('< I', memory.read(code, sizecode * 4))):
+          yield LuaInstruction(addr, pc, op)
+        for (child,) in struct.iter_unpack('< I', memory.read(p, sizep * 4)):
+          yield proto_edge(addr, child)
+
+
+#### JSON Lines ####
+
+def write_jsonl(records, fd):
+  '''
+  Write records to a text file, one JSON object per line, with a "record" field
+  giving the record type. String contents that aren't valid UTF-8 survive the
+  round trip through read_dump().
+  '''
+  count = 0
+  for record in records:
+    fields = record._asdict()
+    if type(record) is LuaObject and record.data is not None:
+      fields['data'] = record.data.decode(errors='surrogateescape')
+    fields['record'] = type(record).__name__
+    fd.write(json.dumps(fields) + '\n')
+    count += 1
+  return count
+
+def read_jsonl(fd):
+  types = { T.__name__: T for T in RECORD_TYPES }
+  for line in fd:
+    fields = json.loads(line)
+    T = types[fields.pop('record')]
+    if T is LuaObject and fields['data'] is not None:
+      fields['data'] = fields['data'].encode(errors='surrogateescape')
+    yield T(**fields)
+
+
+#### Binary ####
+
+_MAGIC = b'LUADUMP\x01'
+# Each record is a type byte (index into RECORD_TYPES) followed by its fields.
+# Values are stored as their TObject tag and raw 32-bit contents.
+_OBJECT = struct.Struct('< I B I I')            # addr, tt, size, data length (or -1 as 0xFFFFFFFF)
+_EDGE = struct.Struct('< I B B I B I')          # src, kind, key tt, key, tt, value
+_CONSTANT = struct.Struct('< I I B I')          # proto, index, tt, value
+_INSTRUCTION = struct.Struct('< I I I')         # proto, pc, op
+_NO_DATA = 0xFFFFFFFF
+
+def write_binary(records, fd):
+  '''
+  Write records to a binary file. A fraction of the size of the JSON, and much
+  faster to read back.
+  '''
+  fd.write(_MAGIC)
+  count = 0
+  for record in records:
+    match record:
+      case LuaObject():
+        data = record.data
+        fd.write(b'\x00' + _OBJECT.pack(
+          record.addr, record.tt, record.size, _NO_DATA if data is None else len(data)))
+        if data is not None:
+          fd.write(data)
+      case LuaEdge():
+        fd.write(b'\x01' + _EDGE.pack(
+          record.src, EDGE_KINDS.index(record.kind),
+          record.key_tt, encode(record.key_tt, record.key),
+          record.tt, encode(record.tt, record.value)))
+      case LuaConstant():
+        fd.write(b'\x02' + _CONSTANT.pack(
+          record.proto, record.index, record.tt, encode(record.tt, record.value)))
+      case LuaInstruction():
+        fd.write(b'\x03' + _INSTRUCTION.pack(*record))
+    count += 1
+  return count
+
+def read_binary(fd):
+  assert fd.read(len(_MAGIC)) == _MAGIC, 'not a binary Lua dump'
+  while kind := fd.read(1):
+    match kind[0]:
+      case 0:
+        (addr, tt, size, length) = _OBJECT.unpack(fd.read(_OBJECT.size))
+        yield LuaObject(addr, tt, size, None if length == _NO_DATA else fd.read(length))
+      case 1:
+        (src, kind, key_tt, key, tt, value) = _EDGE.unpack(fd.read(_EDGE.size))
+        yield LuaEdge(src, EDGE_KINDS[kind], key_tt, decode(key_tt, key), tt, decode(tt, value))
+      case 2:
+        (proto, index, tt, value) = _CONSTANT.unpack(fd.read(_CONSTANT.size))
+        yield LuaConstant(proto, index, tt, decode(tt, value))
+      case 3:
+        yield LuaInstruction(*_INSTRUCTION.unpack(fd.read(_INSTRUCTION.size)))
+
+
+def read_dump(path: str):
+  '''
+  Yields the records in a dump written by write_jsonl() or write_binary().
+  '''
+  with open(path, 'rb') as fd:
+    binary = fd.read(len(_MAGIC)) == _MAGIC
+  if binary:
+    with open(path, 'rb') as fd:
+      yield from read_binary(fd)
+  else:
+    with open(path, 'r') as fd:
+      yield from read_jsonl(fd)
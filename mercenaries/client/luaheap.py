@@ -0,0 +1,209 @@
+'''
+Lua heap walker.
+
+Rather than finding objects by following references from _G and friends, which
+takes one round trip per object and misses anything not reachable from where we
+start, this walks the lists the garbage collector itself keeps of every object
+it has allocated:
+  - rootgc, every table, function, prototype, upvalue, and thread;
+  - rootudata, every userdata;
+  - the string table, every string.
+
+The lists are linked through the next pointer at the start of each object, so
+walking them one object at a time would cost a round trip per object. Instead,
+memory is read in large chunks, and the next pointer is followed through those;
+since the allocator puts objects near each other, most of the list ends up being
+walked out of memory we've already read.
+
+  heap = LuaHeap(pine, L_ptr)
+  print(heap)           # counts and sizes by type
+  heap.objects[addr]    # HeapObject for the object at addr
+
+HeapMemory, which does the chunked reading, is also used by luadump.py.
+
+Sizes are the size of the allocation(s) belonging to each object, worked out
+from the Lua 5.0 structure layouts: the object itself plus any arrays it owns,
+like a table's node and array parts or a function prototype's code and constants.
+'''
+
+from collections import Counter
+import struct
+from typing import Dict, NamedTuple
+
+from .lua import Lua_StringTable, tt_to_name, LUA_TSTRING
+from .pine import Pine
+
+# Sizes of the fixed parts of GC objects.
+_TABLE_SIZE = 0x20
+_PROTO_SIZE = 0x48
+_UPVAL_SIZE = 0x14
+_UDATA_SIZE = 0x10
+_STATE_SIZE = 0x58
+_CALLINFO_SIZE = 0x18
+_NODE_SIZE = 20
+_TOBJECT_SIZE = 8
+
+# Offsets of the lists in global_State.
+_ROOTGC = 0x0C
+_ROOTUDATA = 0x10
+# Offset of dummynode in global_State, which tables with no hash part point
+# their node array at instead of allocating one. It comes right after _registry,
+# _defaultmeta, and mainthread.
+_DUMMYNODE = 0x4C
+
+# Give up on a list after this many objects; if we get this far, the game has
+# almost certainly rewritten it out from under us.
+_MAX_OBJECTS = 1 << 22
+
+
+class HeapObject(NamedTuple):
+  addr: int
+  tt: int
+  # Bytes allocated for the object and anything it owns.
+  size: int
+
+
+class HeapMemory:
+  '''
+  Read-only view of game memory for walking the Lua heap, read in large chunks
+  the first time anything in them is needed. Unlike PageCache, it never
+  expires anything; it's meant for a single pass over the heap.
+  '''
+  pine: Pine
+  l_G: int
+  chunk_size: int
+
+  def __init__(self, pine: Pine, l_G: int, chunk_size: int = 0x10000):
+    self.pine = pine
+    self.l_G = l_G
+    self.chunk_size = chunk_size
+    self.chunks = {}
+    # Round trips spent reading chunks.
+    self.reads = 0
+
+  def read(self, addr: int, size: int):
+    '''
+    Returns the contents of [addr, addr+size), reading whole chunks of memory
+    around it if we don't already have them.
+    '''
+    if size == 0:
+      return b''
+    (first, last) = (addr // self.chunk_size, (addr + size - 1) // self.chunk_size)
+    missing = [chunk for chunk in range(first, last+1) if chunk not in self.chunks]
+    if missing:
+      batch = self.pine.batch()
+      bufs = [batch.readmem(chunk * self.chunk_size, self.chunk_size) for chunk in missing]
+      batch.run()
+      self.chunks.update(zip(missing, bufs))
+      self.reads += 1
+    offset = addr - first * self.chunk_size
+    if first == last:
+      return memoryview(self.chunks[first])[offset:offset+size]
+    return b''.join(self.chunks[chunk] for chunk in range(first, last+1))[offset:offset+size]
+
+  def is_dummynode(self, node: int):
+    '''
+    Check if a table's node array is the shared dummy node that tables with no
+    hash part use.
+    '''
+    return node == self.l_G + _DUMMYNODE
+
+  def unpack(self, layout: str, addr: int):
+    return struct.unpack_from(layout, self.read(addr, struct.calcsize(layout)))
+
+  def size_of(self, addr: int, tt: int):
+    '''
+    Returns the number of bytes allocated for the object at addr, of type tt.
+    '''
+    match tt:
+      case 4: # LUA_TSTRING
+        (size,) = self.unpack('< I', addr + 12)
+        return 16 + size + 1
+      case 5: # LUA_TTABLE
+        (lsizenode, node, sizearray) = self.unpack('< 7x B 8x I 8x I', addr)
+        size = _TABLE_SIZE + sizearray * _TOBJECT_SIZE
+        if not self.is_dummynode(node):
+          size += (1 << lsizenode) * _NODE_SIZE
+        return size
+      case 6: # LUA_TFUNCTION
+        (isC, nups) = self.unpack('< 6x B B', addr)
+        # sizeCclosure/sizeLclosure: C closures are 16 bytes plus their upvalues
+        # inline, Lua closures are 24 (they also have a Proto and environment)
+        # plus a pointer per upvalue.
+        if isC:
+          return 16 + nups * _TOBJECT_SIZE
+        return 24 + nups * 4
+      case 7: # LUA_TUSERDATA
+        return _UDATA_SIZE + self.unpack('< I', addr + 12)[0]
+      case 8: # LUA_TTHREAD
+        (stacksize,) = self.unpack('< I', addr + 0x20)
+        (size_ci,) = self.unpack('< H', addr + 0x2C)
+        return _STATE_SIZE + stacksize * _TOBJECT_SIZE + size_ci * _CALLINFO_SIZE
+      case 9: # LUA_TPROTO
+        (sizeupvalues, sizek, sizecode, sizelineinfo, sizep, sizelocvars) = self.unpack('< 6I', addr + 36)
+        return (
+          _PROTO_SIZE + sizecode * 4 + sizek * _TOBJECT_SIZE + sizep * 4
+          + sizelineinfo * 4 + sizelocvars * 12 + sizeupvalues * 4)
+      case 10: # LUA_TUPVAL
+        return _UPVAL_SIZE
+    # Something that shouldn't be on the heap at all. Count it, but we have no
+    # idea how big it is.
+    return 0
+
+
+class LuaHeap:
+  '''
+  Every object on the Lua heap, as of a single walk. Construct it with a Pine
+  and the address of a lua_State.
+  '''
+  pine: Pine
+  memory: HeapMemory
+  objects: Dict[int, HeapObject]
+
+  def __init__(self, pine: Pine, L_ptr: int, chunk_size: int = 0x10000):
+    self.pine = pine
+    self.memory = HeapMemory(pine, pine.peek32(L_ptr + 0x10), chunk_size)
+    self.objects = {}
+
+    l_G = self.memory.l_G
+    (rootgc, rootudata) = self.memory.unpack('< I I', l_G + _ROOTGC)
+    for obj in self.walk(rootgc):
+      self.objects[obj.addr] = obj
+    for obj in self.walk(rootudata):
+      self.objects[obj.addr] = obj
+    for (addr, _, size) in Lua_StringTable(pine, l_G).snapshot():
+      self.objects[addr] = HeapObject(addr, LUA_TSTRING, 16 + size + 1)
+
+  @property
+  def reads(self):
+    return self.memory.reads
+
+  def walk(self, addr: int):
+    '''
+    Yields a HeapObject for each object on the list starting at addr.
+    '''
+    for _ in range(_MAX_OBJECTS):
+      if addr == 0 or addr in self.objects:
+        return
+      (next, tt) = self.memory.unpack('< I B', addr)
+      yield HeapObject(addr, tt, self.memory.size_of(addr, tt))
+      addr = next
+
+  def by_type(self):
+    '''
+    Returns a dict of type tag to (count, bytes).
+    '''
+    counts = Counter()
+    sizes = Counter()
+    for obj in self.objects.values():
+      counts[obj.tt] += 1
+      sizes[obj.tt] += obj.size
+    return { tt: (counts[tt], sizes[tt]) for tt in counts }
+
+  def __str__(self):
+    lines = [f'{"":10s} {"count":>8s} {"bytes":>10s}']
+    types = sorted(self.by_type().items())
+    for tt,(count, size) in types:
+      lines.append(f'{tt_to_name(tt):10s} {count:8d} {size:10d}')
+    lines.append(f'{"total":10s} {sum(c for _,(c,_) in types):8d} {sum(s for _,(_,s) in types):10d}')
+    return '\n'.join(lines)
@@ -0,0 +1,139 @@
+'''
+Read-through cache of emulator memory.
+
+Memory is cached in fixed-size pages, each filled with a single bulk read the
+first time anything in it is read. The cache is only valid for one "epoch",
+which the owner advances whenever it wants fresh data -- MercenariesIPC does it
+once per sync tick -- so within an epoch, repeated reads of the same memory
+(like the game state flags checked by validate(), or the nodes of _G) cost one
+round trip instead of one each.
+
+Writes made through the Pine that owns the cache are applied to any cached
+pages they touch, so we always see our own writes. Writes made by the game
+itself are not seen until the next epoch.
+
+To use it, attach it to a Pine:
+  pine.cache = PageCache(pine)
+and then call pine.cache.advance() at the start of each tick.
+'''
+
+from typing import NamedTuple
+
+from .pine import Pine
+
+
+class CacheStats(NamedTuple):
+  epoch: int
+  # Reads served entirely from cache
+  hits: int
+  # Reads that needed at least one page fetched
+  misses: int
+  # Pages fetched
+  pages: int
+
+  def __str__(self):
+    return f'epoch {self.epoch}: {self.hits} hits, {self.misses} misses, {self.pages} pages fetched'
+
+
+class PageCache:
+  pine: Pine
+  page_size: int
+  epoch: int
+  pages: dict
+  last_stats: CacheStats
+
+  def __init__(self, pine: Pine, page_size: int = 256):
+    assert page_size % 8 == 0, 'Page size must be a multiple of 8'
+    self.pine = pine
+    self.page_size = page_size
+    self.epoch = 0
+    self.pages = {}
+    self.hits = self.misses = self.fetched = 0
+    self.last_stats = CacheStats(-1, 0, 0, 0)
+
+  def stats(self):
+    '''
+    Returns the hit/miss counters for the current epoch so far.
+    '''
+    return CacheStats(self.epoch, self.hits, self.misses, self.fetched)
+
+  def advance(self):
+    '''
+    Start a new epoch, discarding everything cached. Returns the stats for the
+    epoch just finished, which are also kept in last_stats.
+    '''
+    self.last_stats = self.stats()
+    self.epoch += 1
+    self.pages = {}
+    self.hits = self.misses = self.fetched = 0
+    return self.last_stats
+
+  def invalidate(self, addr: int = None, size: int = 1):
+    '''
+    Discard cached pages overlapping [addr, addr+size), or everything if addr is
+    None, without starting a new epoch.
+    '''
+    if addr is None:
+      self.pages = {}
+      return
+    for page in range(addr // self.page_size, (addr + size - 1) // self.page_size + 1):
+      self.pages.pop(page, None)
+
+  def fetch(self, pages):
+    '''
+    Read the given page numbers into the cache in one batch, merging runs of
+    consecutive pages into a single range read.
+    '''
+    batch = self.pine.batch()
+    runs = []
+    for page in sorted(pages):
+      if runs and runs[-1][0] + runs[-1][1] == page:
+        runs[-1][1] += 1
+      else:
+        runs.append([page, 1])
+    bufs = [
+      (page, count, batch.readmem(page * self.page_size, count * self.page_size))
+      for page,count in runs
+    ]
+    # Pages hold what's actually in emulator memory; Pine overlays any buffered
+    # writes on top when reading from them.
+    batch.run(flush = False)
+
+    for first,count,buf in bufs:
+      for i in range(count):
+        self.pages[first + i] = buf[i*self.page_size:(i+1)*self.page_size]
+    self.fetched += len(pages)
+
+  def read(self, addr: int, size: int):
+    '''
+    Returns the contents of [addr, addr+size) as a bytes-like object, fetching
+    any pages not already cached.
+    '''
+    if size == 0:
+      return b''
+    (first, last) = (addr // self.page_size, (addr + size - 1) // self.page_size)
+    missing = [page for page in range(first, last+1) if page not in self.pages]
+    if missing:
+      self.misses += 1
+      self.fetch(missing)
+    else:
+      self.hits += 1
+
+    offset = addr - first * self.page_size
+    if first == last:
+      return memoryview(self.pages[first])[offset:offset+size]
+    buf = b''.join(self.pages[page] for page in range(first, last+1))
+    return buf[offset:offset+size]
+
+  def write(self, addr: int, data: bytes):
+    '''
+    Apply a write to any cached pages it overlaps. This does not write to the
+    emulator; it's called by Pine after it has done so.
+    '''
+    end = addr + len(data)
+    for page in range(addr // self.page_size, (end - 1) // self.page_size + 1):
+      if page not in self.pages:
+        continue
+      base = page * self.page_size
+      (start, stop) = (max(addr, base), min(end, base + self.page_size))
+      self.pages[page][start-base:stop-base] = data[start-addr:stop-addr]
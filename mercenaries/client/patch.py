@@ -1,19 +1,97 @@
 '''
 Code patches for the Mercenaries rando.
+
+patch() applies them and returns handles to the constants we use to talk to the
+patched code. The client goes through Injection instead, which applies them in
+stages and can pick up where it left off if it gets interrupted partway.
+
+Since the patches survive as long as the lua_State does, and the client may
+well not, what it did is also recorded in a PatchRecord, which
+PatchStore keeps on disk; a client that restarts while the game keeps running
+can check that the patches are still there and get its handles back without
+looking anything up or patching anything.
 '''
 
+import hashlib
+import json
+import os
+import struct
+from typing import Dict, NamedTuple, Tuple
+
 from .lopcode import LuaOpcode
-from .lua import LUA_TNUMBER, LUA_TSTRING, LUA_TBOOL
+from .lua import global_index, TObject, Lua_GlobalIndex, Lua_TObject, LUA_TNUMBER, LUA_TSTRING, LUA_TFUNCTION, LUA_TBOOL
+from .pine import Pine
+
+# Globals we need to look up, and the ones we refer to by name from patched code.
+GLOBALS = [
+  'gameflow_GetIntelTotal', 'gameflow_ShouldGameStateApply',
+  'util_PrintDebugMsg', 'Debug_Printf', 'gameflow_AttemptAceMissionUnlock',
+  'AttemptFactionMoodClamp', 'bDebugOutput', 'Player_GetMoney',
+  'Player_SetMoney', 'Ui_PrintHudMessage', 'Support_AddItem',
+]
+NAMED_GLOBALS = [
+  'bDebugOutput', 'gameflow_ShouldGameStateApply', 'gameflow_GetIntelTotal',
+  'gameflow_AttemptAceMissionUnlock', 'Player_GetMoney', 'Player_SetMoney',
+  'Ui_PrintHudMessage', 'Support_AddItem',
+]
+
+# Functions whose code and constants we patch.
+PATCHED_FUNCTIONS = [
+  'gameflow_GetIntelTotal', 'gameflow_ShouldGameStateApply', 'AttemptFactionMoodClamp',
+]
+# Functions we replace with AttemptFactionMoodClamp.
+REDIRECTED_FUNCTIONS = ['Debug_Printf', 'util_PrintDebugMsg']
+
+# Constants that we keep writing to after patching, to pass things to the game;
+# these are left out of the fingerprint. The strings in k11 and k21 of AFMC are
+# rewritten in place, so the constants pointing at them don't change.
+_VOLATILE_CONSTANTS = {
+  'gameflow_GetIntelTotal': {0},
+  'AttemptFactionMoodClamp': {5, 6, 7, 8, 9, 13, 22},
+}
+
+# How many lua_States to remember patches for, per game.
+_PATCH_STORE_LIMIT = 4
+
 
-def patch(globals):
+class PatchHandles(NamedTuple):
+  intel_total: Lua_TObject
+  money_bonus: Lua_TObject
+  message_buffer: Lua_TObject
+  has_message: Lua_TObject
+  support_item: Lua_TObject
+  has_support_item: Lua_TObject
+  # Faction name to TObject.
+  reputation_floors: Dict[str, Lua_TObject]
+
+
+def resolve_globals(pine, L_ptr):
+  '''
+  Look up everything the patches need in _G, in one go. Returns the
+  Lua_GlobalIndex, and a dict of the TObjects holding the globals, plus the key
+  strings of the ones we need by name as '<name>_name'. Raises KeyError if any
+  of them are missing, which usually means the VM is still starting up.
+  '''
+  index = global_index(pine, L_ptr, GLOBALS)
+  globals = { name: index.getglobal(name) for name in GLOBALS }
+  for name in NAMED_GLOBALS:
+    globals[f'{name}_name'] = index.node(name).k
+  return (index, globals)
+
+def patch(globals) -> PatchHandles:
   patch_intel(globals)
   # TODO: Not needed since tCurrentMissions is available in most contexts?
   patch_sgsa(globals)
   patch_afmc(globals)
   redirect_debug_prints(globals)
+  return patch_handles(globals)
 
+def patch_handles(globals) -> PatchHandles:
+  '''
+  Returns the handles to the constants the patched code reads from.
+  '''
   afmc = globals['AttemptFactionMoodClamp'].val()
-  return (
+  return PatchHandles(
     globals['gameflow_GetIntelTotal'].val().getk(0), # Intel counter
     afmc.getk(9), # Money bonus
     afmc.getk(11), # Message buffer
@@ -29,8 +107,10 @@ def patch(globals):
   )
 
 def redirect_debug_prints(globals):
-  globals['Debug_Printf'].set(globals['AttemptFactionMoodClamp'])
-  globals['util_PrintDebugMsg'].set(globals['AttemptFactionMoodClamp'])
+  afmc = globals['AttemptFactionMoodClamp'].val()
+  with globals['AttemptFactionMoodClamp'].pine.combine():
+    for name in REDIRECTED_FUNCTIONS:
+      globals[name].set(afmc)
 
 def patch_intel(globals):
   '''
@@ -220,3 +300,279 @@ def patch_afmc(globals):
       # eof
       LuaOpcode('RETURN', B=1),
     ])
+
+
+def fingerprint(images: Dict[str, Tuple[bytes, bytes]]) -> str:
+  '''
+  Hash of the patched functions' constant tables and bytecode, given as a dict
+  of function name to (constants, code), ignoring the volatile constants.
+  '''
+  h = hashlib.sha1()
+  for name in PATCHED_FUNCTIONS:
+    hash_image(h, name, *images[name])
+  return h.hexdigest()
+
+def hash_image(h, name: str, k: bytes, code: bytes):
+  '''
+  Add the constant table and bytecode of one patched function to the hash h.
+  '''
+  k = bytearray(k)
+  for i in _VOLATILE_CONSTANTS.get(name, ()):
+    k[i*8:i*8+8] = bytes(8)
+  h.update(struct.pack('< I I', len(k), len(code)))
+  h.update(k)
+  h.update(code)
+  return h
+
+
+class PatchRecord(NamedTuple):
+  '''
+  Everything we need to know to check that a lua_State is still patched, and to
+  get handles to the patched constants back, without looking anything up.
+  '''
+  fingerprint: str
+  # For each patched function, the addresses of its closure, its prototype, and
+  # the prototype's constant table and bytecode, and the sizes of the latter,
+  # as (closure, proto, k, sizek, code, sizecode).
+  functions: Dict[str, Tuple[int, int, int, int, int, int]]
+  # For each patched or redirected function, and bDebugOutput, the address of
+  # the TObject in _G holding it, the address of its name, and the closure it
+  # should hold (None for bDebugOutput), as (value, key, closure).
+  globals: Dict[str, Tuple[int, int, int]]
+  # Addresses of the TObjects in PatchHandles, keyed by field name.
+  handles: Dict[str, object]
+
+  @staticmethod
+  def capture(pine, index, handles: PatchHandles, debug_flag: Lua_TObject):
+    '''
+    Record the patches just applied to the lua_State that index (a
+    Lua_GlobalIndex) is for.
+    '''
+    functions = {}
+    for name in PATCHED_FUNCTIONS:
+      fn = index.getglobal(name).val()
+      proto = fn.proto
+      functions[name] = (fn.addr, proto.addr, proto.k, proto.sizek, proto.codeptr, proto.sizecode)
+    afmc = functions['AttemptFactionMoodClamp'][0]
+    globals = {
+      name: (index.getglobal(name).addr, index.keys[name],
+             afmc if name in REDIRECTED_FUNCTIONS else functions[name][0])
+      for name in PATCHED_FUNCTIONS + REDIRECTED_FUNCTIONS
+    }
+    globals['bDebugOutput'] = (debug_flag.addr, index.keys['bDebugOutput'], None)
+    addrs = {
+      field: { k: v.addr for k,v in value.items() } if type(value) is dict else value.addr
+      for field,value in handles._asdict().items()
+    }
+
+    batch = pine.batch()
+    images = {
+      name: (batch.readmem(k, sizek*8), batch.readmem(code, sizecode*4))
+      for name,(_, _, k, sizek, code, sizecode) in functions.items()
+    }
+    batch.run()
+    return PatchRecord(fingerprint(images), functions, globals, addrs)
+
+  @staticmethod
+  def from_json(data):
+    return PatchRecord(
+      data['fingerprint'],
+      { name: tuple(v) for name,v in data['functions'].items() },
+      { name: tuple(v) for name,v in data['globals'].items() },
+      data['handles'])
+
+  def check(self, pine) -> bool:
+    '''
+    Check, in a single batch, that the globals still hold the closures we
+    patched, the closures still have the same prototypes, and the prototypes
+    still have the same code and constants as when we patched them.
+    '''
+    batch = pine.batch()
+    expected = []
+    images = {}
+    for name,(closure, proto, k, sizek, code, sizecode) in self.functions.items():
+      expected.append((batch.readmem(closure + 12, 4), struct.pack('< I', proto)))
+      expected.append((batch.readmem(proto + 8, 8), struct.pack('< I I', k, code)))
+      expected.append((batch.readmem(proto + 40, 8), struct.pack('< I I', sizek, sizecode)))
+      images[name] = (batch.readmem(k, sizek*8), batch.readmem(code, sizecode*4))
+    for (value, key, closure) in self.globals.values():
+      # The key of the node the value is in comes right before it.
+      if closure is None:
+        expected.append((batch.readmem(value - 8, 8), struct.pack('< I I', LUA_TSTRING, key)))
+      else:
+        expected.append((batch.readmem(value - 8, 16), struct.pack('< 4I', LUA_TSTRING, key, LUA_TFUNCTION, closure)))
+    batch.run()
+    return (
+      all(bytes(buf) == data for buf,data in expected)
+      and fingerprint(images) == self.fingerprint)
+
+  def restore(self, pine) -> Tuple[PatchHandles, Lua_TObject]:
+    '''
+    Returns the PatchHandles that patch() returned when this was recorded,
+    and the bDebugOutput TObject.
+    '''
+    def handle(addr):
+      if type(addr) is dict:
+        return { k: TObject(pine, v) for k,v in addr.items() }
+      return TObject(pine, addr)
+    return (
+      PatchHandles(*[handle(self.handles[field]) for field in PatchHandles._fields]),
+      TObject(pine, self.globals['bDebugOutput'][0]))
+
+
+class PatchStore:
+  '''
+  PatchRecords on disk, as JSON, keyed by game UUID and lua_State address.
+  '''
+  path: str
+
+  def __init__(self, path: str):
+    self.path = path
+
+  def load(self):
+    try:
+      with open(self.path, 'r') as fd:
+        return json.load(fd)
+    except (OSError, ValueError):
+      # Missing or mangled; either way, we'll just patch everything again.
+      return {}
+
+  def get(self, uuid: str, L_ptr: int) -> PatchRecord:
+    record = self.load().get(uuid, {}).get(f'{L_ptr:08X}')
+    return record and PatchRecord.from_json(record)
+
+  def put(self, uuid: str, L_ptr: int, record: PatchRecord):
+    records = self.load()
+    game = records.setdefault(uuid, {})
+    game.pop(f'{L_ptr:08X}', None)
+    game[f'{L_ptr:08X}'] = record._asdict()
+    while len(game) > _PATCH_STORE_LIMIT:
+      del game[next(iter(game))]
+    # Written to the side and renamed into place, so that we never leave a
+    # half-written file behind.
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as fd:
+      json.dump(records, fd, indent=2)
+    os.replace(tmp, self.path)
+
+
+class Injection:
+  '''
+  Progress of patching one lua_State, in stages:
+    globals   look up everything we need in _G
+    intel     patch gameflow_GetIntelTotal
+    sgsa      patch gameflow_ShouldGameStateApply
+    afmc      patch AttemptFactionMoodClamp
+    redirect  point the debug print functions at AFMC
+
+  Each stage is applied atomically -- the patches by Lua_GCFunction.lock(), the
+  redirect in a single message -- and which ones are done is remembered. If
+  injection is interrupted, say by a loading screen, the next run() checks that
+  the finished stages still hold, which costs two round trips however many there
+  are, and picks up from the first one that doesn't.
+  '''
+  STAGES = ['globals', 'intel', 'sgsa', 'afmc', 'redirect']
+  # Which function each of the patch stages patches.
+  PATCHES = {
+    'intel': 'gameflow_GetIntelTotal',
+    'sgsa': 'gameflow_ShouldGameStateApply',
+    'afmc': 'AttemptFactionMoodClamp',
+  }
+
+  pine: Pine
+  L_ptr: int
+  index: Lua_GlobalIndex
+  globals: dict
+  # Finished stages, and what check() needs to see if they still hold: for the
+  # patch stages, where the function is and a hash of it as we left it, as
+  # (closure, k, sizek, code, sizecode, digest); for the redirect, the closure
+  # the debug print functions should be pointing at.
+  done: dict
+
+  def __init__(self, pine, L_ptr):
+    self.pine = pine
+    self.L_ptr = L_ptr
+    self.index = None
+    self.globals = None
+    self.done = {}
+
+  def __str__(self):
+    return f'injection into lua_State${self.L_ptr:08X} ({", ".join(self.done) or "not started"})'
+
+  def complete(self):
+    return len(self.done) == len(self.STAGES)
+
+  def run(self) -> PatchHandles:
+    '''
+    Run every stage that isn't done, or is done but no longer holds, and return
+    the handles to the patched constants.
+    '''
+    self.check()
+    for stage in self.STAGES:
+      if stage in self.done:
+        continue
+      print(f'Starting code injection stage: {stage}')
+      match stage:
+        case 'globals':
+          (self.index, self.globals) = resolve_globals(self.pine, self.L_ptr)
+          self.done[stage] = None
+        case 'intel':
+          patch_intel(self.globals)
+          self.done[stage] = self.capture(stage)
+        case 'sgsa':
+          patch_sgsa(self.globals)
+          self.done[stage] = self.capture(stage)
+        case 'afmc':
+          patch_afmc(self.globals)
+          self.done[stage] = self.capture(stage)
+        case 'redirect':
+          redirect_debug_prints(self.globals)
+          self.done[stage] = self.globals['AttemptFactionMoodClamp'].val().addr
+    return patch_handles(self.globals)
+
+  def capture(self, stage):
+    name = self.PATCHES[stage]
+    fn = self.globals[name].val()
+    (k, code) = fn.read_proto()
+    return (
+      fn.addr, fn.proto.k, fn.proto.sizek, fn.proto.codeptr, fn.proto.sizecode,
+      hash_image(hashlib.sha1(), name, k, code).digest())
+
+  def check(self):
+    '''
+    Forget any finished stages that no longer hold: if _G has changed, that's
+    all of them; otherwise, any patched function that's been replaced or no
+    longer hashes the same, and the redirect if the debug print functions have
+    been put back.
+    '''
+    if not self.done:
+      return
+    if not self.index.validate():
+      self.done.clear()
+      return
+
+    batch = self.pine.batch()
+    reads = {}
+    for stage,name in self.PATCHES.items():
+      if stage in self.done:
+        (_, k, sizek, code, sizecode, _) = self.done[stage]
+        reads[stage] = (
+          batch.readmem(self.globals[name].addr, 8),
+          batch.readmem(k, sizek*8),
+          batch.readmem(code, sizecode*4))
+    if 'redirect' in self.done:
+      reads['redirect'] = [batch.readmem(self.globals[name].addr, 8) for name in REDIRECTED_FUNCTIONS]
+    batch.run()
+
+    for stage,name in self.PATCHES.items():
+      if stage not in reads:
+        continue
+      (closure, _, _, _, _, digest) = self.done[stage]
+      (value, k, code) = reads[stage]
+      if (bytes(value) != struct.pack('< I I', LUA_TFUNCTION, closure)
+          or hash_image(hashlib.sha1(), name, k, code).digest() != digest):
+        del self.done[stage]
+    if 'redirect' in reads:
+      afmc = self.done['redirect']
+      if any(bytes(value) != struct.pack('< I I', LUA_TFUNCTION, afmc) for value in reads['redirect']):
+        del self.done['redirect']
@@ -1,3 +1,7 @@
+from bisect import bisect_right
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from operator import itemgetter
 import socket
 import struct
 from typing import NamedTuple
@@ -5,6 +9,78 @@ from typing import NamedTuple
 
 _INT_FORMATS = { 8: '< B', 16: '< H', 32: '< I', 64: '< Q'}
 
+# Opcodes for peeks and pokes, by width in bytes.
+_PEEK_OPCODES = { 1: 0x00, 2: 0x01, 4: 0x02, 8: 0x03 }
+_POKE_OPCODES = { 1: 0x04, 2: 0x05, 4: 0x06, 8: 0x07 }
+
+# Size of the arguments and of the reply for every opcode, for code that needs
+# to pick apart messages it didn't create. A reply size of None means the reply
+# is a length-prefixed string.
+_OPCODE_SIZES = {
+  0x00: (4, 1), 0x01: (4, 2), 0x02: (4, 4), 0x03: (4, 8), # peeks
+  0x04: (5, 0), 0x05: (6, 0), 0x06: (8, 0), 0x07: (12, 0), # pokes
+  0x08: (0, None), # emulator version
+  0x09: (1, 0), 0x0A: (1, 0), # save/load state
+  0x0B: (0, None), 0x0C: (0, None), 0x0D: (0, None), 0x0E: (0, None), # game info
+  0x0F: (0, 4), # emulator status
+}
+
+# Precompiled structs for everything on the hot path, so that we aren't parsing
+# format strings on every command.
+# Message header: total size, including the header; opcode (requests) or result
+# code (replies).
+_SIZE = struct.Struct('< I')
+_ADDR = struct.Struct('< I')
+_HEADER = struct.Struct('< I B')
+# Op bodies, as they appear inside a message: opcode, address, and for pokes,
+# the value to write.
+_PEEK = struct.Struct('< B I')
+_POKE = {
+  8: struct.Struct('< B I B'),
+  16: struct.Struct('< B I H'),
+  32: struct.Struct('< B I I'),
+  64: struct.Struct('< B I Q'),
+  'f32': struct.Struct('< B I f'),
+}
+# Complete single-op messages, including the header.
+_PEEK_MSG = struct.Struct('< I B I')
+_POKE_MSG = {
+  8: struct.Struct('< I B I B'),
+  16: struct.Struct('< I B I H'),
+  32: struct.Struct('< I B I I'),
+  64: struct.Struct('< I B I Q'),
+  'f32': struct.Struct('< I B I f'),
+}
+# Reply payloads.
+_VALUE = { bits: struct.Struct(fmt) for bits,fmt in _INT_FORMATS.items() }
+_VALUE['f32'] = struct.Struct('< f')
+
+def _scalar_unpacker(value: struct.Struct):
+  def unpack(data: bytes):
+    return value.unpack(data)[0]
+  return unpack
+
+_UNPACK_INT = { bits: _scalar_unpacker(_VALUE[bits]) for bits in _INT_FORMATS }
+
+# Limits on the size of a single message, including the header, from PCSX2's
+# PINE server. Batches larger than this are split across multiple messages.
+MAX_IPC_SIZE = 650000
+MAX_IPC_RETURN_SIZE = 450000
+
+# What Pine.tagged() returns when there's nothing to tag.
+_UNTAGGED = nullcontext()
+
+
+class PineError(RuntimeError):
+  '''
+  Raised when the emulator reports failure for a command. For batched commands,
+  index is the position of the failing op in the batch, and op its opcode.
+  '''
+  def __init__(self, msg: str, index: int = None, op: int = None):
+    super().__init__(msg)
+    self.index = index
+    self.op = op
+
 
 class PineStatus(NamedTuple):
   title: str
@@ -13,8 +89,180 @@ class PineStatus(NamedTuple):
   version: str
 
 
-class Pine:
+class PineCodec:
+  '''
+  Message encoding and decoding shared by the blocking and asyncio PINE clients.
+  '''
+
+  def pack(self, bits: int, n: int, *args):
+    buf = _VALUE[bits].pack(n)
+    if len(args) == 0:
+      return buf
+    else:
+      return buf + self.pack(*args)
+
+  # Unpackers are passed the reply payload, which may be a memoryview into a
+  # receive buffer that will be overwritten by the next reply; they must copy
+  # out anything they want to keep.
+
+  def unpack_empty(self, data: bytes):
+    assert len(data) == 0, f'Non-empty response: {bytes(data)}'
+    return None
+
+  def unpack_string(self, data: bytes):
+    size = _SIZE.unpack_from(data)[0]
+    assert len(data) == size+4, 'String consistency error, size=%d len(data)=%d' % (size, len(data))
+    return str(data[4:-1], errors='replace')
+
+  def unpack_float(self, data: bytes):
+    return _VALUE['f32'].unpack(data)[0]
+
+  def int_unpacker(self, bits: int):
+    return _UNPACK_INT[bits]
+
+  def encode_command(self, opcode: int, payload: bytes = b''):
+    '''
+    Encode a single command as a complete message.
+    '''
+    return _HEADER.pack(len(payload) + 5, opcode) + payload
+
+  def encode_op(self, request: bytes):
+    '''
+    Encode a single op from a batch as a complete message.
+    '''
+    return _SIZE.pack(len(request) + 4) + request
+
+  def encode_reply(self, payload: bytes = None):
+    '''
+    Encode a reply message, as the emulator would send it. A payload of None
+    means the command failed.
+    '''
+    if payload is None:
+      return _HEADER.pack(5, 0xFF)
+    return _HEADER.pack(len(payload) + 5, 0) + payload
+
+  def decode_header(self, data: bytes):
+    '''
+    Decode a reply header into (size, result). size includes the header itself.
+    '''
+    return _HEADER.unpack_from(data)
+
+  def encode_batch(self, ops):
+    '''
+    Encode a list of (request, reply_size, unpack) ops as a single message. The
+    caller is responsible for making sure it fits within MAX_IPC_SIZE and
+    MAX_IPC_RETURN_SIZE.
+    '''
+    return b''.join([_SIZE.pack(4 + sum(len(request) for request,_,_ in ops))] + [request for request,_,_ in ops])
+
+  def decode_batch(self, ops, data: bytes):
+    '''
+    Split the reply to a message created by encode_batch() into per-op results.
+    '''
+    results = []
+    offset = 0
+    for _,reply_size,unpack in ops:
+      results.append(unpack(data[offset:offset+reply_size]))
+      offset += reply_size
+    assert offset == len(data), f'Batch reply size mismatch: expected {offset}, got {len(data)}'
+    return results
+
+  def split_ops(self, body: bytes):
+    '''
+    Split the body of a message (everything after the size field) into its
+    individual encoded ops, returning a list of (request, reply_size) pairs,
+    where reply_size is None if it depends on the reply. Raises PineError on
+    unknown opcodes.
+    '''
+    ops = []
+    offset = 0
+    while offset < len(body):
+      opcode = body[offset]
+      if opcode not in _OPCODE_SIZES:
+        raise PineError(f'Unknown opcode {opcode:#04x} at offset {offset}', index=len(ops), op=opcode)
+      (args, reply_size) = _OPCODE_SIZES[opcode]
+      ops.append((bytes(body[offset:offset+1+args]), reply_size))
+      offset += 1 + args
+    return ops
+
+  def split_reply(self, ops, data: bytes):
+    '''
+    Split a reply payload into per-op slices, given the (request, reply_size)
+    pairs from split_ops().
+    '''
+    replies = []
+    offset = 0
+    for _,reply_size in ops:
+      if reply_size is None:
+        reply_size = 4 + _SIZE.unpack_from(data, offset)[0]
+      replies.append(data[offset:offset+reply_size])
+      offset += reply_size
+    assert offset == len(data), f'Reply size mismatch: expected {offset}, got {len(data)}'
+    return replies
+
+  def is_read(self, request: bytes):
+    '''
+    True if the op has no side effects on the emulator and can safely be
+    answered from a previous identical request.
+    '''
+    return request[0] <= 0x03
+
+  def plan_range(self, addr: int, size: int):
+    '''
+    Split the memory range [addr, addr+size) into naturally aligned accesses,
+    using the widest access that fits at each step: a few 1/2/4-byte accesses to
+    reach 8-byte alignment, 8-byte accesses for the bulk, and a few narrower ones
+    again for the tail. Yields (offset, width) pairs.
+    '''
+    offset = 0
+    while offset < size:
+      (a, remaining) = (addr + offset, size - offset)
+      if a % 8 == 0 and remaining >= 8:
+        # Fast path for the bulk of the range.
+        width = 8
+      else:
+        width = next(w for w in (4, 2, 1) if a % w == 0 and remaining >= w)
+      yield (offset, width)
+      offset += width
+
+  def probe_ops(self, ops):
+    '''
+    When a batch fails, the emulator carries out the ops before the failing one,
+    drops the rest, and only tells us that the message as a whole failed. To
+    find out which op it was, we can't just re-send them, since the writes
+    before the failure have already happened and may not be safe to repeat --
+    think of the lock/restore sequences in patch.py. So this yields (index,
+    request) pairs giving a stand-in for each op that has no side effects but
+    fails whenever the op would: reads are their own stand-ins, and pokes are
+    stood in for by a peek of the same address and width. Save and load state
+    have no such stand-in, and are skipped.
+    '''
+    for i,(request,_,_) in enumerate(ops):
+      opcode = request[0]
+      if 0x04 <= opcode <= 0x07:
+        yield (i, _PEEK.pack(opcode - 4, _ADDR.unpack_from(request, 1)[0]))
+      elif opcode not in (0x09, 0x0A):
+        yield (i, request)
+
+  def batch_error(self, ops, base: int, index: int = None):
+    if index is None:
+      return PineError(f'Batch of {len(ops)} commands starting at index {base} failed')
+    return PineError(
+      f'Command {ops[index][0][0]:#04x} at index {base+index} of batch failed',
+      index=base+index, op=ops[index][0][0])
+
+
+class Pine(PineCodec):
   sock: socket.socket
+  rxbuf: bytearray
+  rxview: memoryview
+  # Optional read-through cache (see pagecache.py). If set, peeks and readmem
+  # are served from it, and all writes update it.
+  cache = None
+  # PineWriteBuffer that writes are collected in while inside a combine() block.
+  writes = None
+  # Optional traffic statistics (see pinestats.py).
+  stats = None
 
   def __init__(self, path: str = None, address: str = None):
     assert path or address, "Pine requires a path or address"
@@ -30,25 +278,49 @@ class Pine:
     else:
       raise NotImplementedError
 
+    # Replies are read into this and handed back as memoryview slices of it, so
+    # receiving doesn't allocate.
+    self.rxbuf = bytearray(MAX_IPC_RETURN_SIZE)
+    self.rxview = memoryview(self.rxbuf)
+    # Everything we send goes through this, so that PineRecorder can see it.
+    self.sendall = self.sock.sendall
+
+  def close(self):
+    self.sock.close()
+
   def send(self, opcode: int, payload: bytes = b''):
-    size = len(payload) + 5
-    data = struct.pack('< I B %ds' % len(payload), size, opcode, payload)
-    # print('>>', size, opcode, data)
-    return self.sock.send(data)
+    # print('>>', opcode, payload)
+    return self.sendall(self.encode_command(opcode, payload))
 
   def recv(self):
-    header = self.sock.recv(5)
-    (size, result) = struct.unpack('< I B', header)
+    '''
+    Read a reply. Returns None if the emulator reported failure, otherwise the
+    payload, as a memoryview that is only valid until the next call to recv().
+
+    We only ever have one request in flight, so it's safe to offer the socket
+    the whole buffer; this gets small replies in a single recv_into() rather
+    than one for the header and one for the payload. recv_into() is allowed to
+    return less than we asked for, and will for any reply larger than a few KB,
+    so we keep going until we have as much as the header says we should.
+    '''
+    (received, size) = (0, 5)
+    while received < size:
+      n = self.sock.recv_into(self.rxview[received:])
+      if n == 0:
+        raise ConnectionError('PINE connection closed by emulator')
+      received += n
+      if received >= 5:
+        (size, result) = self.decode_header(self.rxbuf)
+        if size > len(self.rxbuf):
+          # Shouldn't happen with PCSX2, which caps replies at MAX_IPC_RETURN_SIZE.
+          buf = bytearray(size)
+          buf[:received] = self.rxview[:received]
+          (self.rxbuf, self.rxview) = (buf, memoryview(buf))
     if result > 0:
-      # print('<<', header, size, result)
+      # print('<<', size, result)
       return None
-    if size > 5:
-      data = self.sock.recv(size-5)
-      # print('<<', header, size, result, data)
-      return data
-    else:
-      # print('<<', header, size, result, b'')
-      return b''
+    # print('<<', size, result, bytes(self.rxview[5:size]))
+    return self.rxview[5:size]
 
   def command(self, opcode: int, unpack, payload: bytes = b''):
     self.send(opcode, payload)
@@ -56,29 +328,72 @@ class Pine:
     assert data is not None, f"Error receiving reply for command {opcode}"
     return unpack(data)
 
-  def pack(self, bits: int, n: int, *args):
-    buf = struct.pack(_INT_FORMATS[bits], n)
-    if len(args) == 0:
-      return buf
-    else:
-      return buf + self.pack(*args)
+  def roundtrip(self, message: bytes, opcode: int):
+    '''
+    Send a complete, pre-encoded single-op message and return the reply payload.
+    This is the fast path used by peek and poke.
+    '''
+    self.sendall(message)
+    data = self.recv()
+    assert data is not None, f"Error receiving reply for command {opcode}"
+    return data
 
-  def unpack_empty(self, data: bytes):
-    assert data == b'', f'Non-empty response: {data}'
-    return None
+  def tagged(self, tag: str):
+    '''
+    Context manager that attributes everything sent inside it to the named
+    subsystem, in the stats attached to this Pine. Does nothing if there aren't
+    any.
+    '''
+    if self.stats is None:
+      return _UNTAGGED
+    return self.stats.tagged(tag)
 
-  def unpack_string(self, data: bytes):
-    size = struct.unpack('< I', data[0:4])[0]
-    assert len(data) == size+4, 'String consistency error, size=%d len(data)=%d' % (size, len(data))
-    return data[4:-1].decode(errors='replace')
+  def tick(self, state = None):
+    '''
+    Called by the client at the start of each sync tick, with whatever it wants
+    to remember about the tick. Does nothing here; PineRecorder uses it to mark
+    tick boundaries in the log.
+    '''
+    pass
 
-  def unpack_float(self, data: bytes):
-    return struct.unpack('< f', data)[0]
+  def batch(self):
+    '''
+    Returns a new, empty PineBatch for this connection.
+    '''
+    return PineBatch(self)
 
-  def int_unpacker(self, bits: int):
-    def unpack_int(data: bytes):
-      return struct.unpack(_INT_FORMATS[bits], data)[0]
-    return unpack_int
+  def send_batch(self, ops, base: int = 0):
+    '''
+    Send a list of (request, reply_size, unpack) ops as a single message and
+    return the list of unpacked replies. Used by PineBatch; callers should make
+    sure the ops fit within MAX_IPC_SIZE and MAX_IPC_RETURN_SIZE.
+
+    base is the index of the first op in the enclosing batch, and is used only
+    for error reporting.
+    '''
+    self.sendall(self.encode_batch(ops))
+    data = self.recv()
+    if data is None:
+      if self.cache is not None:
+        # Some of the writes may have gone through, we don't know which.
+        self.cache.invalidate()
+      raise self.batch_error(ops, base, self.find_failure(ops))
+    if self.cache is not None:
+      for request,_,_ in ops:
+        if 0x04 <= request[0] <= 0x07:
+          self.cache.write(_ADDR.unpack_from(request, 1)[0], request[5:])
+    return self.decode_batch(ops, data)
+
+  def find_failure(self, ops):
+    '''
+    Figure out which op in a failed batch the emulator was unhappy with, by
+    sending stand-ins for them one at a time; see probe_ops().
+    '''
+    for i,request in self.probe_ops(ops):
+      self.sendall(self.encode_op(request))
+      if self.recv() is None:
+        return i
+    return None
 
   # Higher-level commands to make it easier to wiggle the game.
 
@@ -89,52 +404,325 @@ class Pine:
       self.command(0x0D, self.unpack_string),
       self.command(0x0E, self.unpack_string))
 
+  def uuid(self):
+    '''
+    Just the disc CRC from game_info(), in one round trip rather than four.
+    '''
+    return self.command(0x0D, self.unpack_string)
+
+  def combine(self):
+    '''
+    Context manager that buffers all writes made through this Pine until the
+    block exits, and then sends them as a single batch, with writes to adjacent
+    memory combined into range writes. Reads made inside the block see the
+    buffered writes. Running a batch inside the block flushes the buffer first,
+    so the batch sees (and is ordered after) everything written so far.
+
+      with pine.combine() as writes:
+        pine.poke32(addr, 1)
+        pine.poke32(addr+4, 2)  # these two go out as one poke64
+        writes.fence()
+        pine.poke32(flag, 1)  # guaranteed to be written after the others
+
+    Nested blocks share the outermost block's buffer, and only it flushes.
+    '''
+    if self.writes is not None:
+      return nullcontext(self.writes)
+    return self._combine()
+
+  @contextmanager
+  def _combine(self):
+    self.writes = PineWriteBuffer(self)
+    try:
+      yield self.writes
+    finally:
+      (writes, self.writes) = (self.writes, None)
+      writes.flush()
+
+  def flush(self):
+    '''
+    Send any writes buffered by combine() now, without leaving the block.
+    '''
+    if self.writes:
+      self.writes.flush()
+
+  def peek(self, value: struct.Struct, opcode: int, addr: int):
+    if self.writes:
+      return value.unpack(self.readmem(addr, value.size))[0]
+    if self.cache is not None:
+      return value.unpack(self.cache.read(addr, value.size))[0]
+    return value.unpack(self.roundtrip(_PEEK_MSG.pack(9, opcode, addr), opcode))[0]
+
   def peek8(self, addr):
-    return self.command(0x00, self.int_unpacker(8), self.pack(32, addr))
+    return self.peek(_VALUE[8], 0x00, addr)
   def peek16(self, addr):
-    return self.command(0x01, self.int_unpacker(16), self.pack(32, addr))
+    return self.peek(_VALUE[16], 0x01, addr)
   def peek32(self, addr):
-    return self.command(0x02, self.int_unpacker(32), self.pack(32, addr))
+    return self.peek(_VALUE[32], 0x02, addr)
   def peek64(self, addr):
-    return self.command(0x03, self.int_unpacker(64), self.pack(32, addr))
+    return self.peek(_VALUE[64], 0x03, addr)
 
   def peekf32(self, addr):
-    return self.command(0x02, self.unpack_float, self.pack(32, addr))
+    return self.peek(_VALUE['f32'], 0x02, addr)
+
+  def poke(self, message: struct.Struct, value: struct.Struct, opcode: int, addr: int, n):
+    if self.writes is not None:
+      self.writes.write(addr, value.pack(n))
+      return
+    self.unpack_empty(self.roundtrip(message.pack(message.size, opcode, addr, n), opcode))
+    if self.cache is not None:
+      self.cache.write(addr, value.pack(n))
 
   def poke8(self, addr, n):
-    return self.command(0x04, self.unpack_empty, self.pack(32, addr, 8, n))
+    return self.poke(_POKE_MSG[8], _VALUE[8], 0x04, addr, n)
   def poke16(self, addr, n):
-    return self.command(0x05, self.unpack_empty, self.pack(32, addr, 16, n))
+    return self.poke(_POKE_MSG[16], _VALUE[16], 0x05, addr, n)
   def poke32(self, addr, n):
-    return self.command(0x06, self.unpack_empty, self.pack(32, addr, 32, n))
+    return self.poke(_POKE_MSG[32], _VALUE[32], 0x06, addr, n)
   def poke64(self, addr, n):
-    return self.command(0x07, self.unpack_empty, self.pack(32, addr, 64, n))
+    return self.poke(_POKE_MSG[64], _VALUE[64], 0x07, addr, n)
 
   def pokef32(self, addr, n):
-    return self.command(0x06, self.unpack_empty, self.pack(32, addr) + struct.pack('< f', n))
+    return self.poke(_POKE_MSG['f32'], _VALUE['f32'], 0x06, addr, n)
 
   def readmem(self, addr, size):
-    buf = b''
-    while size >= 8:
-      buf = buf + self.command(0x03, lambda x: x, self.pack(32, addr))
-      addr += 8
-      size -= 8
-    while size > 0:
-      buf = buf + self.command(0x00, lambda x: x, self.pack(32, addr))
-      addr += 1
-      size -= 1
-    return buf
+    if self.cache is not None:
+      data = bytes(self.cache.read(addr, size))
+    else:
+      batch = self.batch()
+      buf = batch.readmem(addr, size)
+      batch.run(flush = False)
+      data = bytes(buf)
+    if self.writes:
+      data = self.writes.overlay(addr, data)
+    return data
 
   def writemem(self, addr, data):
-    while len(data) >= 8:
-      self.command(0x07, self.unpack_empty, self.pack(32, addr) + data[:8])
-      addr += 8
-      data = data[8:]
-    while len(data) > 0:
-      self.command(0x04, self.unpack_empty, self.pack(32, addr) + data[:1])
-      addr += 1
-      data = data[1:]
+    if self.writes is not None:
+      self.writes.write(addr, data)
+      return
+    batch = self.batch()
+    batch.writemem(addr, data)
+    batch.run()
 
   def readstring(self, addr, size):
     return self.readmem(addr, size).decode(errors='replace')
 
+
+
+class PineBatch:
+  '''
+  A queue of PINE commands to be sent to the emulator together.
+
+  Each peek and poke method queues an op and returns its index in the batch.
+  run() sends everything, in as few messages as the emulator's size limits allow,
+  and returns a list with one result per op, in the order they were queued (None
+  for pokes). The emulator executes commands in order, so pokes and peeks of the
+  same address can be freely mixed.
+
+    batch = pine.batch()
+    for addr in addrs:
+      batch.peek32(addr)
+    values = batch.run()
+
+  If a command fails, run() raises PineError with the index of the failing op.
+  '''
+  pine: PineCodec
+
+  def __init__(self, pine: PineCodec):
+    self.pine = pine
+    self.ops = []
+
+  def __len__(self):
+    return len(self.ops)
+
+  def queue(self, request: bytes, reply_size: int, unpack):
+    '''
+    Queue a raw op. request is the encoded op, starting with the opcode; unpack
+    will be called with the reply_size bytes of the reply belonging to it.
+    '''
+    self.ops.append((request, reply_size, unpack))
+    return len(self.ops) - 1
+
+  def peek8(self, addr):
+    return self.queue(_PEEK.pack(0x00, addr), 1, _UNPACK_INT[8])
+  def peek16(self, addr):
+    return self.queue(_PEEK.pack(0x01, addr), 2, _UNPACK_INT[16])
+  def peek32(self, addr):
+    return self.queue(_PEEK.pack(0x02, addr), 4, _UNPACK_INT[32])
+  def peek64(self, addr):
+    return self.queue(_PEEK.pack(0x03, addr), 8, _UNPACK_INT[64])
+
+  def peekf32(self, addr):
+    return self.queue(_PEEK.pack(0x02, addr), 4, self.pine.unpack_float)
+
+  def readmem(self, addr, size):
+    '''
+    Queue a read of an arbitrary range of memory. Unlike the other methods, this
+    returns a bytearray, which is filled in with the contents of the range when
+    the batch is run. The ops it queues all have None as their result.
+    '''
+    buf = bytearray(size)
+    view = memoryview(buf)
+    # This is the hot path for bulk reads, so it appends to the op list directly
+    # rather than going through queue(), and the per-op unpack copies the reply
+    # straight into place in buf.
+    self.ops.extend(
+      (_PEEK.pack(_PEEK_OPCODES[width], addr+offset), width,
+        partial(view.__setitem__, slice(offset, offset+width)))
+      for offset,width in self.pine.plan_range(addr, size))
+    return buf
+
+  def writemem(self, addr, data):
+    '''
+    Queue a write of an arbitrary bytes-like object to memory.
+    '''
+    data = memoryview(data)
+    self.ops.extend(
+      (_PEEK.pack(_POKE_OPCODES[width], addr+offset) + data[offset:offset+width],
+        0, self.pine.unpack_empty)
+      for offset,width in self.pine.plan_range(addr, len(data)))
+
+  def poke8(self, addr, n):
+    return self.queue(_POKE[8].pack(0x04, addr, n), 0, self.pine.unpack_empty)
+  def poke16(self, addr, n):
+    return self.queue(_POKE[16].pack(0x05, addr, n), 0, self.pine.unpack_empty)
+  def poke32(self, addr, n):
+    return self.queue(_POKE[32].pack(0x06, addr, n), 0, self.pine.unpack_empty)
+  def poke64(self, addr, n):
+    return self.queue(_POKE[64].pack(0x07, addr, n), 0, self.pine.unpack_empty)
+
+  def pokef32(self, addr, n):
+    return self.queue(_POKE['f32'].pack(0x06, addr, n), 0, self.pine.unpack_empty)
+
+  def frames(self):
+    '''
+    Split the queued ops into runs that each fit in a single message. Yields
+    (start, end) index pairs.
+    '''
+    start = 0
+    size = 4
+    reply_size = 5
+    for i,(request,reply,_) in enumerate(self.ops):
+      op_size = len(request)
+      if i > start and (size + op_size > MAX_IPC_SIZE or reply_size + reply > MAX_IPC_RETURN_SIZE):
+        yield (start, i)
+        start = i
+        size = 4
+        reply_size = 5
+      size += op_size
+      reply_size += reply
+    if start < len(self.ops):
+      yield (start, len(self.ops))
+
+  def run(self, flush: bool = True):
+    '''
+    Send all queued ops and return their results. The batch is emptied
+    afterwards and can be reused.
+
+    If the Pine is buffering writes (see Pine.combine()), they are flushed
+    first, so that the batch sees them. Pass flush=False to skip that; this is
+    only safe if the batch is all reads and the caller applies the buffered
+    writes to the results itself, as Pine.readmem() does.
+    '''
+    if flush and self.pine.writes:
+      self.pine.writes.flush()
+    results = []
+    try:
+      for start,end in self.frames():
+        results.extend(self.pine.send_batch(self.ops[start:end], start))
+    finally:
+      self.ops = []
+    return results
+
+
+class PineWriteBuffer:
+  '''
+  Collects writes so that they can be sent to the emulator together. Writes to
+  adjacent or overlapping memory are combined into a single range, which is sent
+  using the widest aligned pokes that fit (see PineBatch.writemem()), so e.g.
+  three poke32s to consecutive words go out as a poke64 and a poke32.
+
+  Writes are only combined with others in the same segment, and fence() starts a
+  new segment. Everything in one segment is written before anything in the next,
+  so code that needs the game to see writes in a particular order, like the
+  jump-to-self in Lua_GCFunction.lock(), puts fences between them. Within a
+  segment, the order in which writes reach the emulator is unspecified, but if
+  two writes overlap the later one wins.
+
+  You don't normally create these yourself; see Pine.combine().
+  '''
+  pine: Pine
+  segments: list
+
+  def __init__(self, pine: Pine):
+    self.pine = pine
+    # Each segment is a list of (addr, data) writes, in the order they were made.
+    self.segments = [[]]
+
+  def __len__(self):
+    return sum(len(segment) for segment in self.segments)
+
+  def write(self, addr: int, data: bytes):
+    self.segments[-1].append((addr, bytes(data)))
+
+  def fence(self):
+    '''
+    Start a new segment. Writes made after this are sent after all writes made
+    before it.
+    '''
+    if self.segments[-1]:
+      self.segments.append([])
+
+  def overlay(self, addr: int, data: bytes):
+    '''
+    Given the contents of memory at addr as last read from the emulator, returns
+    what it will contain once the buffered writes are flushed.
+    '''
+    end = addr + len(data)
+    buf = None
+    for segment in self.segments:
+      for waddr,wdata in segment:
+        (start, stop) = (max(addr, waddr), min(end, waddr + len(wdata)))
+        if start < stop:
+          if buf is None:
+            buf = bytearray(data)
+          buf[start-addr:stop-addr] = wdata[start-waddr:stop-waddr]
+    return data if buf is None else bytes(buf)
+
+  @staticmethod
+  def coalesce(writes):
+    '''
+    Merge a segment's writes into a list of (addr, bytearray) runs that neither
+    overlap nor touch each other, in address order.
+    '''
+    # Work out the extent of each run first, then apply the writes to them in
+    # their original order so that later writes overwrite earlier ones.
+    spans = []
+    for addr,data in sorted(writes, key = itemgetter(0)):
+      end = addr + len(data)
+      if spans and addr <= spans[-1][1]:
+        spans[-1][1] = max(spans[-1][1], end)
+      else:
+        spans.append([addr, end])
+    starts = [start for start,_ in spans]
+    runs = [(start, bytearray(end - start)) for start,end in spans]
+    for addr,data in writes:
+      (start, buf) = runs[bisect_right(starts, addr) - 1]
+      buf[addr-start:addr-start+len(data)] = data
+    return runs
+
+  def flush(self):
+    '''
+    Send all buffered writes to the emulator as a single batch and empty the
+    buffer. Returns the number of ops sent.
+    '''
+    (segments, self.segments) = (self.segments, [[]])
+    batch = self.pine.batch()
+    for segment in segments:
+      for addr,buf in self.coalesce(segment):
+        batch.writemem(addr, buf)
+    ops = len(batch)
+    # The buffer is already empty, so this doesn't need to flush it again.
+    batch.run(flush = False)
+    return ops
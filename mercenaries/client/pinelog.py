@@ -0,0 +1,235 @@
+'''
+Recording and replay of PINE sessions.
+
+PineRecorder is a Pine that also logs every message it sends and every reply it
+gets back, with timestamps, plus a marker at the start of each sync tick. The
+client does this when started with --record.
+
+ReplayPine reads such a log back and pretends to be the emulator. Rather than
+playing back the recorded replies verbatim, which would only work if the code
+under test made exactly the same requests in exactly the same order as the code
+that made the recording, it uses the log to reconstruct what game memory looked
+like during each tick, and answers whatever it's asked from that. Memory the
+recording never read reads as zeroes. This means the code being replayed can be
+changed freely -- batched differently, cached, reordered -- and still see the
+same game states; see replay.py for the driver that does this.
+
+The log format is a magic number followed by records, each of which is a fixed
+header (_RECORD) followed by the request and reply bytes. Logs with names ending
+in .gz are compressed. The recorder should be closed when done with, but the log
+is flushed at every tick marker, so even one that isn't is readable up to there.
+'''
+
+import gzip
+import json
+import struct
+import time
+from typing import Any, NamedTuple
+
+from .pine import Pine
+
+_MAGIC = b'PINELOG\x01'
+# kind, time since start of recording, request size, reply size (-1 if the
+# emulator reported failure).
+_RECORD = struct.Struct('< B d I i')
+
+KIND_EXCHANGE = 0
+KIND_TICK = 1
+
+# EE main memory size and address mask; see tools/fakepine.py.
+_EE_RAM_SIZE = 32 * 1024 * 1024
+_EE_RAM_MASK = 0x1FFFFFFF
+
+_PEEK_SIZES = { 0x00: 1, 0x01: 2, 0x02: 4, 0x03: 8 }
+_POKE_SIZES = { 0x04: 1, 0x05: 2, 0x06: 4, 0x07: 8 }
+
+
+class LogRecord(NamedTuple):
+  kind: int
+  time: float
+  # For exchanges, the complete request message. For ticks, the client state
+  # passed to tick(), as JSON.
+  request: bytes
+  # Reply payload, or None if the emulator reported failure or this is a tick.
+  reply: bytes
+
+
+def open_log(path: str, mode: str):
+  if path.endswith('.gz'):
+    return gzip.open(path, mode)
+  return open(path, mode)
+
+
+def read_log(path: str):
+  '''
+  Yields the LogRecords in a log, in order.
+
+  A log whose recorder never got closed, e.g. because the client crashed, just
+  ends at the last tick that was flushed, or wherever it was cut off.
+  '''
+  with open_log(path, 'rb') as fd:
+    assert fd.read(len(_MAGIC)) == _MAGIC, f'{path} is not a PINE log'
+    try:
+      while len(header := fd.read(_RECORD.size)) == _RECORD.size:
+        (kind, t, request_size, reply_size) = _RECORD.unpack(header)
+        request = fd.read(request_size)
+        reply = fd.read(reply_size) if reply_size >= 0 else None
+        if len(request) != request_size or (reply is not None and len(reply) != reply_size):
+          return
+        yield LogRecord(kind, t, request, reply)
+    except EOFError:
+      # Compressed log that's missing its end-of-stream marker.
+      return
+
+
+class PineRecorder(Pine):
+  '''
+  Pine that records everything it does to a log file. Takes the same arguments
+  as Pine, plus the path to write the log to.
+  '''
+  def __init__(self, log: str, **kwargs):
+    super().__init__(**kwargs)
+    self.log = open_log(log, 'wb')
+    self.log.write(_MAGIC)
+    self.start = time.perf_counter()
+    self.sent = b''
+    self.sendall = self.record_send
+
+  def record(self, kind: int, request: bytes, reply: bytes):
+    self.log.write(_RECORD.pack(
+      kind, time.perf_counter() - self.start, len(request), -1 if reply is None else len(reply)))
+    self.log.write(request)
+    if reply is not None:
+      self.log.write(reply)
+
+  def record_send(self, message: bytes):
+    self.sent = bytes(message)
+    self.sock.sendall(message)
+
+  def recv(self):
+    data = super().recv()
+    self.record(KIND_EXCHANGE, self.sent, data)
+    return data
+
+  def tick(self, state = None):
+    # Flushing here means that if we never get closed, the log is still good up
+    # to the start of the last tick.
+    self.log.flush()
+    self.record(KIND_TICK, json.dumps(state).encode(), None)
+
+  def close(self):
+    self.log.close()
+    super().close()
+
+
+class Tick(NamedTuple):
+  # Index of the tick in the log.
+  index: int
+  # When it started, in seconds since the start of the recording.
+  time: float
+  # Whatever the client passed to tick() when recording.
+  state: Any
+
+
+class ReplayPine(Pine):
+  '''
+  Pine that answers requests from game memory as reconstructed from a log made
+  by PineRecorder. Call advance() to move on to the next tick; it returns the
+  Tick, or None once the log is exhausted.
+
+  Writes made by the code being replayed are applied to the reconstructed memory,
+  and stay there until the recording shows the game overwriting them.
+  '''
+  def __init__(self, log: str):
+    self.records = read_log(log)
+    self.lookahead = None
+    self.mem = bytearray(_EE_RAM_SIZE)
+    # Replies to the game info commands, as recorded.
+    self.info = {}
+    self.ticks = 0
+    self.reply = None
+    self.sendall = self.execute
+    # Number of messages and ops answered, for benchmarking.
+    self.messages = 0
+    self.ops = 0
+
+  def next_record(self):
+    (record, self.lookahead) = (self.lookahead, None)
+    return record or next(self.records, None)
+
+  def advance(self):
+    '''
+    Bring memory up to date with everything the recording saw during the next
+    tick, and return that tick.
+    '''
+    record = self.next_record()
+    if record is None:
+      return None
+    if record.kind == KIND_TICK:
+      tick = Tick(self.ticks, record.time, json.loads(record.request))
+    else:
+      # Exchanges from before the first tick marker, when the client was
+      # connecting. They get a tick of their own with no state.
+      tick = Tick(self.ticks, record.time, None)
+      self.lookahead = record
+
+    # Bytes the recorded client wrote this tick. Reads of them later in the tick
+    # show what it wrote, not what the game did, so the code being replayed has
+    # to make those writes itself.
+    dirty = set()
+    while (record := self.next_record()) is not None:
+      if record.kind == KIND_TICK:
+        self.lookahead = record
+        break
+      self.observe(record.request, record.reply, dirty)
+
+    self.ticks += 1
+    return tick
+
+  def observe(self, message: bytes, reply: bytes, dirty: set):
+    '''
+    Update memory from a recorded exchange.
+    '''
+    if reply is None:
+      # Some unknown prefix of the ops succeeded; safest to ignore it.
+      return
+    ops = self.split_ops(message[4:])
+    for (request,_),data in zip(ops, self.split_reply(ops, reply)):
+      opcode = request[0]
+      if opcode in _PEEK_SIZES:
+        addr = int.from_bytes(request[1:5], 'little') & _EE_RAM_MASK
+        if addr + len(data) <= len(self.mem) and dirty.isdisjoint(range(addr, addr + len(data))):
+          self.mem[addr:addr+len(data)] = data
+      elif opcode in _POKE_SIZES:
+        addr = int.from_bytes(request[1:5], 'little') & _EE_RAM_MASK
+        dirty.update(range(addr, addr + _POKE_SIZES[opcode]))
+      elif 0x0B <= opcode <= 0x0E:
+        self.info[opcode] = bytes(data)
+
+  def execute(self, message: bytes):
+    '''
+    Stands in for the socket: works out the reply to a message, which the next
+    call to recv() returns.
+    '''
+    ops = self.split_ops(memoryview(message)[4:])
+    self.messages += 1
+    self.ops += len(ops)
+    reply = bytearray()
+    for request,reply_size in ops:
+      opcode = request[0]
+      if opcode in _PEEK_SIZES:
+        addr = int.from_bytes(request[1:5], 'little') & _EE_RAM_MASK
+        reply += self.mem[addr:addr+reply_size].ljust(reply_size, b'\0')
+      elif opcode in _POKE_SIZES:
+        addr = int.from_bytes(request[1:5], 'little') & _EE_RAM_MASK
+        if addr + _POKE_SIZES[opcode] <= len(self.mem):
+          self.mem[addr:addr+_POKE_SIZES[opcode]] = request[5:]
+      elif opcode in self.info:
+        reply += self.info[opcode]
+      else:
+        self.reply = None
+        return
+    self.reply = memoryview(reply)
+
+  def recv(self):
+    return self.reply
@@ -0,0 +1,205 @@
+'''
+Traffic statistics for Pine: how many ops of each kind we send, how many bytes
+they cost each way, and how long the emulator takes to answer, broken down by
+which part of the client asked.
+
+  stats = PineStats()
+  stats.attach(pine)
+  with pine.tagged('deck'):
+    ...
+  print(stats.snapshot())
+
+Attaching works by wrapping the Pine's sendall and recv, so a Pine without
+stats attached runs exactly the same code it would if this module didn't exist.
+pine.tagged() on such a Pine returns a shared do-nothing context manager.
+
+Latency is measured per message, and attributed to the opcode of the ops in it,
+or to "batch" if it contains a mix. Histograms use power-of-two buckets in
+microseconds.
+
+The client attaches stats when MERCS_DEBUG is set and logs them every tick. The
+tools do so when PINE_STATS is set, and print them on exit.
+'''
+
+import atexit
+from contextlib import contextmanager
+import os
+import time
+from typing import Dict, NamedTuple, Tuple
+
+from .pine import Pine, PineCodec
+
+OPCODE_NAMES = {
+  0x00: 'peek8', 0x01: 'peek16', 0x02: 'peek32', 0x03: 'peek64',
+  0x04: 'poke8', 0x05: 'poke16', 0x06: 'poke32', 0x07: 'poke64',
+  0x08: 'version', 0x09: 'savestate', 0x0A: 'loadstate',
+  0x0B: 'title', 0x0C: 'id', 0x0D: 'uuid', 0x0E: 'gameversion', 0x0F: 'status',
+}
+
+# Number of latency histogram buckets. Bucket n counts messages that took less
+# than 2**n microseconds (and at least 2**(n-1)); the last one catches
+# everything slower.
+_BUCKETS = 24
+
+UNTAGGED = 'other'
+
+
+class OpCounters(NamedTuple):
+  ops: int
+  # Bytes of request and reply, not counting message headers.
+  sent: int
+  received: int
+
+
+class Latency(NamedTuple):
+  messages: int
+  failures: int
+  # Total seconds spent waiting for replies.
+  total: float
+  buckets: Tuple[int, ...]
+
+  def mean(self):
+    return self.total / self.messages if self.messages else 0.0
+
+  def percentile(self, p: float):
+    '''
+    Upper bound of the histogram bucket containing the pth percentile, in
+    seconds.
+    '''
+    target = self.messages * p / 100
+    seen = 0
+    for n,count in enumerate(self.buckets):
+      seen += count
+      if count and seen >= target:
+        return (1 << n) / 1e6
+    return 0.0
+
+
+class PineStatsSnapshot(NamedTuple):
+  # Keyed by (tag, opcode).
+  ops: Dict[Tuple[str, int], OpCounters]
+  # Keyed by (tag, message kind), where the kind is an opcode name or 'batch'.
+  latency: Dict[Tuple[str, str], Latency]
+
+  def messages(self):
+    return sum(latency.messages for latency in self.latency.values())
+
+  def by_tag(self):
+    '''
+    Returns a dict of tag to (messages, ops, bytes sent, bytes received, seconds).
+    '''
+    tags = {}
+    for (tag,_),latency in self.latency.items():
+      (messages, ops, sent, received, total) = tags.get(tag, (0, 0, 0, 0, 0.0))
+      tags[tag] = (messages + latency.messages, ops, sent, received, total + latency.total)
+    for (tag,_),counters in self.ops.items():
+      (messages, ops, sent, received, total) = tags.get(tag, (0, 0, 0, 0, 0.0))
+      tags[tag] = (messages, ops + counters.ops, sent + counters.sent, received + counters.received, total)
+    return tags
+
+  def __str__(self):
+    lines = [f'{"":16s} {"msgs":>6s} {"ops":>7s} {"sent":>9s} {"recv":>9s} {"time":>9s}']
+    for tag,(messages, ops, sent, received, total) in sorted(self.by_tag().items()):
+      lines.append(f'{tag:16s} {messages:6d} {ops:7d} {sent:9d} {received:9d} {total*1000:7.1f}ms')
+    lines.append('')
+    lines.append(f'{"":28s} {"msgs":>6s} {"fail":>4s} {"mean":>9s} {"p50":>9s} {"p99":>9s}')
+    for (tag,kind),latency in sorted(self.latency.items()):
+      lines.append(
+        f'{tag+"/"+kind:28s} {latency.messages:6d} {latency.failures:4d} '
+        f'{latency.mean()*1000:7.3f}ms {latency.percentile(50)*1000:7.3f}ms {latency.percentile(99)*1000:7.3f}ms')
+    return '\n'.join(lines)
+
+
+class PineStats(PineCodec):
+  pine: Pine
+
+  def __init__(self):
+    self.pine = None
+    self.tags = []
+    # The message waiting for a reply, as (tag, kind, ops, time sent).
+    self.inflight = None
+    self.reset()
+
+  def reset(self):
+    # Mutable versions of the snapshot contents: [ops, sent, received] and
+    # [messages, failures, total, buckets].
+    self.ops = {}
+    self.latency = {}
+
+  def attach(self, pine: Pine):
+    '''
+    Start collecting stats for everything sent through pine.
+    '''
+    (sendall, recv) = (pine.sendall, pine.recv)
+    def sendall_counted(message):
+      self.sending(message)
+      return sendall(message)
+    def recv_counted():
+      data = recv()
+      self.received(data)
+      return data
+    (pine.sendall, pine.recv) = (sendall_counted, recv_counted)
+    pine.stats = self
+    self.pine = pine
+    return self
+
+  @contextmanager
+  def tagged(self, tag: str):
+    self.tags.append(tag)
+    try:
+      yield self
+    finally:
+      self.tags.pop()
+
+  def sending(self, message: bytes):
+    tag = self.tags[-1] if self.tags else UNTAGGED
+    ops = self.split_ops(memoryview(message)[4:])
+    for request,_ in ops:
+      counters = self.ops.setdefault((tag, request[0]), [0, 0, 0])
+      counters[0] += 1
+      counters[1] += len(request)
+    opcodes = {request[0] for request,_ in ops}
+    kind = OPCODE_NAMES[opcodes.pop()] if len(opcodes) == 1 else 'batch'
+    self.inflight = (tag, kind, ops, time.perf_counter())
+
+  def received(self, data: bytes):
+    (tag, kind, ops, sent) = self.inflight
+    elapsed = time.perf_counter() - sent
+    self.inflight = None
+
+    latency = self.latency.setdefault((tag, kind), [0, 0, 0.0, [0] * _BUCKETS])
+    latency[0] += 1
+    latency[2] += elapsed
+    latency[3][min(int(elapsed * 1e6).bit_length(), _BUCKETS - 1)] += 1
+    if data is None:
+      latency[1] += 1
+      return
+    for (request,_),reply in zip(ops, self.split_reply(ops, data)):
+      self.ops.setdefault((tag, request[0]), [0, 0, 0])[2] += len(reply)
+
+  def snapshot(self):
+    return PineStatsSnapshot(
+      { key: OpCounters(*counters) for key,counters in self.ops.items() },
+      { key: Latency(messages, failures, total, tuple(buckets))
+        for key,(messages, failures, total, buckets) in self.latency.items() })
+
+  def advance(self):
+    '''
+    Returns a snapshot of everything so far, and starts counting again from
+    zero.
+    '''
+    snapshot = self.snapshot()
+    self.reset()
+    return snapshot
+
+
+def attach_from_env(pine: Pine):
+  '''
+  For tools: if PINE_STATS is set in the environment, attach stats to pine and
+  print them when the program exits.
+  '''
+  if 'PINE_STATS' not in os.environ:
+    return None
+  stats = PineStats().attach(pine)
+  atexit.register(lambda: print(stats.snapshot()))
+  return stats
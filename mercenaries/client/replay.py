@@ -0,0 +1,136 @@
+'''
+Replay a recorded play session against MercenariesIPC and MercenariesConnector.
+
+Record a session by starting the client with --record FILE (end it in .gz to
+compress it), then play normally for as long as you like. Replaying it runs
+the same calls the client made each tick -- send_items(), then
+get_checks_and_hints() -- with the same inputs, against game memory as it was
+during that tick, and reports how long they took and how many PINE round trips
+they needed. The log doesn't need to have been recorded by the same version of
+the code; see pinelog.py for how that works.
+
+  python -m worlds.mercenaries.client.replay FILE [--speed N] [--verbose] [--stats]
+
+--speed 1 replays in real time, with ticks as far apart as they were when
+recorded; the default of 0 replays as fast as possible.
+'''
+
+import argparse
+from collections import Counter
+import random
+import statistics
+import sys
+import time
+from typing import NamedTuple
+
+from .lua import LuaTypeError
+from .MercenariesConnector import MercenariesConnector
+from .MercenariesIPC import MercenariesIPC, IPCError
+from .pinelog import ReplayPine
+from .pinestats import PineStats
+
+
+class ReplayItem(NamedTuple):
+  '''
+  Stands in for a NetworkItem in the client's items_received; the connector only
+  looks at the item ID.
+  '''
+  item: int
+
+
+class TickResult(NamedTuple):
+  index: int
+  # Seconds spent in the connector.
+  elapsed: float
+  # Messages and ops sent to the emulator.
+  messages: int
+  ops: int
+  # Name of the exception that ended the tick early, if any.
+  error: str
+
+
+def replay_tick(connector: MercenariesConnector, state):
+  connector.begin_tick()
+  connector.send_items(
+    [ReplayItem(item) for item in state['items']],
+    Counter({int(k): v for k,v in state['sent_items'].items()}))
+  connector.get_checks_and_hints(set(state['missing']), state['slot_data']['hints_from_cards'])
+  connector.get_hintable_checks(set(state['checked']), set(state['missing']))
+
+
+def replay(log: str, speed: float = 0, stats: PineStats = None):
+  '''
+  Replay a log, yielding a TickResult for each tick. If stats is set, it's
+  attached to the replaying Pine.
+  '''
+  # The connector picks coupons at random, and we want runs to be comparable.
+  random.seed(0)
+  pine = ReplayPine(log)
+  if stats:
+    stats.attach(pine)
+  ipc = MercenariesIPC(pine=pine)
+  connector = None
+  start = None
+
+  while (tick := pine.advance()) is not None:
+    if tick.state is None:
+      continue
+    if connector is None:
+      connector = MercenariesConnector(None, ipc, tick.state['slot_data'])
+      start = (time.perf_counter(), tick.time)
+    elif speed:
+      delay = start[0] + (tick.time - start[1]) / speed - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+
+    (messages, ops) = (pine.messages, pine.ops)
+    error = None
+    t = time.perf_counter()
+    try:
+      replay_tick(connector, tick.state)
+    except (IPCError, LuaTypeError) as e:
+      # Game wasn't in a state we can talk to it in; the client just waits.
+      error = type(e).__name__
+    except Exception as e:
+      # Same recovery as the client.
+      error = type(e).__name__
+      ipc.clear_handles()
+    yield TickResult(
+      tick.index, time.perf_counter() - t,
+      pine.messages - messages, pine.ops - ops, error)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog='replay')
+  parser.add_argument('log', help='PINE log recorded with the client\'s --record option')
+  parser.add_argument('--speed', type=float, default=0,
+    help='Replay speed relative to the recording, or 0 to go as fast as possible')
+  parser.add_argument('--verbose', action='store_true', help='Report on every tick')
+  parser.add_argument('--stats', action='store_true', help='Report PINE traffic by subsystem')
+  args = parser.parse_args(argv)
+
+  stats = PineStats() if args.stats else None
+  results = []
+  for result in replay(args.log, args.speed, stats):
+    results.append(result)
+    if args.verbose:
+      print(f'tick {result.index}: {result.elapsed*1000:.2f}ms, '
+        f'{result.messages} messages, {result.ops} ops{result.error and f' ({result.error})' or ''}')
+
+  if not results:
+    print('No ticks in log.')
+    return
+  times = [result.elapsed * 1000 for result in results]
+  errors = Counter(result.error for result in results if result.error)
+  print(f'{len(results)} ticks, {sum(times):.1f}ms total')
+  print(f'  per tick: {statistics.mean(times):.2f}ms mean, {statistics.median(times):.2f}ms median, {max(times):.2f}ms max')
+  print(f'  {sum(r.messages for r in results)} messages, {sum(r.ops for r in results)} ops')
+  for error,count in errors.most_common():
+    print(f'  {count} ticks ended with {error}')
+  if stats:
+    print()
+    print(stats.snapshot())
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
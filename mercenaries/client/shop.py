@@ -10,6 +10,12 @@ class ShopUnlock(NamedTuple):
   price: MemVarInt
   new: MemVarInt
 
+class ShopCounts(NamedTuple):
+  unlocks: int
+  vehicles: int
+  supplies: int
+  airstrikes: int
+
 class MafiaShop:
   pine: Pine
 
@@ -26,24 +32,52 @@ class MafiaShop:
     self.airstrike_count = MemVarInt(pine, METADATA_PTR+12)
     self.unlocks = MemVarArray(pine, mkUnlock, UNLOCK_PTR, 12, NROF_UNLOCKS)
 
+  def queue_counts(self, batch):
+    '''
+    Queue reads of the shop metadata on batch. Returns a function that takes the
+    batch's results and returns them as ShopCounts.
+    '''
+    first = len(batch)
+    for count in [self.unlock_count, self.vehicle_count, self.supplies_count, self.airstrike_count]:
+      batch.peek32(count.addr)
+    return lambda results: ShopCounts(*results[first:first+4])
+
   def clear_unlocks(self):
     self.update_counts([])
 
+  def counts_for(self, unlocks: List) -> ShopCounts:
+    '''
+    The shop metadata the game should have for the given unlocks.
+    '''
+    return ShopCounts(
+      len(unlocks),
+      sum(1 for ul in unlocks if 'vehicle' in ul.groups()),
+      sum(1 for ul in unlocks if 'supplies' in ul.groups()),
+      sum(1 for ul in unlocks if 'airstrike' in ul.groups()))
+
   def update_counts(self, unlocks: List):
-    self.vehicle_count(sum(1 for ul in unlocks if 'vehicle' in ul.groups()))
-    self.supplies_count(sum(1 for ul in unlocks if 'supplies' in ul.groups()))
-    self.airstrike_count(sum(1 for ul in unlocks if 'airstrike' in ul.groups()))
-    self.unlock_count(len(unlocks))
+    counts = self.counts_for(unlocks)
+    with self.pine.tagged('shop'), self.pine.combine():
+      self.pine.poke32(self.vehicle_count.addr, counts.vehicles)
+      self.pine.poke32(self.supplies_count.addr, counts.supplies)
+      self.pine.poke32(self.airstrike_count.addr, counts.airstrikes)
+      self.pine.poke32(self.unlock_count.addr, counts.unlocks)
 
   def set_unlocks(self, unlocks: List):
-    # old_count = self.unlock_count()
-    self.unlock_count(0)
+    # This all goes out as a single message, so the game never sees the shop in
+    # a half-updated state. The fences make sure the unlock count is zeroed
+    # before the list is touched, and only set again once it's complete; the
+    # list itself is contiguous, so it gets combined into poke64s.
+    with self.pine.tagged('shop'), self.pine.combine() as writes:
+      self.pine.poke32(self.unlock_count.addr, 0)
+      writes.fence()
 
-    for idx,unlock in enumerate(unlocks):
-      # TODO: this only sets the price as displayed, not the price as billed; the player
-      # is still charged full price (modulated by faction discounts) once it's in the quickbar.
-      self.unlocks[idx].tag(unlock.tag)
-      self.unlocks[idx].price(unlock.price)
-      self.unlocks[idx].new(0) # TODO: maybe set this for new items (which aren't neccessarily at tail)
+      for idx,unlock in enumerate(unlocks):
+        # TODO: this only sets the price as displayed, not the price as billed; the player
+        # is still charged full price (modulated by faction discounts) once it's in the quickbar.
+        self.pine.poke32(self.unlocks[idx].tag.addr, unlock.tag)
+        self.pine.poke32(self.unlocks[idx].price.addr, unlock.price)
+        self.pine.poke32(self.unlocks[idx].new.addr, 0) # TODO: maybe set this for new items (which aren't neccessarily at tail)
 
-    self.update_counts(unlocks)
+      writes.fence()
+      self.update_counts(unlocks)
@@ -11,31 +11,81 @@ class PDAStats:
       for name,addr in BOUNTY_IDX_ADDRS.items()
     }
 
+  def read_destruction(self):
+    batch = self.pine.batch()
+    for count in self.destruction:
+      batch.peekf32(count.addr)
+    with self.pine.tagged('stats'):
+      return batch.run()
+
   def vehicles_destroyed(self):
     return {
       VEHICLE_NAMES[idx]
-      for idx,count in enumerate(self.destruction)
-      if count() > 0
+      for idx,count in enumerate(self.read_destruction())
+      if count > 0
     }
 
   def vehicles_destroyed_count(self):
     return {
-      VEHICLE_NAMES[idx]: count()
-      for idx,count in enumerate(self.destruction)
-      if count() > 0
+      VEHICLE_NAMES[idx]: count
+      for idx,count in enumerate(self.read_destruction())
+      if count > 0
     }
 
-  def read_bounty_count(self, idx):
-    if idx == 0:
-      return 0
-    buf = self.pine.readmem(BOUNTY_BUF_ADDR + idx, 8)
+  def parse_bounty_count(self, buf):
     buf = buf[:buf.find(0)]
     if len(buf) == 0:
       return 0
     return int(buf.decode())
 
+  def read_bounty_count(self, idx):
+    if idx == 0:
+      return 0
+    with self.pine.tagged('stats'):
+      return self.parse_bounty_count(self.pine.readmem(BOUNTY_BUF_ADDR + idx, 8))
+
   def bounties_found(self):
-    return {
-      name: self.read_bounty_count(idx())
-      for name,idx in self.bounties.items()
+    batch = self.pine.batch()
+    finish = self.queue_bounties(batch)
+    with self.pine.tagged('stats'):
+      return finish(batch.run())[1]
+
+  def queue_bounties(self, batch, previous = None):
+    '''
+    Queue the reads for bounties_found() on batch, so they can go out along with
+    other things. Returns a function that takes the batch's results and returns
+    (indexes, counts), where indexes are the indexes into the bounty string
+    buffer.
+
+    Finding the counts takes two passes: one to read all the indexes, and then
+    one to read all the strings they point to. If previous is the indexes from
+    last time, the strings they pointed to are read along with the indexes; any
+    index that hasn't changed since doesn't need the second pass.
+    '''
+    ops = { name: batch.peek16(idx.addr) for name,idx in self.bounties.items() }
+    guesses = {
+      name: batch.readmem(BOUNTY_BUF_ADDR + idx, 8)
+      for name,idx in (previous or {}).items()
+      if idx != 0
     }
+
+    def finish(results):
+      indexes = { name: results[op] for name,op in ops.items() }
+      bufs = {
+        name: guesses[name]
+        for name,idx in indexes.items()
+        if name in guesses and idx == previous[name]
+      }
+      batch = self.pine.batch()
+      bufs.update({
+        name: batch.readmem(BOUNTY_BUF_ADDR + idx, 8)
+        for name,idx in indexes.items()
+        if idx != 0 and name not in bufs
+      })
+      if len(batch):
+        batch.run()
+      return (indexes, {
+        name: self.parse_bounty_count(bufs[name]) if idx != 0 else 0
+        for name,idx in indexes.items()
+      })
+    return finish
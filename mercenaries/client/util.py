@@ -1,3 +1,4 @@
+from collections.abc import Sequence
 from typing import Any, NamedTuple
 
 from .pine import Pine
@@ -56,6 +57,34 @@ def MemVarArray(pine: Pine, T: Any, base_ptr: int, size: int, count: int):
     ]
   ]
 
+class LazyMemVarArray(Sequence):
+  '''
+  Like MemVarArray, but elements are only created when first accessed. For
+  arrays where constructing an element reads memory, or that are large and
+  usually only looked at in a few places.
+  '''
+  def __init__(self, pine: Pine, T: Any, base_ptr: int, size: int, count: int):
+    self.pine = pine
+    self.T = T
+    self.base_ptr = base_ptr
+    self.size = size
+    self.count = count
+    self.elements = {}
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      return [self[i] for i in range(*idx.indices(self.count))]
+    if idx < 0:
+      idx += self.count
+    if not 0 <= idx < self.count:
+      raise IndexError(f'index {idx} out of range for array of {self.count}')
+    if idx not in self.elements:
+      self.elements[idx] = self.T(self.pine, self.base_ptr + idx*self.size)
+    return self.elements[idx]
+
 def chapter_to_suit(chapter):
   # clubs are both 0 (tutorial) and 1
   return ['clubs', 'clubs', 'diamonds', 'hearts', 'spades'][chapter]
@@ -7,5 +7,13 @@ match sys.argv[1]:
     from . import watch
   case 'inspect':
     from . import inspect
+  case 'proxy':
+    from . import proxy
+  case 'fakepine':
+    from . import fakepine
+  case 'heap':
+    from . import heap
+  case 'snapshot':
+    from . import snapshot
 
 sys.exit(0)
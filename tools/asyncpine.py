@@ -0,0 +1 @@
+../mercenaries/client/asyncpine.py
\ No newline at end of file
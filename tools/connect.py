@@ -0,0 +1,17 @@
+'''
+Shared setup for the tools that talk to the emulator.
+
+  PINE_PATH   socket to connect to instead of the default, e.g. the --listen
+              socket of 'python -m tools proxy'
+  PINE_STATS  if set, print a summary of PINE traffic on exit
+'''
+
+import os
+
+from .pine import Pine
+from .pinestats import attach_from_env
+
+def connect() -> Pine:
+  pcsx2 = Pine(path = os.environ.get('PINE_PATH', '/run/user/8509/pcsx2.sock'))
+  attach_from_env(pcsx2)
+  return pcsx2
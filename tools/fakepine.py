@@ -0,0 +1,195 @@
+'''
+Stand-in for PCSX2's PINE server, backed by a memory image rather than a running
+game.
+
+Serves peeks and pokes from a copy of EE RAM, which can be loaded from a raw dump
+or straight out of a PCSX2 savestate, and answers the game info commands as if
+Mercenaries were running. Anything that talks to PCSX2 -- the client, the other
+tools, the proxy -- can be pointed at it instead, which makes it possible to test
+and benchmark IPC code without the emulator.
+
+  python -m tools fakepine [--listen PATH|HOST:PORT] [--image FILE] [--latency MS] [--rtt MS] [--uuid CRC]
+
+--image accepts either a raw 32MB RAM dump or a .p2s savestate. Without it, memory
+is all zeroes, which is enough for benchmarking but not for anything that expects
+to find the game in there.
+
+--latency delays each reply by that long per op in the message, and --rtt by
+that long per message, to approximate talking to a real emulator that's busy
+running the game.
+'''
+
+import argparse
+import asyncio
+import os
+import struct
+import sys
+import zipfile
+
+from .pine import PineCodec, PineError, PineStatus
+
+# Size of EE main memory.
+EE_RAM_SIZE = 32 * 1024 * 1024
+
+# Game info for the US release. The disc CRC is a placeholder; use --uuid to
+# match whatever your copy reports.
+DEFAULT_STATUS = PineStatus('Mercenaries - Playground of Destruction', 'SLUS-20932', '00000000', '1.00')
+
+_PEEK_SIZES = { 0x00: 1, 0x01: 2, 0x02: 4, 0x03: 8 }
+_POKE_SIZES = { 0x04: 1, 0x05: 2, 0x06: 4, 0x07: 8 }
+
+
+def load_image(path: str):
+  '''
+  Load an EE RAM image from a raw dump or a PCSX2 savestate. Savestates are zip
+  files with main memory stored as eeMemory.bin.
+  '''
+  if zipfile.is_zipfile(path):
+    with zipfile.ZipFile(path) as p2s:
+      data = p2s.read('eeMemory.bin')
+  else:
+    with open(path, 'rb') as fd:
+      data = fd.read()
+  assert len(data) <= EE_RAM_SIZE, f'{path} is too large to be an EE RAM image ({len(data)} bytes)'
+  mem = bytearray(EE_RAM_SIZE)
+  mem[:len(data)] = data
+  return mem
+
+
+class FakePine(PineCodec):
+  mem: bytearray
+  status: PineStatus
+  latency: float
+  rtt: float
+
+  def __init__(self, mem: bytearray = None, status: PineStatus = DEFAULT_STATUS,
+               latency: float = 0, rtt: float = 0):
+    self.mem = mem if mem is not None else bytearray(EE_RAM_SIZE)
+    self.status = status
+    self.latency = latency
+    self.rtt = rtt
+    self.clients = 0
+    self.messages = 0
+    self.ops = 0
+
+  def translate(self, addr: int, size: int):
+    '''
+    Convert an EE virtual address to an offset into mem. Main memory is mirrored
+    at several places in the address space (kseg0, kseg1, the uncached views),
+    which all differ only in the top three bits. Returns None for anything that
+    isn't main memory, which the real server would either fail or read from some
+    other device we don't emulate.
+    '''
+    offset = addr & 0x1FFFFFFF
+    if offset + size > len(self.mem):
+      return None
+    return offset
+
+  def string(self, s: str):
+    data = s.encode() + b'\0'
+    return struct.pack('< I', len(data)) + data
+
+  def execute(self, body: bytes):
+    '''
+    Run all the ops in a message and return the reply payload, or None if any
+    of them failed. Like PCSX2, ops before the failing one still take effect.
+    '''
+    try:
+      ops = self.split_ops(body)
+    except PineError:
+      return None
+
+    reply = bytearray()
+    self.ops += len(ops)
+    for request,_ in ops:
+      opcode = request[0]
+      if opcode in _PEEK_SIZES:
+        size = _PEEK_SIZES[opcode]
+        offset = self.translate(int.from_bytes(request[1:5], 'little'), size)
+        if offset is None:
+          return None
+        reply += self.mem[offset:offset+size]
+      elif opcode in _POKE_SIZES:
+        size = _POKE_SIZES[opcode]
+        offset = self.translate(int.from_bytes(request[1:5], 'little'), size)
+        if offset is None:
+          return None
+        self.mem[offset:offset+size] = request[5:5+size]
+      elif opcode == 0x08:
+        reply += self.string('PCSX2 fakepine')
+      elif 0x0B <= opcode <= 0x0E:
+        reply += self.string(self.status[opcode - 0x0B])
+      elif opcode == 0x0F:
+        # Emulator status: 0 = running
+        reply += struct.pack('< I', 0)
+      else:
+        # Save/load state; nothing sensible we can do.
+        return None
+    return reply
+
+  async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    self.clients += 1
+    print(f'Client connected ({self.clients} total)')
+    try:
+      while True:
+        size = int.from_bytes(await reader.readexactly(4), 'little')
+        body = await reader.readexactly(size - 4)
+        self.messages += 1
+        ops = self.ops
+        reply = self.execute(body)
+        if self.latency or self.rtt:
+          await asyncio.sleep(self.rtt + self.latency * (self.ops - ops))
+        writer.write(self.encode_reply(reply))
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      self.clients -= 1
+      print(f'Client disconnected ({self.clients} remaining)')
+      writer.close()
+
+  def summary(self):
+    return f'{self.messages} messages, {self.ops} ops'
+
+
+async def serve(fake: FakePine, listen: str):
+  if listen.startswith('/'):
+    if os.path.exists(listen):
+      os.unlink(listen)
+    server = await asyncio.start_unix_server(fake.handle_client, path=listen)
+  else:
+    (host, port) = listen.split(':')
+    server = await asyncio.start_server(fake.handle_client, host, int(port))
+  print(f'Serving {fake.status.id} on {listen}')
+
+  try:
+    async with server:
+      await server.serve_forever()
+  finally:
+    print(fake.summary())
+
+
+def main(argv):
+  runtime_dir = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+  parser = argparse.ArgumentParser(prog='python -m tools fakepine')
+  parser.add_argument('--listen', default=os.path.join(runtime_dir, 'pcsx2-fake.sock'),
+    help='Absolute path (unix) or host:port (windows) to accept clients on')
+  parser.add_argument('--image',
+    help='EE RAM dump or .p2s savestate to load memory from')
+  parser.add_argument('--latency', type=float, default=0,
+    help='Milliseconds of delay to add per op')
+  parser.add_argument('--rtt', type=float, default=0,
+    help='Milliseconds of delay to add per message')
+  parser.add_argument('--uuid', default=DEFAULT_STATUS.uuid,
+    help='Disc CRC to report as the game UUID')
+  args = parser.parse_args(argv)
+
+  mem = load_image(args.image) if args.image else None
+  status = DEFAULT_STATUS._replace(uuid=args.uuid)
+  fake = FakePine(mem, status, latency=args.latency / 1000, rtt=args.rtt / 1000)
+  try:
+    asyncio.run(serve(fake, args.listen))
+  except KeyboardInterrupt:
+    pass
+
+main(sys.argv[2:])
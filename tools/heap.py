@@ -0,0 +1,17 @@
+import time
+
+from .connect import connect
+from .luaheap import LuaHeap
+from .pine import Pine
+
+pcsx2: Pine = connect()
+
+print(pcsx2.game_info())
+
+Lptr = pcsx2.peek32(0x0056CBD0)
+print(f'L is at: {Lptr:08X}')
+
+t = time.perf_counter()
+heap = LuaHeap(pcsx2, Lptr)
+print(f'Walked {len(heap.objects)} objects in {time.perf_counter() - t:.2f}s ({heap.reads} chunk reads)')
+print(heap)
@@ -1,10 +1,21 @@
+import argparse
 import socket
 import struct
+import sys
+import time
 
+from .connect import connect
 from .lua import TObject, GCObject
+from .luadump import dump, write_binary, write_jsonl
 from .pine import Pine
 
-pcsx2: Pine = Pine(path = '/run/user/8509/pcsx2.sock')
+parser = argparse.ArgumentParser(prog='python -m tools inspect')
+parser.add_argument('--format', choices=['text', 'jsonl', 'binary'], default='text',
+  help='text is the traditional indented dump; jsonl and binary are streams of records (see luadump.py)')
+parser.add_argument('--output', help='File to write jsonl/binary dumps to')
+args = parser.parse_args(sys.argv[2:])
+
+pcsx2: Pine = connect()
 
 print(pcsx2.game_info())
 
@@ -21,6 +32,18 @@ def peek8assert(addr, val, reason):
 Lptr = pcsx2.peek32(0x0056CBD0)
 print(f'L is at: {Lptr:08X}')
 
+if args.format != 'text':
+  assert args.output, '--output is required for jsonl and binary dumps'
+  t = time.perf_counter()
+  if args.format == 'jsonl':
+    with open(args.output, 'w') as fd:
+      count = write_jsonl(dump(pcsx2, Lptr), fd)
+  else:
+    with open(args.output, 'wb') as fd:
+      count = write_binary(dump(pcsx2, Lptr), fd)
+  print(f'Wrote {count} records to {args.output} in {time.perf_counter() - t:.2f}s')
+  sys.exit(0)
+
 L = GCObject(pcsx2, Lptr)
 assert L.tt == 8, 'L must be LUA_TTHREAD'
 assert L._G.tt() == 5, 'L->gt must be LUA_TTABLE'
@@ -0,0 +1 @@
+../mercenaries/client/luadb.py
\ No newline at end of file
@@ -0,0 +1 @@
+../mercenaries/client/luadump.py
\ No newline at end of file
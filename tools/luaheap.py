@@ -0,0 +1 @@
+../mercenaries/client/luaheap.py
\ No newline at end of file
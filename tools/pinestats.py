@@ -0,0 +1 @@
+../mercenaries/client/pinestats.py
\ No newline at end of file
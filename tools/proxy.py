@@ -0,0 +1,280 @@
+'''
+PINE multiplexing proxy.
+
+Owns the single PINE connection to PCSX2 and accepts any number of local
+clients, speaking PINE to both sides, so that the AP client and any number of
+tools can talk to the game at once without each opening their own connection.
+
+Requests from different clients that arrive together (in the same pass through
+the event loop, or within --window milliseconds of each other) are merged into
+one message upstream. Identical reads in the same merged message are only sent
+to the emulator once, unless there's a write between them.
+
+  python -m tools proxy [--pcsx2 PATH|HOST:PORT] [--listen PATH|HOST:PORT] [--window MS]
+
+Then point the client's --pcsx2, or a tool's PINE_PATH, at the --listen socket.
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+
+from .asyncpine import AsyncPine
+from .pine import MAX_IPC_SIZE, MAX_IPC_RETURN_SIZE, PineCodec, PineError
+
+# Space to budget for a string reply (game title etc) when deciding whether
+# merged messages will fit in the emulator's reply limit.
+_STRING_REPLY_SIZE = 1024
+
+
+class PineProxy(PineCodec):
+  upstream: AsyncPine
+  window: float
+
+  def __init__(self, upstream: AsyncPine, window: float = 0):
+    self.upstream = upstream
+    self.window = window
+    # Requests waiting for the next flush, as (ops, future) pairs.
+    self.queue = []
+    self.flush_task = None
+    self.clients = 0
+    self.requests = 0
+    self.messages = 0
+    self.deduped = 0
+
+  async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    self.clients += 1
+    print(f'Client connected ({self.clients} total)')
+    try:
+      while True:
+        size = int.from_bytes(await reader.readexactly(4), 'little')
+        body = await reader.readexactly(size - 4)
+        writer.write(self.encode_reply(await self.submit(body)))
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      self.clients -= 1
+      print(f'Client disconnected ({self.clients} remaining)')
+      writer.close()
+
+  async def submit(self, body: bytes):
+    '''
+    Queue a client's message for the next flush and wait for its reply payload.
+    '''
+    self.requests += 1
+    try:
+      ops = self.split_ops(body)
+    except PineError:
+      # Something we don't know how to take apart, so we can't merge it.
+      self.messages += 1
+      return await self.upstream.request((len(body) + 4).to_bytes(4, 'little') + body)
+
+    future = asyncio.get_running_loop().create_future()
+    self.queue.append((ops, future))
+    if self.flush_task is None:
+      self.flush_task = asyncio.create_task(self.flush())
+    return await future
+
+  async def flush(self):
+    # Give any other clients with requests ready a chance to queue them.
+    await asyncio.sleep(self.window)
+    (queue, self.queue, self.flush_task) = (self.queue, [], None)
+
+    groups = [[]]
+    (size, reply_size) = (4, 5)
+    for ops,future in queue:
+      op_size = sum(len(request) for request,_ in ops)
+      op_reply = sum(_STRING_REPLY_SIZE if reply is None else reply for _,reply in ops)
+      if groups[-1] and (size + op_size > MAX_IPC_SIZE or reply_size + op_reply > MAX_IPC_RETURN_SIZE):
+        groups.append([])
+        (size, reply_size) = (4, 5)
+      groups[-1].append((ops, future))
+      size += op_size
+      reply_size += op_reply
+
+    await asyncio.gather(*[self.send_group(group) for group in groups])
+
+  async def send_group(self, group):
+    '''
+    Send a group of client requests as one message and hand each client its
+    share of the reply.
+    '''
+    merged = []
+    # Index in merged of the first copy of each read, since the last write.
+    seen = {}
+    # For each client, the indexes in merged of the replies it wants.
+    wanted = []
+    # For each client, the range of merged that its own ops went into.
+    spans = []
+    for ops,_ in group:
+      indexes = []
+      start = len(merged)
+      for request,reply_size in ops:
+        if not self.is_read(request):
+          seen = {}
+        elif request in seen:
+          self.deduped += 1
+          indexes.append(seen[request])
+          continue
+        else:
+          seen[request] = len(merged)
+        indexes.append(len(merged))
+        merged.append((request, reply_size))
+      wanted.append(indexes)
+      spans.append((start, len(merged)))
+
+    try:
+      self.messages += 1
+      data = await self.upstream.request(self.encode_batch(
+        [(request, reply_size, None) for request,reply_size in merged]))
+      if data is None:
+        # Someone's request made the emulator unhappy.
+        await self.recover(group, merged, wanted, spans)
+        return
+      replies = self.split_reply(merged, data)
+    except Exception as e:
+      for _,future in group:
+        if not future.done():
+          future.set_exception(e)
+      return
+
+    for (_,future),indexes in zip(group, wanted):
+      if not future.cancelled():
+        future.set_result(b''.join(replies[i] for i in indexes))
+
+  async def recover(self, group, merged, wanted, spans):
+    '''
+    Sort out a merged message that the emulator failed. It ran every op before
+    the failing one and none after, so we can't just re-send everyone's requests
+    separately: writes that already landed would happen twice, which for things
+    like the lock/restore sequences in patch.py is not harmless. Instead we find
+    the failing op without re-sending any writes, the same way Pine does (see
+    PineCodec.probe_ops()), and then:
+    - the client it belongs to gets the failure;
+    - clients whose ops all came after it never ran, and are re-sent;
+    - clients whose ops all came before it succeeded, and get their reads
+      answered by reading again. If one of those reads was overwritten by a
+      write that landed after it, its original value is gone, and that client
+      gets the failure too, same as if its own message had failed partway.
+    If we can't find the failing op, we don't know what ran, so everyone gets
+    the failure.
+    '''
+    self.messages += 1
+    failed = await self.upstream.find_failure(
+      [(request, reply_size, None) for request,reply_size in merged])
+
+    def fail(future):
+      if not future.cancelled():
+        future.set_result(None)
+
+    if failed is None:
+      for _,future in group:
+        fail(future)
+      return
+
+    # Memory written by the ops that landed, and the first index that wrote it.
+    written = []
+    for i,(request,_) in enumerate(merged[:failed]):
+      if 0x04 <= request[0] <= 0x07:
+        addr = int.from_bytes(request[1:5], 'little')
+        written.append((i, addr, addr + (1 << (request[0] & 3))))
+    def clobbered(i):
+      request = merged[i][0]
+      if request[0] > 0x03:
+        return False
+      addr = int.from_bytes(request[1:5], 'little')
+      end = addr + (1 << request[0])
+      return any(j > i and start < end and addr < stop for j,start,stop in written)
+
+    (done, resend, reread) = ([], [], set())
+    for (ops,future),indexes,(start,end) in zip(group, wanted, spans):
+      if start > failed:
+        resend.append((ops, future))
+      elif end > failed or any(clobbered(i) for i in indexes):
+        fail(future)
+      else:
+        done.append((future, indexes))
+        # Pokes and savestate ops have empty replies; everything else is a
+        # read of some kind.
+        reread.update(i for i in indexes if merged[i][1] != 0)
+
+    replies = { i: b'' for _,indexes in done for i in indexes }
+    if reread:
+      reread = sorted(reread)
+      ops = [merged[i] for i in reread]
+      self.messages += 1
+      data = await self.upstream.request(self.encode_batch(
+        [(request, reply_size, None) for request,reply_size in ops]))
+      if data is None:
+        for future,_ in done:
+          fail(future)
+        done = []
+      else:
+        replies.update(zip(reread, self.split_reply(ops, data)))
+
+    for future,indexes in done:
+      if not future.cancelled():
+        future.set_result(b''.join(replies[i] for i in indexes))
+    await asyncio.gather(*[self.send_alone(ops, future) for ops,future in resend])
+
+  async def send_alone(self, ops, future):
+    try:
+      self.messages += 1
+      data = await self.upstream.request(self.encode_batch(
+        [(request, reply_size, None) for request,reply_size in ops]))
+      if not future.cancelled():
+        future.set_result(data)
+    except Exception as e:
+      if not future.done():
+        future.set_exception(e)
+
+  def summary(self):
+    return (
+      f'{self.requests} requests from clients, {self.messages} messages to emulator, '
+      f'{self.deduped} duplicate reads merged')
+
+
+async def serve(pcsx2: str, listen: str, window: float):
+  if pcsx2.startswith('/'):
+    upstream = await AsyncPine.connect(path=pcsx2)
+  else:
+    upstream = await AsyncPine.connect(address=pcsx2)
+  print(f'Connected to PCSX2 at {pcsx2}: {await upstream.game_info()}')
+
+  proxy = PineProxy(upstream, window)
+  if listen.startswith('/'):
+    if os.path.exists(listen):
+      os.unlink(listen)
+    server = await asyncio.start_unix_server(proxy.handle_client, path=listen)
+  else:
+    (host, port) = listen.split(':')
+    server = await asyncio.start_server(proxy.handle_client, host, int(port))
+  print(f'Listening on {listen}')
+
+  try:
+    async with server:
+      # Exits when the emulator goes away.
+      await upstream.reader_task
+  finally:
+    print(proxy.summary())
+
+
+def main(argv):
+  runtime_dir = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+  parser = argparse.ArgumentParser(prog='python -m tools proxy')
+  parser.add_argument('--pcsx2', default=os.path.join(runtime_dir, 'pcsx2.sock'),
+    help='Absolute path (unix) or host:port (windows) of the PCSX2 PINE socket')
+  parser.add_argument('--listen', default=os.path.join(runtime_dir, 'pcsx2-proxy.sock'),
+    help='Absolute path (unix) or host:port (windows) to accept clients on')
+  parser.add_argument('--window', type=float, default=0,
+    help='Milliseconds to wait for other clients before sending a request on')
+  args = parser.parse_args(argv)
+
+  try:
+    asyncio.run(serve(args.pcsx2, args.listen, args.window / 1000))
+  except KeyboardInterrupt:
+    pass
+
+main(sys.argv[2:])
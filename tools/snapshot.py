@@ -0,0 +1,91 @@
+'''
+Save Lua state snapshots to an indexed database, and query them offline.
+
+  python -m tools snapshot capture DB            # dump the live lua_State into DB
+  python -m tools snapshot load DUMP DB          # load a dump from 'inspect --format jsonl|binary'
+  python -m tools snapshot refs DB CONSTANT      # which functions use a string constant
+  python -m tools snapshot functions DB [--min-sizek N]
+                                                 # global functions with at least N constants
+  python -m tools snapshot path DB ADDR          # how to get from _G to an object
+  python -m tools snapshot sql DB QUERY          # anything else
+
+Only capture needs the emulator. See luadb.py for the schema.
+'''
+
+import argparse
+import sys
+import time
+
+from .luadb import LuaSnapshotDB
+from .luadump import dump, read_dump
+
+def capture(args):
+  from .connect import connect
+  pcsx2 = connect()
+  info = pcsx2.game_info()
+  print(info)
+  Lptr = pcsx2.peek32(0x0056CBD0)
+  print(f'L is at: {Lptr:08X}')
+  t = time.perf_counter()
+  count = args.db.load(dump(pcsx2, Lptr), uuid=info.uuid, L_ptr=Lptr, time=time.time())
+  print(f'Stored {count} records in {time.perf_counter() - t:.2f}s')
+
+def load(args):
+  t = time.perf_counter()
+  count = args.db.load(read_dump(args.dump), source=args.dump, time=time.time())
+  print(f'Stored {count} records in {time.perf_counter() - t:.2f}s')
+
+def refs(args):
+  db = args.db
+  for proto,idx,closures in db.referencing(args.constant):
+    names = [name for closure in closures for name in db.names(closure)]
+    print(f'proto${proto:08X} k{idx}: {', '.join(names) or '(no globals)'}'
+      f' [{', '.join(f'${closure:08X}' for closure in closures)}]')
+
+def functions(args):
+  for name,closure,proto,sizek,sizecode in args.db.functions(args.min_sizek):
+    print(f'{name:40s} function${closure:08X} proto${proto:08X} sizek={sizek} sizecode={sizecode}')
+
+def path(args):
+  path = args.db.path(int(args.addr, 16))
+  if path is None:
+    print(f'No path from _G to ${args.addr}')
+    return
+  print(args.db.format_path(path))
+
+def sql(args):
+  for row in args.db.db.execute(args.query):
+    print(*row, sep='\t')
+
+parser = argparse.ArgumentParser(prog='python -m tools snapshot')
+commands = parser.add_subparsers(required=True)
+command = commands.add_parser('capture', help='Dump the live lua_State into a database')
+command.add_argument('db')
+command.set_defaults(run=capture)
+command = commands.add_parser('load', help='Load a dump written by inspect into a database')
+command.add_argument('dump')
+command.add_argument('db')
+command.set_defaults(run=load)
+command = commands.add_parser('refs', help='Find functions with a given string constant')
+command.add_argument('db')
+command.add_argument('constant')
+command.set_defaults(run=refs)
+command = commands.add_parser('functions', help='List global functions by number of constants')
+command.add_argument('db')
+command.add_argument('--min-sizek', type=int, default=0)
+command.set_defaults(run=functions)
+command = commands.add_parser('path', help='Find the shortest path from _G to an address')
+command.add_argument('db')
+command.add_argument('addr', help='Address in hex')
+command.set_defaults(run=path)
+command = commands.add_parser('sql', help='Run an arbitrary SQL query')
+command.add_argument('db')
+command.add_argument('query')
+command.set_defaults(run=sql)
+
+args = parser.parse_args(sys.argv[2:])
+args.db = LuaSnapshotDB(args.db)
+try:
+  args.run(args)
+finally:
+  args.db.close()
@@ -1,10 +1,11 @@
 import sys
 import time
 
+from .connect import connect
 from .pine import Pine
 from .lua import GCObject, TObject
 
-pcsx2: Pine = Pine(path = '/run/user/8509/pcsx2.sock')
+pcsx2: Pine = connect()
 
 print(pcsx2.game_info())
 